@@ -1,23 +1,44 @@
 import logging
 import os
+import posixpath
 import schedule
 import time
 import json
-import paramiko
 import shutil
 from cryptography.fernet import Fernet
-import signal
+import stat
 import sys
-import win32com.client  # Requires `pywin32` package
+import threading
+from functools import partial
+from itertools import chain
 import subprocess
-import tkinter as tk
-from tkinter import simpledialog, messagebox
-from setup import prompt_user_for_config_gui  # Import setup functions
-from utils import generate_key, load_key, save_config, load_config, validate_config, add_to_startup  # Import shared utility functions
+from utils import generate_key, load_key, save_config, load_config, validate_config, add_to_startup, derive_payload_key  # Import shared utility functions
+from manifest import MANIFEST_FILE, Manifest, sftp_target, rebuild_from_remote
+from remote_tree import RemoteTree, normalize as normalize_remote_path
+from chunkstore import LocalChunkBackend, SFTPChunkBackend, store_file
+from delta import delta_upload
+from local_copy import copy_file
+from workers import WorkerPool, set_transfer_limit, transfer_slot
+from watcher import create_watcher
+from compression import available_codec, choose_codec
+from payload import STORED_SUFFIXES, Encryption, original_name, stored_base, stored_suffix, write_payload
+from resumable import PARTIAL_SUFFIX, partial_name, replace_remote, resumable_put
+from change_detection import SFTP_MTIME_TOLERANCE, ChangeDetector, local_mtime_tolerance
+from throttle import RTTMonitor, create_limiter, throttled
+from metrics import RunMetrics
+from snapshots import DEFAULT_RETENTION, SNAPSHOTS_DIR, VERSIONS_DIR, LocalSnapshotStore, SFTPSnapshotStore
+from jobs import DEFAULT_JOB, FanOut, JobRunner, job_configs, job_sources
+from scanner import ALL_FILES, SCAN_WORKERS, FileStat, ListingCache, PathFilter, SourceFile, scan
+from mirror import DEFAULT_MAX_DELETE_PERCENT, deletions_allowed, find_move, remove_empty_dirs, source_missing
+from scheduling import create_policy, log_stopped
+from backup_daemon import DEFAULT_SHUTDOWN_GRACE, BackupDaemon, control_port
+from packs import DEFAULT_BUNDLE_SIZE, DEFAULT_PACK_THRESHOLD, PACK_SUFFIX, PACKS_DIR, Packer, write_bundle
+from pathsets import PathSet, missing
+from audit import DEFAULT_AUDIT_TIME, run_audit
+from integrity import WHOLE_FILE, IntegrityError, RemoteHasher, StreamHasher, hashing, verify_file
 
 CONFIG_FILE = 'config.json'
 LOG_FILE = 'backup.log'
-BUSINESS_HOURS = (8, 18)  # 8 AM to 6 PM
 
 logging.basicConfig(
     filename=LOG_FILE,
@@ -66,147 +87,776 @@ def prompt_user_for_config():
 
     # Add scheduling configuration
     print("Configure scheduling:")
-    config["schedule_interval"] = input("Enter schedule interval (daily/weekly/custom): ").strip().lower()
+    config["schedule_interval"] = input("Enter schedule interval (daily/weekly/custom/watch): ").strip().lower()
     if config["schedule_interval"] == "custom":
         config["custom_interval_minutes"] = int(input("Enter custom interval in minutes: ").strip())
 
     return config
 
-def sftp_sync_directories(source_dir, remote_dir, host, port, username, password):
-    def connect_to_sftp(host, port, username, password):
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(host, port, username, password)
-        return ssh.open_sftp()
-
-    def create_remote_dir(sftp, remote_dir_path):
-        """Recursively create directories on the remote server."""
-        dirs = remote_dir_path.replace('\\', '/').split('/')
-        path = ''
-        for dir in dirs:
-            if dir:
-                path += f'/{dir}'
-                try:
-                    sftp.stat(path)
-                except IOError:
-                    sftp.mkdir(path)
-                    logging.info(f"Created remote directory: {path}")
+def connect_to_sftp(host, port, username, password):
+    import paramiko
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(host, port, username, password)
+    return ssh.open_sftp()
+
+def preserve_times(sftp, remote_path, local_stat):
+    """Give a remote file the access and modification times of its source."""
+    sftp.utime(remote_path, (local_stat.st_atime, local_stat.st_mtime))
+
+def log_summary(title, summary):
+    """Log the one-line outcome of a sync run."""
+    files = summary['files']
+    mirrored = ""
+    if files.get('moved') or files.get('deleted'):
+        mirrored = f"{files.get('moved', 0)} files moved, {files.get('deleted', 0)} files deleted, "
+    if files.get('deferred'):
+        mirrored += f"{files['deferred']} files deferred, "
+    packed = f" ({files['packed']} packed into bundles)" if files.get('packed') else ""
+    if files.get('verified'):
+        packed += f", {files['verified']} verified"
+    memory = f", peak memory {summary['peak_rss_bytes'] // (1024 * 1024)} MB" if summary.get('peak_rss_bytes') else ""
+    logging.info(f"{title}: {files.get('copied', 0)} files copied{packed}, {files.get('skipped', 0)} files skipped, {mirrored}"
+                 f"{files.get('failed', 0)} files failed, {summary['sent_bytes']} bytes sent in {summary['duration_seconds']} s{memory}.")
+
+def report_deferred(title, workers, metrics, walked):
+    """Count the transfers a deadline or cancel kept from starting, and say what the next run has left to do."""
+    for _, size in workers.deferred:
+        metrics.count("deferred", size)
+    if workers.deferred or (workers.policy.expired() and not walked):
+        log_stopped(title, workers.policy.stop_reason, len(workers.deferred), sum(size for _, size in workers.deferred), walked)
+
+def local_stat_lookup(source_dir):
+    """Return a function mapping a relative path to its local stat result, or None."""
+    def lookup(relative_path):
+        try:
+            return os.stat(os.path.join(source_dir, relative_path))
+        except OSError:
+            return None
+    return lookup
+
+def iter_source_files(source_dir, paths=None, path_filter=ALL_FILES, workers=SCAN_WORKERS):
+    """Yield a SourceFile for each file to back up: the whole tree, or only the given relative paths."""
+    if paths is None:
+        yield from scan(source_dir, path_filter, workers)
+        return
+    seen = set()
+    for relative_path in paths:
+        relative_path = relative_path.replace(os.sep, '/').strip('/')
+        path = os.path.join(source_dir, *relative_path.split('/'))
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISDIR(path_stat.st_mode):
+            # A directory that appeared or moved in: back up everything under it
+            files = scan(source_dir, path_filter, workers, start=relative_path)
+        elif stat.S_ISREG(path_stat.st_mode) and path_filter.accepts(relative_path):
+            files = [SourceFile(path, relative_path, FileStat(path_stat))]
+        else:
+            continue
+        for source in files:
+            if source.relative_path not in seen:
+                seen.add(source.relative_path)
+                yield source
 
-    def get_file_modification_time(file_path):
-        return os.path.getmtime(file_path)
+def verify_manifest(config, manifest_file=MANIFEST_FILE):
+    """Rebuild the SFTP manifest from a bulk listing of the remote backup directory."""
+    try:
+        remote_host = config.get('remote_host')
+        remote_port = config.get('remote_port')
+        remote_username = config.get('remote_username')
+        logging.info("Verifying manifest against the remote backup directory...")
+        sftp = connect_to_sftp(remote_host, remote_port, remote_username, config.get('remote_password'))
+        with Manifest(manifest_file) as manifest:
+            for source_folder, subdir in job_sources(config):
+                remote_directory = posixpath.join(config.get('remote_backup_directory'), subdir)
+                target = sftp_target(remote_host, remote_port, remote_username, remote_directory)
+                rebuild_from_remote(manifest, target, sftp, remote_directory, local_stat_lookup(source_folder))
+        sftp.close()
+    except Exception as e:
+        logging.error(f"An error occurred while verifying the manifest: {e}")
 
+def sftp_sync_directories(source_dir, remote_dir, host, port, username, password, parallelism=1, delta=False,
+                          compression=None, encryption=None, change_detection='mtime', throttle=None,
+                          snapshot_retention=None, mirror=False, max_delete_percent=DEFAULT_MAX_DELETE_PERCENT,
+                          pack_threshold=None, bundle_size=DEFAULT_BUNDLE_SIZE, verify=False, policy=None, paths=None,
+                          manifest_file=MANIFEST_FILE, source_files=None):
+    # paramiko takes longer to import than the rest of the program, so only SFTP runs load it
+    from sftp_pool import SFTPSessionPool, UploadWorkers
     try:
+        metrics = RunMetrics('sftp')
         logging.info("Connecting to SFTP...")
-        sftp = connect_to_sftp(host, port, username, password)
+        pool = SFTPSessionPool(host, port, username, password, metrics)
+        sftp = pool.open_session()
         logging.info("Connected to SFTP.")
 
-        # Set the initial remote directory
-        try:
-            sftp.chdir(remote_dir)
-            logging.info(f"Changed to remote directory: {remote_dir}")
-        except IOError:
-            logging.info(f"Remote directory {remote_dir} does not exist. Creating it.")
-            create_remote_dir(sftp, remote_dir)
-            sftp.chdir(remote_dir)
-            logging.info(f"Changed to remote directory: {remote_dir}")
-
-        files_copied = 0
-        files_skipped = 0
-        files_failed = 0
-
-        # Walk through the source directory
-        for root, dirs, files in os.walk(source_dir):
-            for file in files:
-                src_file = os.path.join(root, file)
-                relative_path = os.path.relpath(src_file, source_dir)
-                dest_file = os.path.join(remote_dir, relative_path).replace('\\', '/')
-
-                if not os.path.exists(src_file):
-                    logging.error(f"Source file does not exist: {src_file}")
-                    continue
+        # Remote state comes from one listing per directory instead of a stat per file
+        remote_dir = normalize_remote_path(remote_dir)
+        tree = RemoteTree(sftp)
+        tree.ensure_dir(sftp, remote_dir)
+
+        # With snapshots, replaced copies are moved into the earlier snapshots instead of being lost
+        snapshots = None
+        if snapshot_retention is not None:
+            snapshots = SFTPSnapshotStore(sftp, remote_dir, tree)
+            snapshots.begin()
+            if delta:
+                logging.info("Delta uploads are not used with snapshots, since they modify the previous copy in place.")
+                delta = False
+
+        # In mirror mode a file that moved is renamed on the server rather than uploaded again,
+        # unless snapshots need the old copy to stay where it is
+        detect_moves = mirror and snapshots is None
+        if mirror and snapshots is not None:
+            logging.info("Moved files are uploaded again with snapshots, so earlier snapshots keep the old copy.")
+        # Only a mirrored full run needs the names it saw; they spill to disk rather than fill memory
+        seen = PathSet() if mirror and paths is None else None
+
+        # Small files below pack_threshold go into bundles, each sent as one sequential write
+        if pack_threshold and snapshots is not None:
+            logging.info("Small files are not packed with snapshots, since bundles can't keep earlier versions.")
+            pack_threshold = None
 
+        def submit_bundle(bundle_id, files):
+            workers.submit(upload_bundle(bundle_id, files), posixpath.join(PACKS_DIR, bundle_id),
+                           sum(local_stat.st_size for _, _, local_stat, _ in files))
+
+        packs = Packer(submit_bundle, bundle_size)
+
+        # Uploads are hashed as they are sent, then checked against a digest taken on the server
+        verifier = RemoteHasher() if verify else None
+
+        def keep_version(worker_sftp, stored_file, relative_path):
+            """Move a copy about to be replaced into the snapshots that contain it; False if there are none."""
+            return snapshots is not None and snapshots.retire(
+                worker_sftp, posixpath.relpath(stored_file, remote_dir), manifest.get_snapshot(target, relative_path))
+
+        def upload(src_file, dest_file, relative_path, local_stat, stored_infos, resume_offset):
+            def task(worker_sftp):
+                started = time.monotonic()
                 try:
-                    remote_file_info = sftp.stat(dest_file)
-                    remote_mtime = remote_file_info.st_mtime
-                except IOError:
-                    remote_mtime = 0
-
-                local_mtime = get_file_modification_time(src_file)
-                if local_mtime > remote_mtime:
-                    remote_dir_path = os.path.dirname(dest_file).replace('\\', '/')
-                    try:
-                        sftp.chdir(remote_dir_path)
-                    except IOError:
-                        create_remote_dir(sftp, remote_dir_path)
-                        sftp.chdir(remote_dir_path)
+                    tree.ensure_dir(worker_sftp, posixpath.dirname(dest_file))
+                    manifest.start_upload(target, relative_path, local_stat.st_size, local_stat.st_mtime)
+                    kept = {suffix for suffix, info in stored_infos.items()
+                            if info and keep_version(worker_sftp, dest_file + suffix, relative_path)}
+                    codec = choose_codec(src_file, compression)
+                    suffix = stored_suffix(codec, encryption)
+                    hasher = StreamHasher(verifier.kinds) if verifier else None
+                    if suffix:
+                        attributes, stored_digest = upload_payload(worker_sftp, src_file, dest_file + suffix, local_stat, codec,
+                                                                   hasher)
+                    elif delta:
+                        attributes, stored_digest = upload_delta(worker_sftp, src_file, dest_file, relative_path, local_stat,
+                                                                 stored_infos[''], hasher)
+                    else:
+                        attributes, stored_digest = upload_file(worker_sftp, src_file, dest_file, local_stat, resume_offset,
+                                                                hasher)
+                    # Drop copies stored another way so restores find exactly one
+                    for other_suffix, info in stored_infos.items():
+                        if info and other_suffix != suffix and other_suffix not in kept:
+                            worker_sftp.remove(dest_file + other_suffix)
+                    if manifest.get_bundle(target, relative_path):
+                        packs.drop(relative_path)
+                    digest = detector.digest(src_file, local_stat) if detector.use_hashes or mirror else None
+                    manifest.record(target, relative_path, local_stat.st_size, local_stat.st_mtime, attributes.st_size, attributes.st_mtime,
+                                    codec, digest, snapshots.id if snapshots else None, stored_digest=stored_digest)
+                    if snapshots:
+                        snapshots.record_change(relative_path)
+                    metrics.count("copied", local_stat.st_size)
+                    if stored_digest:
+                        metrics.count("verified", local_stat.st_size)
+                except Exception as e:
+                    logging.error(f"Failed to copy {src_file} to {dest_file}: {e}")
+                    metrics.count("failed", local_stat.st_size)
+                finally:
+                    metrics.add_phase("transfer", time.monotonic() - started)
+            return task
+
+        def upload_bundle(bundle_id, files):
+            def task(worker_sftp):
+                started = time.monotonic()
+                pack_file = posixpath.join(remote_dir, PACKS_DIR, bundle_id + PACK_SUFFIX)
+                try:
+                    tree.ensure_dir(worker_sftp, posixpath.dirname(pack_file))
+                    entries, written = write_bundle(worker_sftp, pack_file, files, compression, encryption, throttle, verifier)
+                    metrics.sent(written)
+                    packed = {entry['path']: entry for entry in entries}
+                    for src_file, relative_path, local_stat, stored_infos in files:
+                        entry = packed.get(relative_path)
+                        if entry is None:
+                            metrics.count("failed", local_stat.st_size)
+                            continue
+                        # The bundle holds the file now; drop copies stored on their own so restores find exactly one
+                        for suffix, info in stored_infos.items():
+                            if info:
+                                worker_sftp.remove(posixpath.join(remote_dir, stored_base(relative_path)) + suffix)
+                        digest = detector.digest(src_file, local_stat) if detector.use_hashes or mirror else None
+                        manifest.record(target, relative_path, local_stat.st_size, local_stat.st_mtime, codec=entry['codec'],
+                                        digest=digest, bundle=bundle_id)
+                        metrics.count("copied", local_stat.st_size)
+                        metrics.count("packed", local_stat.st_size)
+                        if verifier:
+                            metrics.count("verified", local_stat.st_size)
+                    logging.debug(f"Packed {len(entries)} files into {pack_file} ({written} bytes)")
+                except Exception as e:
+                    logging.error(f"Failed to upload bundle {pack_file}: {e}")
+                    for _, _, local_stat, _ in files:
+                        metrics.count("failed", local_stat.st_size)
+                finally:
+                    metrics.add_phase("transfer", time.monotonic() - started)
+            return task
+
+        def check_upload(worker_sftp, stored_file, hasher):
+            """Check an upload against the digests taken as it was sent; returns the digest to record, if checked.
+
+            A copy that differs is deleted, so the next run sends the file again.
+            """
+            if hasher is None:
+                return None
+            try:
+                return verifier.verify(worker_sftp, stored_file, hasher.hexdigests())
+            except IntegrityError:
+                worker_sftp.remove(stored_file)
+                raise
+
+        def upload_file(worker_sftp, src_file, dest_file, local_stat, resume_offset, hasher):
+            # Upload under a temporary name so an interrupted transfer never looks like a finished file
+            partial_file = partial_name(dest_file)
+            sent = resumable_put(worker_sftp, src_file, partial_file, resume_offset, throttle, hasher)
+            preserve_times(worker_sftp, partial_file, local_stat)
+            # A copy is checked before it replaces the previous one
+            stored_digest = check_upload(worker_sftp, partial_file, hasher)
+            replace_remote(worker_sftp, partial_file, dest_file)
+            metrics.sent(sent)
+            if resume_offset:
+                logging.info(f"Resumed: {src_file} to {dest_file} at byte {resume_offset}, {sent} bytes sent")
+            else:
+                logging.debug(f"Copied: {src_file} to {dest_file}")
+            return worker_sftp.stat(dest_file), stored_digest
+
+        def upload_payload(worker_sftp, src_file, stored_file, local_stat, codec, hasher):
+            # Compressed and encrypted streams can't be resumed part-way, but still only appear once complete
+            partial_file = partial_name(stored_file)
+            with worker_sftp.open(partial_file, 'wb') as remote_file:
+                remote_file.set_pipelined(True)
+                written = write_payload(src_file, hashing(throttled(remote_file, throttle), hasher), codec, encryption)
+            preserve_times(worker_sftp, partial_file, local_stat)
+            stored_digest = check_upload(worker_sftp, partial_file, hasher)
+            replace_remote(worker_sftp, partial_file, stored_file)
+            metrics.sent(written)
+            logging.debug(f"Copied: {src_file} to {stored_file} ({written} bytes for {local_stat.st_size})")
+            return worker_sftp.stat(stored_file), stored_digest
+
+        def upload_delta(worker_sftp, src_file, dest_file, relative_path, local_stat, remote_file_info, hasher):
+            # The cached signature only describes the remote copy if it is still the one we uploaded
+            previous = manifest.get(target, relative_path)
+            signature = manifest.get_signature(target, relative_path)
+            if remote_file_info is None or previous is None or \
+                    (previous[2], previous[3]) != (remote_file_info.st_size, remote_file_info.st_mtime):
+                signature = None
+            manifest.drop_signature(target, relative_path)
+            remote_size = remote_file_info.st_size if remote_file_info else None
+            signature, bytes_sent = delta_upload(worker_sftp, src_file, dest_file, signature, remote_size, throttle, hasher)
+            preserve_times(worker_sftp, dest_file, local_stat)
+            # Patched in place, so there is no earlier copy left to keep if this one differs
+            stored_digest = check_upload(worker_sftp, dest_file, hasher)
+            attributes = worker_sftp.stat(dest_file)
+            manifest.put_signature(target, relative_path, signature)
+            metrics.sent(bytes_sent)
+            logging.debug(f"Copied: {src_file} to {dest_file} ({bytes_sent} of {local_stat.st_size} bytes sent)")
+            return attributes, stored_digest
+
+        def move_remote(old_path, relative_path, dest_file, local_stat):
+            """Rename the copy of a file that moved in the source to its new name. False if there was none."""
+            old_file = posixpath.join(remote_dir, stored_base(old_path))
+            moved = None
+            for suffix in STORED_SUFFIXES:
+                if tree.stat(old_file + suffix):
+                    tree.ensure_dir(sftp, posixpath.dirname(dest_file))
+                    sftp.rename(old_file + suffix, dest_file + suffix)
+                    moved = dest_file + suffix
+            if moved is None:
+                return False
+            preserve_times(sftp, moved, local_stat)
+            manifest.rename(target, old_path, relative_path, local_stat.st_size, local_stat.st_mtime, int(local_stat.st_mtime))
+            moved_from.append(old_path)
+            logging.debug(f"Moved: {old_file} to {moved}")
+            return True
+
+        def delete_vanished():
+            """Delete the copies of files gone from the source, within the safety limit."""
+            with PathSet() as vanished:
+                # The sorted manifest is merged against the sorted walk, so neither is held in memory
+                for path in missing(manifest.paths(target), seen):
+                    if source_missing(source_dir, path):
+                        vanished.add(path)
+                if not deletions_allowed(len(vanished), manifest.count(target), max_delete_percent):
+                    return
+                for relative_path in vanished:
+                    stored_file = posixpath.join(remote_dir, stored_base(relative_path))
                     try:
-                        sftp.put(src_file, dest_file)
-                        logging.info(f"Copied: {src_file} to {dest_file}")
-                        files_copied += 1
+                        for suffix in STORED_SUFFIXES:
+                            if tree.stat(stored_file + suffix) and not keep_version(sftp, stored_file + suffix, relative_path):
+                                sftp.remove(stored_file + suffix)
+                        if manifest.get_bundle(target, relative_path):
+                            packs.drop(relative_path)
+                        manifest.remove(target, relative_path)
+                        if snapshots:
+                            snapshots.record_change(relative_path)
+                        logging.debug(f"Deleted: {stored_file}")
+                        metrics.count("deleted")
                     except Exception as e:
-                        logging.error(f"Failed to copy {src_file} to {dest_file}: {e}")
-                        files_failed += 1
+                        logging.error(f"Failed to delete {stored_file}: {e}")
+                remove_empty_dirs(lambda relative_dir: sftp.rmdir(posixpath.join(remote_dir, relative_dir)),
+                                  chain(vanished, moved_from))
+
+        def consider(src_file, relative_path, local_stat):
+            """Return the upload task for a file, or None if its copy is current."""
+            dest_file = posixpath.join(remote_dir, stored_base(relative_path))
+            metrics.count("scanned", local_stat.st_size)
+
+            # Files unchanged since their last upload never touch the network
+            if manifest.is_unchanged(target, relative_path, local_stat.st_size, local_stat.st_mtime):
+                if mirror and manifest.get_digest(target, relative_path) is None:
+                    # Moves are matched by contents, so every copy needs a digest once
+                    manifest.set_digest(target, relative_path, detector.digest(src_file, local_stat))
+                logging.debug(f"Skipped (up-to-date): {src_file}")
+                metrics.count("skipped", local_stat.st_size)
+                return None
+
+            # A file may be stored as-is, compressed and/or encrypted; the newest copy counts
+            stored_infos = {suffix: tree.stat(dest_file + suffix) for suffix in STORED_SUFFIXES}
+            newest_suffix, remote_file_info = max(((suffix, info) for suffix, info in stored_infos.items() if info),
+                                                  key=lambda item: item[1].st_mtime or 0, default=(None, None))
+
+            # Uploads keep the local size and mtime, so a copy with both is current; an interrupted one never is
+            started = interrupted.get(relative_path)
+            if started is None and remote_file_info is not None:
+                stored_size = remote_file_info.st_size if newest_suffix == '' else None
+                if detector.unchanged(local_stat, stored_size, remote_file_info.st_mtime):
+                    digest = detector.digest(src_file, local_stat) if detector.use_hashes or mirror else None
+                    manifest.record(target, relative_path, local_stat.st_size, local_stat.st_mtime, remote_file_info.st_size,
+                                    remote_file_info.st_mtime, digest=digest)
+                    logging.debug(f"Skipped (up-to-date): {src_file}")
+                    metrics.count("skipped", local_stat.st_size)
+                    return None
+                previous = manifest.get(target, relative_path)
+                if detector.use_hashes and previous is not None and previous[0] == local_stat.st_size and \
+                        detector.digest(src_file, local_stat) == manifest.get_digest(target, relative_path):
+                    # Touched but not modified: bring the remote time in line instead of uploading again
+                    stored_file = dest_file + newest_suffix
+                    preserve_times(sftp, stored_file, local_stat)
+                    manifest.record(target, relative_path, local_stat.st_size, local_stat.st_mtime, remote_file_info.st_size,
+                                    int(local_stat.st_mtime), digest=detector.digest(src_file, local_stat))
+                    logging.debug(f"Skipped (contents unchanged): {src_file}")
+                    metrics.count("skipped", local_stat.st_size)
+                    return None
+
+            # A new name for contents uploaded under a name that is gone from the source: rename instead
+            if detect_moves and started is None and remote_file_info is None:
+                old_path = find_move(manifest, detector, target, source_dir, src_file, local_stat)
+                if old_path is not None and move_remote(old_path, relative_path, dest_file, local_stat):
+                    metrics.count("moved", local_stat.st_size)
+                    return None
+
+            if pack_threshold and local_stat.st_size < pack_threshold and started is None:
+                packs.add(src_file, relative_path, local_stat, stored_infos)
+                return None
+
+            resume_offset = 0
+            partial_info = tree.stat(partial_name(dest_file))
+            if partial_info and started == (local_stat.st_size, local_stat.st_mtime):
+                resume_offset = min(partial_info.st_size or 0, local_stat.st_size)
+            return upload(src_file, dest_file, relative_path, local_stat, stored_infos, resume_offset)
+
+        def submit(src_file, relative_path, local_stat=None):
+            if local_stat is None:
+                try:
+                    local_stat = os.stat(src_file)
+                except OSError:
+                    logging.error(f"Source file does not exist: {src_file}")
+                    return
+            # Time spent waiting for a free worker belongs to the transfer, not the comparison
+            with metrics.phase("compare"):
+                task = consider(src_file, relative_path, local_stat)
+            if task:
+                workers.submit(task, relative_path, local_stat.st_size)
+
+        with Manifest(manifest_file) as manifest:
+            target = sftp_target(host, port, username, remote_dir)
+            interrupted = manifest.interrupted_uploads(target)
+            detector = ChangeDetector(manifest, change_detection == 'hash', SFTP_MTIME_TOLERANCE)
+            moved_from = []
+            walked = False
+            workers = UploadWorkers(pool, parallelism, policy=policy)
+            logging.info(f"Uploading with {workers.parallelism} SFTP session(s).")
+            # Round trips are timed on a session of their own, so probes never queue behind uploads
+            monitor = RTTMonitor(pool.open_session(), throttle) if throttle and throttle.adaptive else None
+            if monitor:
+                monitor.start()
+
+            try:
+                # Finish what the last run left half-done before walking the rest of the tree
+                if interrupted:
+                    logging.info(f"Resuming {len(interrupted)} interrupted upload(s).")
+                for relative_path in sorted(interrupted):
+                    if seen is not None:
+                        seen.add(relative_path)
+                    src_file = os.path.join(source_dir, *relative_path.split('/'))
+                    if os.path.isfile(src_file):
+                        submit(src_file, relative_path)
+                    else:
+                        manifest.remove(target, relative_path)
+
+                # Walk through the source directory, unless another target's walk is shared
+                if source_files is None:
+                    source_files = iter_source_files(source_dir, paths)
+                for source in metrics.timed("walk", source_files):
+                    if policy and policy.expired():
+                        break
+                    if seen is not None:
+                        seen.add(source.relative_path)
+                    if source.relative_path not in interrupted:
+                        submit(*source)
                 else:
-                    logging.info(f"Skipped (up-to-date): {src_file}")
-                    files_skipped += 1
+                    # Only a complete walk of the whole source shows what was deleted
+                    walked = True
+            finally:
+                packs.flush()
+                workers.join()
+                report_deferred("SFTP sync", workers, metrics, walked)
+                if monitor:
+                    monitor.stop()
+                if seen is not None:
+                    try:
+                        if walked:
+                            delete_vanished()
+                    except Exception as e:
+                        logging.error(f"Failed to mirror deletions: {e}")
+                    finally:
+                        seen.close()
+                if packs.changed:
+                    try:
+                        packs.finish(sftp, remote_dir, manifest.bundles(target))
+                    except Exception as e:
+                        logging.error(f"Failed to update the bundles of small files: {e}")
+                if snapshots:
+                    try:
+                        snapshots.finish(snapshot_retention)
+                    except Exception as e:
+                        logging.error(f"Failed to record snapshot: {e}")
 
-        logging.info(f"SFTP Sync Completed: {files_copied} files copied, {files_skipped} files skipped, {files_failed} files failed.")
-        sftp.close()
+        pool.close()
+        summary = metrics.finish()
+        log_summary("SFTP Sync Completed", summary)
+        return summary
     except Exception as e:
         logging.error(f"An error occurred during SFTP sync: {e}")
 
-def local_sync_directories(source_dir, dest_dir):
+def chunk_sync_directories(source_dir, backend, target, paths=None, manifest_file=MANIFEST_FILE, metrics=None,
+                           source_files=None, policy=None):
+    """Store new and changed files in a deduplicating chunk store. Returns the run summary.
+
+    Files are stored one at a time as they are found, so the policy's deadline
+    applies but its order does not.
+    """
+    metrics = metrics or RunMetrics('chunks')
+    chunks_sent = 0
+    if source_files is None:
+        source_files = iter_source_files(source_dir, paths)
+
+    with Manifest(manifest_file) as manifest:
+        for src_file, relative_path, local_stat in metrics.timed("walk", source_files):
+            if policy and policy.expired():
+                log_stopped("Chunk sync", policy.stop_reason, 0, 0, False)
+                break
+            metrics.count("scanned", local_stat.st_size)
+
+            if manifest.is_unchanged(target, relative_path, local_stat.st_size, local_stat.st_mtime):
+                logging.debug(f"Skipped (up-to-date): {src_file}")
+                metrics.count("skipped", local_stat.st_size)
+                continue
+
+            try:
+                with metrics.phase("transfer"), transfer_slot():
+                    new_chunks, new_bytes = store_file(backend, src_file, relative_path, local_stat)
+                manifest.record(target, relative_path, local_stat.st_size, local_stat.st_mtime)
+                metrics.count("copied", local_stat.st_size)
+                metrics.sent(new_bytes)
+                chunks_sent += new_chunks
+            except Exception as e:
+                logging.error(f"Failed to store {src_file}: {e}")
+                metrics.count("failed", local_stat.st_size)
+
+    summary = metrics.finish()
+    log_summary("Chunk Sync Completed", summary)
+    logging.info(f"{chunks_sent} new chunks written.")
+    return summary
+
+def sftp_chunk_sync(source_dir, remote_dir, host, port, username, password, throttle=None, policy=None, paths=None,
+                    manifest_file=MANIFEST_FILE, source_files=None):
+    """Back up to a chunk store on the SFTP server."""
+    from sftp_pool import SFTPSessionPool
+    try:
+        metrics = RunMetrics('sftp-chunks')
+        logging.info("Connecting to SFTP...")
+        pool = SFTPSessionPool(host, port, username, password, metrics)
+        sftp = pool.open_session()
+        logging.info("Connected to SFTP.")
+        remote_dir = normalize_remote_path(remote_dir)
+        backend = SFTPChunkBackend(sftp, remote_dir, RemoteTree(sftp), throttle)
+        target = sftp_target(host, port, username, remote_dir) + '#chunks'
+        summary = chunk_sync_directories(source_dir, backend, target, paths, manifest_file, metrics, source_files, policy)
+        pool.close()
+        return summary
+    except Exception as e:
+        logging.error(f"An error occurred during SFTP chunk sync: {e}")
+
+def local_chunk_sync(source_dir, dest_dir, throttle=None, policy=None, paths=None, manifest_file=MANIFEST_FILE,
+                     source_files=None):
+    """Back up to a chunk store in a local directory."""
+    try:
+        logging.info("Starting local chunk store sync...")
+        backend = LocalChunkBackend(dest_dir, throttle)
+        return chunk_sync_directories(source_dir, backend, f"chunks:{os.path.abspath(dest_dir)}", paths, manifest_file,
+                                      RunMetrics('local-chunks'), source_files, policy)
+    except Exception as e:
+        logging.error(f"An error occurred during local chunk sync: {e}")
+
+def local_sync_directories(source_dir, dest_dir, parallelism=1, compression=None, encryption=None, change_detection='mtime',
+                           throttle=None, snapshot_retention=None, mirror=False, max_delete_percent=DEFAULT_MAX_DELETE_PERCENT,
+                           verify=False, audit=False, policy=None, paths=None, manifest_file=MANIFEST_FILE,
+                           source_files=None, mtime_tolerance=None):
     def create_local_dir(path):
         """Recursively create directories on the local system."""
         if not os.path.exists(path):
-            os.makedirs(path)
+            os.makedirs(path, exist_ok=True)
             logging.info(f"Created local directory: {path}")
 
-    def get_file_modification_time(file_path):
-        return os.path.getmtime(file_path)
-
     try:
         logging.info("Starting local directory sync...")
 
         # Ensure the destination directory exists
         create_local_dir(dest_dir)
 
-        files_copied = 0
-        files_skipped = 0
-        files_failed = 0
+        metrics = RunMetrics('local')
 
-        # Walk through the source directory
-        for root, dirs, files in os.walk(source_dir):
-            for file in files:
-                src_file = os.path.join(root, file)
-                relative_path = os.path.relpath(src_file, source_dir)
-                dest_file = os.path.join(dest_dir, relative_path)
+        # With snapshots, replaced copies are moved into the earlier snapshots instead of being lost
+        snapshots = None
+        if snapshot_retention is not None:
+            snapshots = LocalSnapshotStore(dest_dir)
+            snapshots.begin()
+        target = f"local:{os.path.abspath(dest_dir)}"
 
-                if not os.path.exists(src_file):
-                    logging.error(f"Source file does not exist: {src_file}")
-                    continue
+        # In mirror mode a file that moved is renamed in the backup rather than copied again,
+        # unless snapshots need the old copy to stay where it is
+        detect_moves = mirror and snapshots is None
+        # Only a mirrored full run needs the names it saw; they spill to disk rather than fill memory
+        seen = PathSet() if mirror and paths is None else None
+        moved_from = []
 
+        def copy(src_file, dest_file, relative_path, local_stat):
+            def task(session):
+                started = time.monotonic()
                 try:
-                    remote_mtime = os.path.getmtime(dest_file)
-                except FileNotFoundError:
-                    remote_mtime = 0
-
-                local_mtime = get_file_modification_time(src_file)
-                if local_mtime > remote_mtime:
-                    dest_dir_path = os.path.dirname(dest_file)
-                    create_local_dir(dest_dir_path)
+                    if snapshots:
+                        for existing_suffix in STORED_SUFFIXES:
+                            if os.path.exists(dest_file + existing_suffix):
+                                snapshots.retire(session, f"{stored_base(relative_path)}{existing_suffix}",
+                                                 manifest.get_snapshot(target, relative_path))
+                    codec = choose_codec(src_file, compression)
+                    suffix = stored_suffix(codec, encryption)
+                    stored_file = dest_file + suffix
+                    hasher = StreamHasher((WHOLE_FILE,)) if verify else None
+                    if suffix:
+                        partial_file = partial_name(stored_file)
+                        with open(partial_file, 'wb') as stored:
+                            written = write_payload(src_file, hashing(throttled(stored, throttle), hasher), codec, encryption)
+                        shutil.copystat(src_file, partial_file)
+                        os.replace(partial_file, stored_file)
+                        metrics.sent(written)
+                        logging.debug(f"Copied: {src_file} to {stored_file} ({written} bytes)")
+                    else:
+                        copy_file(src_file, dest_file, throttle, hasher)
+                        metrics.sent(local_stat.st_size)
+                        logging.debug(f"Copied: {src_file} to {dest_file}")
+                    stored_digest = None
+                    if hasher:
+                        try:
+                            stored_digest = verify_file(stored_file, hasher.hexdigests())
+                        except IntegrityError:
+                            # A copy that differs is removed, so the next run copies the file again
+                            os.remove(stored_file)
+                            raise
+                    # Drop copies stored another way so restores find exactly one
+                    for other_suffix in STORED_SUFFIXES:
+                        if other_suffix != suffix and os.path.exists(dest_file + other_suffix):
+                            os.remove(dest_file + other_suffix)
+                    if manifest is not None:
+                        digest = detector.digest(src_file, local_stat) if detector.use_hashes or mirror else None
+                        manifest.record(target, relative_path, local_stat.st_size, local_stat.st_mtime, codec=codec,
+                                        digest=digest, snapshot=snapshots.id if snapshots else None, stored_digest=stored_digest)
+                    if snapshots:
+                        snapshots.record_change(relative_path)
+                    metrics.count("copied", local_stat.st_size)
+                    if stored_digest:
+                        metrics.count("verified", local_stat.st_size)
+                except Exception as e:
+                    logging.error(f"Failed to copy {src_file} to {dest_file}: {e}")
+                    metrics.count("failed", local_stat.st_size)
+                finally:
+                    metrics.add_phase("transfer", time.monotonic() - started)
+            return task
+
+        def remember_copy(src_file, relative_path, local_stat):
+            # Moves are matched by contents, so every copy needs a digest once
+            if mirror and manifest.get_digest(target, relative_path) is None:
+                manifest.record(target, relative_path, local_stat.st_size, local_stat.st_mtime,
+                                digest=detector.digest(src_file, local_stat))
+            # Audits sample the recorded copies, including those made before auditing was turned on
+            elif audit and manifest.get(target, relative_path) is None:
+                manifest.record(target, relative_path, local_stat.st_size, local_stat.st_mtime)
+
+        def move_local(old_path, relative_path, dest_file, local_stat):
+            """Rename the copy of a file that moved in the source to its new name. False if there was none."""
+            old_file = os.path.join(dest_dir, *stored_base(old_path).split('/'))
+            moved = None
+            for suffix in STORED_SUFFIXES:
+                if os.path.exists(old_file + suffix):
+                    create_local_dir(os.path.dirname(dest_file))
+                    os.replace(old_file + suffix, dest_file + suffix)
+                    moved = dest_file + suffix
+            if moved is None:
+                return False
+            # In nanoseconds, so the copy's time matches its source's exactly
+            os.utime(moved, ns=(int(local_stat.st_atime * 1e9), local_stat.st_mtime_ns))
+            manifest.rename(target, old_path, relative_path, local_stat.st_size, local_stat.st_mtime)
+            moved_from.append(old_path)
+            logging.debug(f"Moved: {old_file} to {moved}")
+            return True
+
+        def delete_vanished():
+            """Delete the copies of files gone from the source, within the safety limit."""
+            with PathSet() as stored, PathSet() as vanished:
+                for root, dirs, files in os.walk(dest_dir):
+                    if root == dest_dir:
+                        dirs[:] = [name for name in dirs if name not in (SNAPSHOTS_DIR, VERSIONS_DIR)]
+                    relative_root = os.path.relpath(root, dest_dir).replace(os.sep, '/')
+                    # A file stored more than one way is counted once
+                    for name in {original_name(name) for name in files if not name.endswith(PARTIAL_SUFFIX)}:
+                        stored.add(name if relative_root == '.' else f"{relative_root}/{name}")
+                # Both sides are sorted, so they are merged without holding either in memory
+                for path in missing(stored, seen):
+                    if source_missing(source_dir, path):
+                        vanished.add(path)
+                if not deletions_allowed(len(vanished), len(stored), max_delete_percent):
+                    return
+                for relative_path in vanished:
                     try:
-                        shutil.copy2(src_file, dest_file)
-                        logging.info(f"Copied: {src_file} to {dest_file}")
-                        files_copied += 1
+                        for suffix in STORED_SUFFIXES:
+                            stored_path = stored_base(relative_path) + suffix
+                            stored_file = os.path.join(dest_dir, *stored_path.split('/'))
+                            if os.path.exists(stored_file) and \
+                                    not (snapshots and snapshots.retire(None, stored_path, manifest.get_snapshot(target, relative_path))):
+                                os.remove(stored_file)
+                        if manifest is not None:
+                            manifest.remove(target, relative_path)
+                        if snapshots:
+                            snapshots.record_change(relative_path)
+                        logging.debug(f"Deleted: {relative_path} from {dest_dir}")
+                        metrics.count("deleted")
                     except Exception as e:
-                        logging.error(f"Failed to copy {src_file} to {dest_file}: {e}")
-                        files_failed += 1
-                else:
-                    logging.info(f"Skipped (up-to-date): {src_file}")
-                    files_skipped += 1
+                        logging.error(f"Failed to delete {relative_path} from {dest_dir}: {e}")
+                remove_empty_dirs(lambda relative_dir: os.rmdir(os.path.join(dest_dir, *relative_dir.split('/'))),
+                                  chain(vanished, moved_from))
+
+        # The manifest caches content digests in hash mode, remembers which snapshot wrote each copy,
+        # in mirror mode which contents each copy holds, with verification what each copy was checked against,
+        # and for audits which copies there are to sample
+        manifest = Manifest(manifest_file) if change_detection == 'hash' or snapshots or mirror or verify or audit else None
+        if mtime_tolerance is None:
+            mtime_tolerance = local_mtime_tolerance(dest_dir)
+        detector = ChangeDetector(manifest, change_detection == 'hash', mtime_tolerance)
+        walked = False
+
+        # The walk feeds a bounded queue drained by the copier threads
+        workers = WorkerPool(parallelism, name='local-copy', policy=policy)
+        stored_files = ListingCache()
+        if source_files is None:
+            source_files = iter_source_files(source_dir, paths)
+        try:
+            for src_file, posix_path, local_stat in metrics.timed("walk", source_files):
+                if policy and policy.expired():
+                    break
+                dest_file = os.path.join(dest_dir, *stored_base(posix_path).split('/'))
+                if seen is not None:
+                    seen.add(posix_path)
+                compare_started = time.monotonic()
+                metrics.count("scanned", local_stat.st_size)
+
+                # A file may be stored as-is, compressed and/or encrypted; the newest copy counts.
+                # One listing per backup folder answers for every name in it
+                newest_suffix, stored_stat = None, None
+                for suffix in STORED_SUFFIXES:
+                    candidate = stored_files.stat(dest_file + suffix)
+                    if candidate is not None and (stored_stat is None or candidate.st_mtime > stored_stat.st_mtime):
+                        newest_suffix, stored_stat = suffix, candidate
+
+                if stored_stat is not None:
+                    stored_size = stored_stat.st_size if newest_suffix == '' else None
+                    if detector.unchanged(local_stat, stored_size, stored_stat.st_mtime):
+                        remember_copy(src_file, posix_path, local_stat)
+                        logging.debug(f"Skipped (up-to-date): {src_file}")
+                        metrics.count("skipped", local_stat.st_size)
+                        metrics.add_phase("compare", time.monotonic() - compare_started)
+                        continue
+                    if detector.use_hashes and stored_size == local_stat.st_size and \
+                            detector.digest(src_file, local_stat) == detector.digest(dest_file, stored_stat):
+                        # Touched but not modified: bring the copy's times in line instead of copying again
+                        shutil.copystat(src_file, dest_file)
+                        remember_copy(src_file, posix_path, local_stat)
+                        logging.debug(f"Skipped (contents unchanged): {src_file}")
+                        metrics.count("skipped", local_stat.st_size)
+                        metrics.add_phase("compare", time.monotonic() - compare_started)
+                        continue
+
+                # A new name for contents copied under a name that is gone from the source: rename instead
+                if detect_moves and stored_stat is None:
+                    old_path = find_move(manifest, detector, target, source_dir, src_file, local_stat)
+                    if old_path is not None and move_local(old_path, posix_path, dest_file, local_stat):
+                        metrics.count("moved", local_stat.st_size)
+                        metrics.add_phase("compare", time.monotonic() - compare_started)
+                        continue
+
+                create_local_dir(os.path.dirname(dest_file))
+                metrics.add_phase("compare", time.monotonic() - compare_started)
+                workers.submit(copy(src_file, dest_file, posix_path, local_stat), posix_path, local_stat.st_size)
+            else:
+                # Only a complete walk of the whole source shows what was deleted
+                walked = True
+        finally:
+            workers.join()
+            report_deferred("Local sync", workers, metrics, walked)
+            if seen is not None:
+                try:
+                    if walked:
+                        delete_vanished()
+                except Exception as e:
+                    logging.error(f"Failed to mirror deletions: {e}")
+                finally:
+                    seen.close()
+            if snapshots:
+                try:
+                    snapshots.finish(snapshot_retention)
+                except Exception as e:
+                    logging.error(f"Failed to record snapshot: {e}")
+            if manifest is not None:
+                manifest.close()
 
-        logging.info(f"Local Sync Completed: {files_copied} files copied, {files_skipped} files skipped, {files_failed} files failed.")
+        summary = metrics.finish()
+        log_summary("Local Sync Completed", summary)
+        return summary
     except Exception as e:
         logging.error(f"An error occurred during local sync: {e}")
 
@@ -257,76 +907,210 @@ def get_required_fields(local_sync, sftp_sync):
         }
     return {}
 
-def run_backup(config):
-    """Run the backup based on the configuration."""
+def run_targets(targets, source_files):
+    """Run the syncs of every target at once, over a single walk of the source."""
+    if len(targets) == 1:
+        targets[0](source_files=source_files)
+        return
+    fan_out = FanOut(source_files, len(targets))
+
+    def run(index, target):
+        try:
+            target(source_files=fan_out.branch(index))
+        finally:
+            fan_out.close(index)
+
+    threads = [threading.Thread(target=run, args=(index, target), name=f"target-{index}") for index, target in enumerate(targets)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def run_backup(config, paths=None, cancel=None):
+    """Run the backup based on the configuration, optionally for the given relative paths only.
+
+    Setting the cancel event stops the run from starting new transfers. Returns False if the run failed.
+    """
     try:
-        logging.info("Starting backup...")
+        job = f" job {config['name']}" if config.get('name') else ""
+        logging.info(f"Starting backup{job}..." if paths is None else f"Starting backup{job} of {len(paths)} changed paths...")
         local_sync = config.get('local_sync', False)
         sftp_sync = config.get('sftp_sync', False)
 
-        source_folder = config.get('source_folder')
         remote_directory = config.get('remote_backup_directory')
         remote_host = config.get('remote_host')
         remote_port = config.get('remote_port')
         remote_username = config.get('remote_username')
         remote_password = config.get('remote_password')
+        remote_parallelism = config.get('remote_parallelism', 1)
         destination_folder = config.get('local_backup_folder')
+        compression = config.get('compression')
+        if compression:
+            compression = available_codec(compression)
+        encryption = None
+        if config.get('encryption'):
+            encryption = Encryption(config['encryption'], derive_payload_key(load_key()))
+
+        change_detection = config.get('change_detection', 'mtime')
+        snapshot_retention = config.get('snapshot_retention', DEFAULT_RETENTION) if config.get('snapshots', False) else None
+        if snapshot_retention is not None and 'chunks' in (config.get('remote_backup_format'), config.get('local_backup_format')):
+            logging.info("Snapshots are kept for mirrored backups only; chunk stores keep the latest version of each file.")
+        path_filter = PathFilter(config.get('include'), config.get('exclude'))
+        scan_workers = config.get('scan_workers', SCAN_WORKERS)
+        pack_threshold = None
+        if config.get('sftp_pack_small_files', False):
+            pack_threshold = config.get('pack_max_file_kb', DEFAULT_PACK_THRESHOLD // 1024) * 1024
+        bundle_size = config.get('pack_bundle_mb', DEFAULT_BUNDLE_SIZE // (1024 * 1024)) * 1024 * 1024
+        mirror = config.get('mirror_deletions', False)
+        verify = config.get('verify_uploads', False)
+        max_delete_percent = config.get('mirror_max_delete_percent', DEFAULT_MAX_DELETE_PERCENT)
+        if mirror and 'chunks' in (config.get('remote_backup_format'), config.get('local_backup_format')):
+            logging.info("Deletions are mirrored for mirrored backups only; chunk stores keep every file they stored.")
+        # The deadline is fixed when the run starts, and shared by every source and target
+        policy = create_policy(config, cancel=cancel)
+        # One limiter covers every stream; local copies share it only when asked to
+        throttle = create_limiter(config)
+        local_throttle = throttle if config.get('bandwidth_limit_local', False) else None
 
-        # Perform sync operations
-        if sftp_sync:
-            sftp_sync_directories(source_folder, remote_directory, remote_host, remote_port, remote_username, remote_password)
+        # Perform sync operations; with both targets enabled, they share one walk of each source
+        for source_folder, subdir in job_sources(config):
+            if policy.expired():
+                logging.info(f"Run stopped ({policy.stop_reason}); {source_folder} is left for the next run.")
+                continue
+            targets = []
+            if sftp_sync:
+                remote_dir = posixpath.join(remote_directory, subdir) if subdir else remote_directory
+                if config.get('remote_backup_format') == 'chunks':
+                    targets.append(partial(sftp_chunk_sync, source_folder, remote_dir, remote_host, remote_port, remote_username,
+                                           remote_password, throttle=throttle, policy=policy, paths=paths))
+                else:
+                    targets.append(partial(sftp_sync_directories, source_folder, remote_dir, remote_host, remote_port,
+                                           remote_username, remote_password,
+                                           parallelism=remote_parallelism, delta=config.get('sftp_delta', False),
+                                           compression=compression, encryption=encryption,
+                                           change_detection=change_detection, throttle=throttle,
+                                           snapshot_retention=snapshot_retention, mirror=mirror,
+                                           max_delete_percent=max_delete_percent, pack_threshold=pack_threshold,
+                                           bundle_size=bundle_size, verify=verify, policy=policy, paths=paths))
 
-        if local_sync:
-            local_sync_directories(source_folder, destination_folder)
-        logging.info("Backup completed successfully.")
+            if local_sync:
+                local_dir = os.path.join(destination_folder, subdir) if subdir else destination_folder
+                if config.get('local_backup_format') == 'chunks':
+                    targets.append(partial(local_chunk_sync, source_folder, local_dir, throttle=local_throttle, policy=policy,
+                                           paths=paths))
+                else:
+                    targets.append(partial(local_sync_directories, source_folder, local_dir,
+                                           parallelism=config.get('local_parallelism', 1),
+                                           compression=compression, encryption=encryption,
+                                           change_detection=change_detection, throttle=local_throttle,
+                                           snapshot_retention=snapshot_retention, mirror=mirror,
+                                           max_delete_percent=max_delete_percent, verify=verify,
+                                           audit=bool(config.get('audit_fraction')), policy=policy, paths=paths,
+                                           mtime_tolerance=config.get('local_mtime_tolerance')))
+            if targets:
+                run_targets(targets, iter_source_files(source_folder, paths, path_filter, scan_workers))
+        logging.info(f"Backup{job} completed successfully.")
+        return True
     except Exception as e:
-        logging.error(f"An error occurred during the backup: {e}")
+        logging.error(f"An error occurred during the backup{job}: {e}")
+        return False
 
-def schedule_backup(config):
-    """Schedule the backup outside of business hours."""
+def run_changed_backup(config, watcher, cancel=None):
+    """Back up only the paths the watcher saw change, or everything if it lost track."""
+    paths, overflowed = watcher.collect()
+    if overflowed:
+        return run_backup(config, cancel=cancel)
+    if paths:
+        return run_backup(config, paths=paths, cancel=cancel)
+    return True
+
+def schedule_backup(config, runner=None):
+    """Schedule every backup job outside of business hours; jobs run concurrently."""
+    runner = runner or JobRunner()
+    try:
+        jobs = job_configs(config)
+    except ValueError as e:
+        logging.error(f"Invalid job configuration: {e}. Please reconfigure.")
+        return False
+    return all(schedule_job(name, job_config, runner) for name, job_config in jobs)
+
+def schedule_job(name, config, runner):
+    """Schedule one job, tagged with its name; each run is started through the runner."""
     interval = config.get("schedule_interval", "daily")
     custom_minutes = config.get("custom_interval_minutes", None)
+    label = "Backup" if name == DEFAULT_JOB else f"Backup job {name}"
 
     if interval == "daily":
-        schedule.every().day.at("19:00").do(run_backup, config)  # 7 PM
-        logging.info("Backup scheduled daily at 7 PM.")
+        schedule.every().day.at("19:00").do(runner.start, name, run_backup, config).tag(name)  # 7 PM
+        logging.info(f"{label} scheduled daily at 7 PM.")
     elif interval == "weekly":
-        schedule.every().week.at("19:00").do(run_backup, config)  # 7 PM
-        logging.info("Backup scheduled weekly at 7 PM.")
+        schedule.every().week.at("19:00").do(runner.start, name, run_backup, config).tag(name)  # 7 PM
+        logging.info(f"{label} scheduled weekly at 7 PM.")
     elif interval == "custom" and custom_minutes:
-        schedule.every(custom_minutes).minutes.do(run_backup, config)
-        logging.info(f"Backup scheduled every {custom_minutes} minutes.")
+        schedule.every(custom_minutes).minutes.do(runner.start, name, run_backup, config).tag(name)
+        logging.info(f"{label} scheduled every {custom_minutes} minutes.")
+    elif interval == "watch":
+        sources = job_sources(config)
+        if len(sources) > 1:
+            logging.error(f"Watch mode needs a single source folder ({label}). Please reconfigure.")
+            return False
+        watcher = create_watcher(sources[0][0])
+        if watcher is None:
+            logging.error("Watch mode is not supported on this platform. Please reconfigure.")
+            return False
+        watcher.start()
+        watch_minutes = config.get("watch_interval_minutes", 5)
+        schedule.every(watch_minutes).minutes.do(runner.start, name, run_changed_backup, config, watcher).tag(name)
+        # Full reconciliation scan still runs on the normal schedule
+        schedule.every().day.at("19:00").do(runner.start, name, run_backup, config).tag(name)  # 7 PM
+        logging.info(f"{label}: changed files backed up every {watch_minutes} minutes; full backup daily at 7 PM.")
     else:
-        logging.error("Invalid scheduling configuration. Please reconfigure.")
+        logging.error(f"Invalid scheduling configuration ({label}). Please reconfigure.")
         return False
-    return True
 
-def graceful_exit(signum, frame):
-    logging.info("Scheduler is shutting down.")
-    print("Scheduler is shutting down.")
-    exit(0)
-
-signal.signal(signal.SIGINT, graceful_exit)
-signal.signal(signal.SIGTERM, graceful_exit)
+    # The audit runs as the job, so it never overlaps the job's own backups
+    if config.get("audit_fraction"):
+        audit_time = config.get("audit_time", DEFAULT_AUDIT_TIME)
+        schedule.every().day.at(audit_time).do(runner.start, name, run_audit, config).tag(name)
+        logging.info(f"{label}: {config['audit_fraction']:.2%} of the backup audited daily at {audit_time}.")
+    return True
 
 def run_in_background():
-    """Restart the program in the background."""
-    if not hasattr(sys, 'frozen'):  # Skip if already running as an .exe
+    """Restart the program in the background, as the headless scheduler."""
+    if not hasattr(sys, 'frozen') or sys.platform != 'win32':  # Only the Windows .exe detaches
         return
-    subprocess.Popen([sys.executable], creationflags=subprocess.DETACHED_PROCESS)
+    # The new process starts straight into the scheduler instead of restarting itself again
+    subprocess.Popen([sys.executable, *sys.argv[1:], '--headless'], creationflags=subprocess.DETACHED_PROCESS)
     sys.exit()
 
+def setup_config():
+    """Ask for the configuration: in the setup window where tkinter and pywin32 are installed, else at the console."""
+    try:
+        from setup import prompt_user_for_config_gui
+    except ImportError:
+        save_config(prompt_user_for_config(), load_key())
+        return
+    prompt_user_for_config_gui()
+
 def main():
-        # Check if configuration exists
+    """Set up the configuration if there is none, then run the scheduler in the background."""
+    headless = '--headless' in sys.argv[1:]
     if not os.path.exists(CONFIG_FILE):
+        if headless:
+            logging.error("Configuration file not found. Run RemoteBackup without --headless to set it up.")
+            return
         print("Configuration file not found. Launching setup...")
-        prompt_user_for_config_gui()  # Launch setup GUI for configuration
-        #return
+        setup_config()
+    if not headless:
+        run_in_background()
+    run_scheduler(verify='--verify' in sys.argv[1:])
 
-    # Run in the background
-    run_in_background()
+def run_scheduler(verify=False):
+    """Load the configuration and run its jobs until stopped: the headless entry point.
 
-    # Load configuration and start the scheduler
+    Only the modules the configured targets use are loaded; SFTP support, for
+    example, is imported by the first SFTP run.
+    """
     key = load_key()
     config = load_config(key)
     if not config:
@@ -334,20 +1118,47 @@ def main():
         return
 
     # Validate configuration
-    required_fields = get_required_fields(config.get('local_sync', False), config.get('sftp_sync', False))
-    if not validate_config(config, required_fields):
+    try:
+        jobs = job_configs(config)
+    except ValueError as e:
+        print(f"Error: {e}")
         print("Please reconfigure the application.")
         return
+    for name, job_config in jobs:
+        required_fields = get_required_fields(job_config.get('local_sync', False), job_config.get('sftp_sync', False))
+        if job_config.get('source_folders'):
+            required_fields.pop('source_folder', None)
+        if not validate_config(job_config, required_fields):
+            print("Please reconfigure the application.")
+            return
+
+    # Rebuild the manifest from the remote listing when asked to
+    if verify:
+        for name, job_config in jobs:
+            if job_config.get('sftp_sync', False):
+                verify_manifest(job_config)
+
+    # Concurrent jobs share one cap on transfers in progress
+    set_transfer_limit(config.get('max_concurrent_transfers'))
+
+    # Per-file lines are logged at DEBUG
+    logging.getLogger().setLevel(config.get('log_level', 'INFO').upper())
+
+    # Expose run metrics for Prometheus when a port is configured
+    if config.get('metrics_port'):
+        from metrics_server import start_metrics_server
+        try:
+            start_metrics_server(config['metrics_port'])
+        except OSError as e:
+            logging.error(f"Failed to start metrics server: {e}")
 
-    # Schedule the backup
-    if not schedule_backup(config):
+    # Jobs run as tasks on an event loop; the control socket can start, cancel and inspect them
+    daemon = BackupDaemon(jobs, run_backup, control_port(config), config.get('shutdown_grace_seconds', DEFAULT_SHUTDOWN_GRACE))
+    if not schedule_backup(config, daemon):
         return
 
-    # Run the scheduler in the background
-    print("Scheduler is running in the background. Press Ctrl+C to exit.")
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    print("Scheduler is running in the background. Press Ctrl+C to stop after the transfers in progress.")
+    daemon.run()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,242 @@
+import logging
+import math
+import os
+import posixpath
+import random
+import time
+from integrity import WHOLE_FILE, IntegrityError, RemoteHasher, parse_digest, read_digests, verify_file
+from jobs import job_sources
+from manifest import MANIFEST_FILE, Manifest, sftp_target
+from metrics import RunMetrics
+from payload import STORED_SUFFIXES, original_name, stored_base
+from resumable import PARTIAL_SUFFIX
+from remote_tree import normalize as normalize_remote_path
+from scheduling import TransferPolicy
+from snapshots import SNAPSHOTS_DIR, VERSIONS_DIR
+from workers import WorkerPool
+
+DEFAULT_AUDIT_TIME = '03:00'
+DEFAULT_AUDIT_MINUTES = 60
+
+def sample_size(total, fraction):
+    """Number of files to audit out of total: at least one while there are any."""
+    return min(total, max(1, math.ceil(total * fraction))) if total and fraction > 0 else 0
+
+def expected_digests(source_file, entry, stored_suffix, kinds):
+    """What a sampled copy should hash to, as {kind: hex digest}, or None if nothing says.
+
+    A digest recorded when the copy was verified is used first. Without one, a copy stored
+    as-is should match its source, as long as the source is still the version that was backed up.
+    """
+    _, size, mtime, stored_digest = entry
+    if stored_digest:
+        return parse_digest(stored_digest)
+    if stored_suffix != '':
+        return None
+    try:
+        source_stat = os.stat(source_file)
+        if (source_stat.st_size, source_stat.st_mtime) != (size, mtime):
+            return None
+        with open(source_file, 'rb') as source:
+            return read_digests(source, kinds)
+    except OSError:
+        return None
+
+def sample_folder(dest_dir, fraction):
+    """Return (path, size, mtime, None) for a random fraction of the copies in a local backup folder.
+
+    For backups made without a manifest. Each copy's own size and time stand in for the
+    recorded ones, so a plain copy is compared with its source while the two still agree.
+    """
+    entries = []
+    fallback = None
+    seen = 0
+    for root, dirs, files in os.walk(dest_dir):
+        if root == dest_dir:
+            dirs[:] = [name for name in dirs if name not in (SNAPSHOTS_DIR, VERSIONS_DIR)]
+        relative_root = os.path.relpath(root, dest_dir).replace(os.sep, '/')
+        for name in files:
+            if name.endswith(PARTIAL_SUFFIX):
+                continue
+            seen += 1
+            relative_path = original_name(name) if relative_root == '.' else f"{relative_root}/{original_name(name)}"
+            chosen = random.random() < fraction
+            # A reservoir of one, so a folder too small for the fraction still gets one check
+            if not chosen and random.randrange(seen) != 0:
+                continue
+            copy_stat = os.stat(os.path.join(root, name))
+            entry = (relative_path, copy_stat.st_size, copy_stat.st_mtime, None)
+            if chosen:
+                entries.append(entry)
+            else:
+                fallback = entry
+    return entries or ([fallback] if fallback else [])
+
+def audit_target(title, metrics, entries, parallelism, open_session, check, policy):
+    """Check sampled entries on a worker pool, stopping when the policy expires.
+
+    check(session, entry) returns 'verified', 'mismatched' or 'unverifiable'. Returns the run summary.
+    """
+    if not entries:
+        logging.warning(f"{title}: found no copies to check; nothing was audited.")
+        return metrics.finish()
+    logging.info(f"{title}: checking {len(entries)} copies picked at random.")
+
+    def task(entry):
+        def run(session):
+            started = time.monotonic()
+            try:
+                metrics.count(check(session, entry), entry[1])
+            except Exception as e:
+                logging.error(f"{title}: failed to check {entry[0]}: {e}")
+                metrics.count("failed", entry[1])
+            finally:
+                metrics.add_phase("verify", time.monotonic() - started)
+        return run
+
+    workers = WorkerPool(parallelism, open_session, 'audit', policy=policy)
+    try:
+        for entry in entries:
+            if policy.expired():
+                break
+            workers.submit(task(entry), entry[0], entry[1])
+    finally:
+        workers.join()
+    summary = metrics.finish()
+    files = summary['files']
+    left = len(entries) - sum(files.get(result, 0) for result in ('verified', 'mismatched', 'unverifiable', 'failed'))
+    stopped = f", {left} left unchecked ({policy.stop_reason})" if left else ""
+    logging.info(f"{title}: {files.get('verified', 0)} copies verified, {files.get('mismatched', 0)} did not match, "
+                 f"{files.get('unverifiable', 0)} had nothing to check against, {files.get('failed', 0)} failed{stopped}.")
+    if not files.get('verified') and not files.get('mismatched'):
+        logging.warning(f"{title}: none of the sampled copies could be checked.")
+    return summary
+
+def audit_sftp(source_dir, remote_dir, host, port, username, password, fraction, parallelism=1, policy=None,
+               manifest_file=MANIFEST_FILE):
+    """Check a sample of the files uploaded to an SFTP target against their digests.
+
+    A copy that differs is forgotten by the manifest and given a modification time
+    of zero, so the next backup sends it again; it is not deleted, so a restore
+    still has it until then.
+    """
+    # paramiko takes longer to import than the rest of the program, so only SFTP runs load it
+    from sftp_pool import SFTPSessionPool
+    metrics = RunMetrics('sftp-audit')
+    pool = SFTPSessionPool(host, port, username, password, metrics)
+    remote_dir = normalize_remote_path(remote_dir)
+    target = sftp_target(host, port, username, remote_dir)
+    hasher = RemoteHasher()
+
+    def check(sftp, entry):
+        relative_path = entry[0]
+        stored_file = posixpath.join(remote_dir, stored_base(relative_path))
+        stored = []
+        for suffix in STORED_SUFFIXES:
+            try:
+                stored.append((sftp.stat(stored_file + suffix).st_mtime or 0, suffix))
+            except IOError:
+                pass
+        if not stored:
+            logging.error(f"SFTP audit: {stored_file} is recorded but missing; it will be uploaded again.")
+            manifest.remove(target, relative_path)
+            return 'mismatched'
+        suffix = max(stored)[1]
+        source_file = os.path.join(source_dir, *relative_path.split('/'))
+        expected = expected_digests(source_file, entry, suffix, hasher.kinds)
+        if expected is None:
+            return 'unverifiable'
+        try:
+            hasher.verify(sftp, stored_file + suffix, expected)
+        except IntegrityError as e:
+            logging.error(f"SFTP audit: {e}; it will be uploaded again.")
+            manifest.remove(target, relative_path)
+            sftp.utime(stored_file + suffix, (0, 0))
+            return 'mismatched'
+        return 'verified'
+
+    try:
+        with Manifest(manifest_file) as manifest:
+            entries = manifest.sample(target, sample_size(manifest.count(target), fraction))
+            return audit_target("SFTP audit", metrics, entries, parallelism, pool.open_session, check, policy or TransferPolicy())
+    finally:
+        pool.close()
+
+def audit_local(source_dir, dest_dir, fraction, parallelism=1, policy=None, manifest_file=MANIFEST_FILE):
+    """Check a sample of the files copied to a local target against their digests, like audit_sftp.
+
+    The sample comes from the manifest, or from the backup folder itself if nothing is recorded for it.
+    """
+    metrics = RunMetrics('local-audit')
+    target = f"local:{os.path.abspath(dest_dir)}"
+
+    def check(_, entry):
+        relative_path = entry[0]
+        dest_file = os.path.join(dest_dir, *stored_base(relative_path).split('/'))
+        stored = [(os.path.getmtime(dest_file + suffix), suffix) for suffix in STORED_SUFFIXES
+                  if os.path.exists(dest_file + suffix)]
+        if not stored:
+            logging.error(f"Local audit: {dest_file} is recorded but missing; it will be copied again.")
+            manifest.remove(target, relative_path)
+            return 'mismatched'
+        suffix = max(stored)[1]
+        source_file = os.path.join(source_dir, *relative_path.split('/'))
+        expected = expected_digests(source_file, entry, suffix, (WHOLE_FILE,))
+        if expected is None:
+            return 'unverifiable'
+        try:
+            verify_file(dest_file + suffix, expected)
+        except IntegrityError as e:
+            logging.error(f"Local audit: {e}; it will be copied again.")
+            manifest.remove(target, relative_path)
+            # Copies are compared by time, so this makes the next backup replace it even without a manifest
+            os.utime(dest_file + suffix, (0, 0))
+            return 'mismatched'
+        return 'verified'
+
+    with Manifest(manifest_file) as manifest:
+        total = manifest.count(target)
+        entries = manifest.sample(target, sample_size(total, fraction)) if total else sample_folder(dest_dir, fraction)
+        return audit_target("Local audit", metrics, entries, parallelism, None, check, policy or TransferPolicy())
+
+def run_audit(config, cancel=None, manifest_file=MANIFEST_FILE):
+    """Check a random audit_fraction of each target's copies, within audit_minutes.
+
+    Setting the cancel event stops it from starting more checks. Returns False if
+    it failed, found copies that did not match, or could check none at all.
+    """
+    job = f" of job {config['name']}" if config.get('name') else ""
+    fraction = config.get('audit_fraction', 0)
+    logging.info(f"Starting audit{job} of {fraction:.2%} of the backup...")
+    deadline = time.time() + config.get('audit_minutes', DEFAULT_AUDIT_MINUTES) * 60
+    policy = TransferPolicy(deadline=deadline, cancel=cancel)
+    summaries = []
+    try:
+        for source_folder, subdir in job_sources(config):
+            if config.get('sftp_sync', False):
+                remote_dir = config.get('remote_backup_directory')
+                remote_dir = posixpath.join(remote_dir, subdir) if subdir else remote_dir
+                if config.get('remote_backup_format') == 'chunks':
+                    logging.info("Chunk stores are not audited; each chunk is checked against its hash when it is restored.")
+                else:
+                    summaries.append(audit_sftp(source_folder, remote_dir, config.get('remote_host'), config.get('remote_port'),
+                                                config.get('remote_username'), config.get('remote_password'), fraction,
+                                                config.get('remote_parallelism', 1), policy, manifest_file))
+            if config.get('local_sync', False):
+                local_dir = config.get('local_backup_folder')
+                local_dir = os.path.join(local_dir, subdir) if subdir else local_dir
+                if config.get('local_backup_format') == 'chunks':
+                    logging.info("Chunk stores are not audited; each chunk is checked against its hash when it is restored.")
+                else:
+                    summaries.append(audit_local(source_folder, local_dir, fraction, config.get('local_parallelism', 1),
+                                                 policy, manifest_file))
+    except Exception as e:
+        logging.error(f"An error occurred during the audit{job}: {e}")
+        return False
+    mismatched = sum(summary['files'].get('mismatched', 0) for summary in summaries)
+    verified = sum(summary['files'].get('verified', 0) for summary in summaries)
+    if not mismatched and not verified:
+        logging.warning(f"Audit{job} checked no copies; the backup was not audited.")
+        return False
+    logging.info(f"Audit{job} completed: {mismatched} copies did not match." if mismatched else f"Audit{job} completed.")
+    return not mismatched
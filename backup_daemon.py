@@ -0,0 +1,280 @@
+"""Run scheduled backup jobs on an event loop, and control a running scheduler.
+
+Usage: python backup_daemon.py status
+       python backup_daemon.py run [JOB]
+       python backup_daemon.py cancel [JOB]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import secrets
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+import schedule
+from utils import load_config, load_key
+
+CONTROL_HOST = '127.0.0.1'
+DEFAULT_CONTROL_PORT = 8767
+MAX_IDLE_SECONDS = 60  # wake at least this often, so clock changes are noticed
+DEFAULT_SHUTDOWN_GRACE = 300
+CONTROL_TIMEOUT = 10
+# Next to config.json; only its owner can read it, so only they can control the scheduler
+CONTROL_TOKEN_FILE = 'control.token'
+
+class JobState:
+    """A job's current run, if any, and how its last run ended."""
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.task = None
+        self.cancel = None
+        self.started = None
+        self.last_started = None
+        self.last_finished = None
+        self.last_result = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def status(self):
+        next_runs = [job.next_run for job in schedule.get_jobs(self.name) if job.next_run]
+        return {
+            'job': self.name,
+            'running': self.running,
+            'started': _timestamp(self.started if self.running else None),
+            'last_started': _timestamp(self.last_started),
+            'last_finished': _timestamp(self.last_finished),
+            'last_result': self.last_result,
+            'next_run': min(next_runs).isoformat(timespec='seconds') if next_runs else None,
+        }
+
+def _timestamp(value):
+    return datetime.fromtimestamp(value).isoformat(timespec='seconds') if value else None
+
+class BackupDaemon:
+    """Run backup jobs as asyncio tasks, their blocking work on a thread pool.
+
+    It is the runner jobs are scheduled with: schedule calls start(), which skips
+    a job whose previous run is still going, so schedules may overlap freely.
+    Each run gets a threading.Event as its cancel argument; setting it makes the
+    run stop starting transfers and finish the ones in flight, as at a deadline.
+    A local control socket answers status, run and cancel requests (port 0 picks
+    a free port; None turns it off) that carry the token written to token_file
+    while it listens, and SIGTERM or Ctrl+C cancels every run and
+    waits up to shutdown_grace seconds for them.
+    """
+
+    def __init__(self, jobs, run_job, control_port=DEFAULT_CONTROL_PORT, shutdown_grace=DEFAULT_SHUTDOWN_GRACE,
+                 token_file=CONTROL_TOKEN_FILE):
+        self.jobs = {name: JobState(name, config) for name, config in jobs}
+        self.run_job = run_job
+        self.control_port = control_port
+        self.token_file = token_file
+        self.token = None
+        self.shutdown_grace = shutdown_grace
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(self.jobs)), thread_name_prefix='job')
+        self.loop = None
+        self.stopping = None
+        self.signals = 0
+
+    def start(self, name, function, *args):
+        """Start a run of a job unless one is already going. Returns False if it was skipped."""
+        state = self.jobs[name]
+        if state.running:
+            logging.info(f"Job {name} is still running; skipping this run.")
+            return False
+        if self.stopping is not None and self.stopping.is_set():
+            return False
+        state.cancel = threading.Event()
+        state.started = state.last_started = time.time()
+        work = partial(function, *args, cancel=state.cancel)
+        state.task = self.loop.create_task(self._run(state, work))
+        return True
+
+    async def _run(self, state, work):
+        try:
+            succeeded = await self.loop.run_in_executor(self.executor, work)
+            state.last_result = 'cancelled' if state.cancel.is_set() else 'succeeded' if succeeded is not False else 'failed'
+        except Exception as e:
+            logging.error(f"Job {state.name} failed: {e}")
+            state.last_result = 'failed'
+        finally:
+            state.last_finished = time.time()
+
+    def trigger(self, name):
+        """Run a job now, outside its schedule."""
+        return self.start(name, self.run_job, self.jobs[name].config)
+
+    def cancel(self, name):
+        """Ask a running job to stop; True if one was running."""
+        state = self.jobs[name]
+        if not state.running:
+            return False
+        logging.info(f"Cancelling job {name}; transfers in progress will finish.")
+        state.cancel.set()
+        return True
+
+    def status(self):
+        return [state.status() for state in self.jobs.values()]
+
+    async def _run_schedules(self):
+        while not self.stopping.is_set():
+            schedule.run_pending()
+            # Sleep until the next run is due instead of polling every second
+            idle = schedule.idle_seconds()
+            timeout = MAX_IDLE_SECONDS if idle is None else min(max(idle, 0), MAX_IDLE_SECONDS)
+            try:
+                await asyncio.wait_for(self.stopping.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _handle(self, reader, writer):
+        try:
+            request = json.loads(await asyncio.wait_for(reader.readline(), CONTROL_TIMEOUT))
+            token = request.get('token')
+            if not isinstance(token, str) or not secrets.compare_digest(token.encode(), self.token.encode()):
+                logging.error("Refused a control request without the right token.")
+                response = {'ok': False, 'error': "Not authorized"}
+            else:
+                response = self.handle_request(request)
+        except Exception as e:
+            response = {'ok': False, 'error': str(e)}
+        writer.write(json.dumps(response).encode() + b'\n')
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def handle_request(self, request):
+        command = request.get('command')
+        if command == 'status':
+            return {'ok': True, 'jobs': self.status()}
+        if command not in ('run', 'cancel'):
+            return {'ok': False, 'error': f"Unknown command {command}"}
+        name = request.get('job')
+        if name is None and len(self.jobs) == 1:
+            name = next(iter(self.jobs))
+        if name not in self.jobs:
+            return {'ok': False, 'error': f"Choose a job: {', '.join(self.jobs)}"}
+        done = self.trigger(name) if command == 'run' else self.cancel(name)
+        return {'ok': True, 'job': name, 'done': done}
+
+    def _signal(self, signum, frame):
+        self.signals += 1
+        if self.signals > 1:
+            logging.info("Second stop signal; exiting without waiting for transfers.")
+            logging.shutdown()
+            os._exit(1)
+        self.stop()
+
+    def stop(self):
+        """Stop scheduling runs and drain the running ones; safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self.stopping.set)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        server = None
+        if self.control_port is not None:
+            try:
+                self.token = write_control_token(self.token_file)
+                server = await asyncio.start_server(self._handle, CONTROL_HOST, self.control_port)
+                self.control_port = server.sockets[0].getsockname()[1]
+                logging.info(f"Control socket listening on {CONTROL_HOST}:{self.control_port}.")
+            except OSError as e:
+                logging.error(f"Failed to open control socket: {e}")
+        await self._run_schedules()
+
+        logging.info("Scheduler is shutting down; waiting for running jobs to finish their transfers.")
+        if server:
+            server.close()
+            _remove(self.token_file)
+        tasks = [state.task for state in self.jobs.values() if state.running]
+        for state in self.jobs.values():
+            if state.running:
+                state.cancel.set()
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=self.shutdown_grace)
+            if pending:
+                logging.error(f"{len(pending)} jobs still running after {self.shutdown_grace} s; exiting anyway. "
+                              f"Interrupted uploads resume on the next run.")
+                return False
+        return True
+
+    def run(self):
+        """Serve until SIGTERM or Ctrl+C, then drain. Returns once every run has stopped."""
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self._signal)
+        drained = asyncio.run(self.serve())
+        logging.info("Scheduler stopped.")
+        if not drained:
+            # The pool's threads are still transferring and would otherwise hold the process open
+            logging.shutdown()
+            os._exit(1)
+        self.executor.shutdown()
+
+def write_control_token(token_file):
+    """Write a new random token to a file only the current user can read, and return it."""
+    token = secrets.token_hex(32)
+    # Replaced rather than rewritten, so an old file's permissions are not kept
+    _remove(token_file)
+    with os.fdopen(os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as file:
+        file.write(token)
+    return token
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def send_command(command, job=None, port=DEFAULT_CONTROL_PORT, token_file=CONTROL_TOKEN_FILE):
+    """Send one request to a running scheduler, with the token it wrote, and return its response."""
+    with open(token_file) as file:
+        token = file.read().strip()
+    with socket.create_connection((CONTROL_HOST, port), timeout=CONTROL_TIMEOUT) as connection:
+        connection.sendall(json.dumps({'command': command, 'job': job, 'token': token}).encode() + b'\n')
+        with connection.makefile('rb') as responses:
+            return json.loads(responses.readline())
+
+def control_port(config):
+    return config.get('control_port', DEFAULT_CONTROL_PORT)
+
+def main():
+    parser = argparse.ArgumentParser(description="Control a running RemoteBackup scheduler")
+    parser.add_argument('command', choices=('status', 'run', 'cancel'))
+    parser.add_argument('job', nargs='?', help="backup job (needed when the configuration has several)")
+    parser.add_argument('--port', type=int, help="control port (default: control_port from the configuration)")
+    args = parser.parse_args()
+    port = args.port
+    if port is None:
+        port = control_port(load_config(load_key()) or {})
+    try:
+        response = send_command(args.command, args.job, port)
+    except OSError as e:
+        print(f"Scheduler is not reachable on port {port}: {e}")
+        return 1
+    if not response.get('ok'):
+        print(f"Error: {response.get('error')}")
+        return 1
+    if args.command == 'status':
+        for job in response['jobs']:
+            state = f"running since {job['started']}" if job['running'] else f"idle, last {job['last_result'] or 'never run'}"
+            print(f"{job['job']}: {state}; next run {job['next_run'] or 'not scheduled'}")
+    elif args.command == 'run':
+        print(f"Started {response['job']}." if response['done'] else f"{response['job']} is already running.")
+    else:
+        print(f"Cancelling {response['job']}." if response['done'] else f"{response['job']} is not running.")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,368 @@
+"""Benchmarks for RemoteBackup.
+
+Usage: python benchmark.py <name> [options]
+"""
+import argparse
+import concurrent.futures
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from compression import available_codec
+from delta import BLOCK_SIZE, patch_remote, signature_matcher, upload_with_signature
+from loopback_sftp import LoopbackSFTPServer
+from metrics import peak_rss
+from payload import Encryption, write_payload
+from stream_crypto import CIPHERS, encrypt_chunks
+
+RESULTS_FILE = 'benchmark_results.jsonl'
+SYNC_SCENARIOS = ('initial', 'unchanged', 'modified')
+MODIFIED_FRACTION = 0.1
+WRITE_SIZE = 1024 * 1024
+# Modules the scheduler should not need to load just to start
+HEAVY_MODULES = ('paramiko', 'tkinter', 'win32com', 'psutil', 'setup', 'http.server')
+
+def bench_delta(args):
+    """Report bytes sent by a delta upload against the size of the changed file."""
+    size = args.size_mb * 1024 * 1024
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'data.bin')
+        with open(path, 'wb') as data_file:
+            data_file.write(rng.randbytes(size))
+
+        remote = io.BytesIO()
+        with open(path, 'rb') as source:
+            signature, full_bytes = upload_with_signature(source, remote)
+
+        # Overwrite a few scattered regions, as a mailbox or disk image would change
+        with open(path, 'r+b') as data_file:
+            for _ in range(args.changes):
+                data_file.seek(rng.randrange(size - args.change_bytes))
+                data_file.write(rng.randbytes(args.change_bytes))
+
+        start = time.perf_counter()
+        with open(path, 'rb') as source:
+            signature, delta_bytes = patch_remote(source, remote, signature_matcher(signature), full_bytes)
+        elapsed = time.perf_counter() - start
+
+        with open(path, 'rb') as source:
+            assert remote.getvalue() == source.read(), "patched copy differs from source"
+
+    print(f"file size:      {size} bytes")
+    print(f"changes:        {args.changes} x {args.change_bytes} bytes (block size {BLOCK_SIZE})")
+    print(f"bytes sent:     {delta_bytes} ({delta_bytes / size:.2%} of file)")
+    print(f"delta time:     {elapsed:.2f} s ({size / elapsed / 1e6:.1f} MB/s scanned)")
+
+def bench_encryption(args):
+    """Report file-to-file backup throughput with and without encryption, and each cipher's own speed."""
+    rng = random.Random(args.seed)
+    key = os.urandom(32)
+    size = args.size_mb * 1024 * 1024
+    codec = available_codec(args.codec)
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, 'data.bin')
+        with open(source, 'wb') as data_file:
+            for _ in range(args.size_mb):
+                # Half random, half repetitive, so compression has work to do
+                data_file.write(rng.randbytes(WRITE_SIZE // 2) + rng.randbytes(64) * (WRITE_SIZE // 128))
+
+        def pipeline(encryption):
+            """Seconds to read, compress, encrypt and write the file, as a local backup does."""
+            start = time.perf_counter()
+            with open(os.path.join(workdir, 'stored'), 'wb') as stored:
+                write_payload(source, stored, codec, encryption)
+            return time.perf_counter() - start
+
+        print(f"data size:      {size} bytes, compressed with {codec}")
+        print(f"{'':<15} {'file to file':>12} {'overhead':>9} {'cipher only':>12}")
+        baseline = pipeline(None)
+        print(f"{'none:':<15} {size / baseline / 1e6:>7.1f} MB/s")
+        with open(source, 'rb') as data_file:
+            chunks = [data_file.read(WRITE_SIZE)] * args.size_mb
+        for cipher in CIPHERS:
+            elapsed = pipeline(Encryption(cipher, key))
+            start = time.perf_counter()
+            for _ in encrypt_chunks(chunks, key, cipher):
+                pass
+            cipher_elapsed = time.perf_counter() - start
+            print(f"{cipher + ':':<15} {size / elapsed / 1e6:>7.1f} MB/s {elapsed / baseline - 1:>+9.0%} "
+                  f"{size / cipher_elapsed / 1e6:>7.1f} MB/s")
+
+def make_small_files(root, rng, scale):
+    """Many tiny files, 100 to a directory."""
+    for index in range(int(5000 * scale)):
+        yield os.path.join(root, f"d{index // 100:03}", f"f{index}.txt"), rng.randrange(4096)
+
+def make_large_files(root, rng, scale):
+    """A few huge files."""
+    for index in range(max(1, int(4 * scale))):
+        yield os.path.join(root, f"large{index}.bin"), 64 * 1024 * 1024
+
+def make_deep_tree(root, rng, scale):
+    """Long chains of nested directories with a couple of files at every level."""
+    for chain in range(max(1, int(50 * scale))):
+        directory = os.path.join(root, f"chain{chain}")
+        for depth in range(20):
+            directory = os.path.join(directory, f"level{depth}")
+            for index in range(2):
+                yield os.path.join(directory, f"f{index}.dat"), rng.randrange(1024, 16384)
+
+TREE_PROFILES = {
+    'small': make_small_files,
+    'large': make_large_files,
+    'deep': make_deep_tree,
+}
+
+def make_tree(root, profile, scale=1.0, seed=1):
+    """Create a synthetic source tree. Returns the paths of the files written."""
+    rng = random.Random(seed)
+    paths = []
+    for path, size in TREE_PROFILES[profile](root, rng, scale):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as data_file:
+            for offset in range(0, size, WRITE_SIZE):
+                data_file.write(rng.randbytes(min(WRITE_SIZE, size - offset)))
+        paths.append(path)
+    return paths
+
+def modify_files(paths, seed=1):
+    """Rewrite the start of a fraction of the files and move their modification times forward."""
+    rng = random.Random(seed)
+    for path in rng.sample(paths, max(1, int(len(paths) * MODIFIED_FRACTION))):
+        with open(path, 'r+b') as data_file:
+            data_file.write(rng.randbytes(64))
+        file_stat = os.stat(path)
+        os.utime(path, (file_stat.st_atime, file_stat.st_mtime + 10))
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def run_sync(target, source_dir, workdir, port, parallelism, pack_kb=0):
+    """Run one sync in this process and return its summary and the process's peak RSS."""
+    os.chdir(workdir)
+    # Imported here so the log file and run summaries land in the scratch directory
+    import RemoteBackup
+    manifest_file = os.path.join(workdir, f"manifest-{target}.db")
+    if target == 'sftp':
+        summary = RemoteBackup.sftp_sync_directories(source_dir, 'backup', '127.0.0.1', port, 'bench', 'bench',
+                                                     parallelism=parallelism, pack_threshold=pack_kb * 1024,
+                                                     manifest_file=manifest_file)
+    else:
+        summary = RemoteBackup.local_sync_directories(source_dir, os.path.join(workdir, 'local'), parallelism,
+                                                      manifest_file=manifest_file)
+    return summary, peak_rss()
+
+def sync_result(args, profile, target, scenario, summary, rss):
+    duration = summary['duration_seconds'] or 1e-9
+    calls = {operation: stats['count'] for operation, stats in summary['remote_calls'].items()}
+    return {
+        'benchmark': 'sync',
+        'version': git_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'profile': profile,
+        'scale': args.scale,
+        'target': target,
+        'latency_ms': args.latency_ms,
+        'parallelism': args.parallelism,
+        'pack_kb': args.pack_kb if target == 'sftp' else 0,
+        'scenario': scenario,
+        'files': summary['files'].get('scanned', 0),
+        'files_copied': summary['files'].get('copied', 0),
+        'files_failed': summary['files'].get('failed', 0),
+        'sent_bytes': summary['sent_bytes'],
+        'seconds': summary['duration_seconds'],
+        'files_per_second': round(summary['files'].get('scanned', 0) / duration, 1),
+        'mb_per_second': round(summary['sent_bytes'] / duration / 1e6, 2),
+        'rpc_calls': sum(calls.values()),
+        'rpc': calls,
+        'peak_rss_mb': round(rss / 1e6, 1) if rss else None,
+    }
+
+SETTING_DEFAULTS = {'pack_kb': 0}
+SYNC_SETTINGS = ('benchmark', 'profile', 'scale', 'target', 'latency_ms', 'parallelism', 'pack_kb', 'scenario')
+
+def previous_result(results_file, result, keys=SYNC_SETTINGS):
+    """The most recent saved result for the same benchmark settings, if any."""
+    previous = None
+    try:
+        with open(results_file) as results:
+            for line in results:
+                saved = json.loads(line)
+                # Results saved before a setting existed were taken with its default
+                if all(saved.get(key, SETTING_DEFAULTS.get(key)) == result[key] for key in keys):
+                    previous = saved
+    except FileNotFoundError:
+        pass
+    return previous
+
+def last_error(workdir):
+    errors = ['no error logged']
+    with open(os.path.join(workdir, 'backup.log')) as log_file:
+        errors += [line.strip() for line in log_file if ' - ERROR - ' in line]
+    return errors[-1]
+
+def change(new, old):
+    if new == old:
+        return "+0%"
+    return f"{(new - old) / old:+.0%}" if old else "n/a"
+
+def bench_sync(args):
+    """Time local and SFTP syncs of synthetic trees and save the results."""
+    targets = ('local', 'sftp') if args.target == 'both' else (args.target,)
+    # Each sync runs in a fresh process so peak RSS belongs to that run alone
+    context = multiprocessing.get_context('spawn')
+    # Clients disconnecting as their process exits are expected here
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    print(f"{'profile':<7} {'target':<6} {'scenario':<10} {'files':>7} {'files/s':>9} {'MB/s':>8} {'RPCs':>7} "
+          f"{'peak RSS':>9}  vs previous")
+    for profile in args.profile:
+        with tempfile.TemporaryDirectory() as workdir:
+            source_dir = os.path.join(workdir, 'source')
+            paths = make_tree(source_dir, profile, args.scale, args.seed)
+            sftp_root = os.path.join(workdir, 'sftp')
+            os.makedirs(sftp_root)
+            with LoopbackSFTPServer(sftp_root, args.latency_ms / 1000) as server:
+                for scenario in SYNC_SCENARIOS:
+                    if scenario == 'modified':
+                        modify_files(paths, args.seed)
+                    for target in targets:
+                        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                            summary, rss = executor.submit(run_sync, target, source_dir, workdir, server.port,
+                                                           args.parallelism, args.pack_kb).result()
+                        if summary is None:
+                            print(f"{profile:<7} {target:<6} {scenario:<10} failed: {last_error(workdir)}")
+                            continue
+                        result = sync_result(args, profile, target, scenario, summary, rss)
+                        previous = previous_result(args.output, result)
+                        comparison = ''
+                        if previous:
+                            comparison = (f"{change(result['files_per_second'], previous['files_per_second'])} files/s, "
+                                          f"{change(result['rpc_calls'], previous['rpc_calls'])} RPCs "
+                                          f"({previous['version']})")
+                        rss_text = f"{result['peak_rss_mb']:.0f} MB" if result['peak_rss_mb'] else 'n/a'
+                        print(f"{profile:<7} {target:<6} {scenario:<10} {result['files']:>7} "
+                              f"{result['files_per_second']:>9.0f} {result['mb_per_second']:>8.1f} "
+                              f"{result['rpc_calls']:>7} {rss_text:>9}  {comparison}")
+                        if args.output:
+                            with open(args.output, 'a') as results:
+                                results.write(json.dumps(result) + '\n')
+
+# Runs in a fresh interpreter, so it sees only what starting the scheduler imports
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import RemoteBackup
+imported = time.perf_counter()
+from backup_daemon import BackupDaemon
+config = json.loads(sys.argv[1])
+daemon = BackupDaemon(RemoteBackup.job_configs(config), RemoteBackup.run_backup, control_port=None)
+RemoteBackup.schedule_backup(config, daemon)
+ready = time.perf_counter()
+print(json.dumps({'import_seconds': imported - started, 'ready_seconds': ready - started,
+                  'modules': [name for name in json.loads(sys.argv[2]) if name in sys.modules]}))
+"""
+
+def startup_config(target, workdir):
+    config = {'source_folder': os.path.join(workdir, 'source'), 'schedule_interval': 'daily'}
+    if target == 'sftp':
+        config.update({'sftp_sync': True, 'remote_host': '127.0.0.1', 'remote_port': 22, 'remote_username': 'bench',
+                       'remote_password': 'bench', 'remote_backup_directory': 'backup'})
+    else:
+        config.update({'local_sync': True, 'local_backup_folder': os.path.join(workdir, 'local')})
+    return config
+
+def bench_startup(args):
+    """Time how long a new process takes to be ready to run scheduled backups, and list the heavy modules it loaded."""
+    targets = ('local', 'sftp') if args.target == 'both' else (args.target,)
+    # Run from the source tree, whatever the current directory
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                                     os.environ.get('PYTHONPATH')])))
+    print(f"{'target':<6} {'process':>9} {'import':>9} {'ready':>9}  heavy modules loaded  vs previous")
+    for target in targets:
+        with tempfile.TemporaryDirectory() as workdir:
+            config = json.dumps(startup_config(target, workdir))
+            runs = []
+            for _ in range(args.runs):
+                started = time.perf_counter()
+                output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, config, json.dumps(HEAVY_MODULES)],
+                                        cwd=workdir, env=env, capture_output=True, text=True, check=True).stdout
+                runs.append(dict(json.loads(output), process_seconds=time.perf_counter() - started))
+        result = {
+            'benchmark': 'startup',
+            'version': git_version(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'target': target,
+            'runs': args.runs,
+            # Medians, so one slow start from a cold disk cache does not skew the result
+            'process_ms': round(statistics.median(run['process_seconds'] for run in runs) * 1000, 1),
+            'import_ms': round(statistics.median(run['import_seconds'] for run in runs) * 1000, 1),
+            'ready_ms': round(statistics.median(run['ready_seconds'] for run in runs) * 1000, 1),
+            'heavy_modules': runs[-1]['modules'],
+        }
+        previous = previous_result(args.output, result, ('benchmark', 'target'))
+        comparison = f"{change(result['process_ms'], previous['process_ms'])} ({previous['version']})" if previous else ''
+        print(f"{target:<6} {result['process_ms']:>7.0f}ms {result['import_ms']:>7.0f}ms {result['ready_ms']:>7.0f}ms  "
+              f"{', '.join(result['heavy_modules']) or 'none':<20}  {comparison}")
+        if args.output:
+            with open(args.output, 'a') as results:
+                results.write(json.dumps(result) + '\n')
+
+BENCHMARKS = {
+    'delta': bench_delta,
+    'encryption': bench_encryption,
+    'startup': bench_startup,
+    'sync': bench_sync,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="RemoteBackup benchmarks")
+    subparsers = parser.add_subparsers(dest='name', required=True)
+
+    delta = subparsers.add_parser('delta', help=bench_delta.__doc__)
+    delta.add_argument('--size-mb', type=int, default=256)
+    delta.add_argument('--changes', type=int, default=20)
+    delta.add_argument('--change-bytes', type=int, default=4096)
+    delta.add_argument('--seed', type=int, default=1)
+
+    encryption = subparsers.add_parser('encryption', help=bench_encryption.__doc__)
+    encryption.add_argument('--size-mb', type=int, default=256)
+    encryption.add_argument('--codec', choices=['gzip', 'zstd', 'lz4'], default='gzip')
+    encryption.add_argument('--seed', type=int, default=1)
+
+    sync = subparsers.add_parser('sync', help=bench_sync.__doc__)
+    sync.add_argument('--profile', nargs='+', choices=sorted(TREE_PROFILES), default=['small', 'large', 'deep'])
+    sync.add_argument('--target', choices=['local', 'sftp', 'both'], default='both')
+    sync.add_argument('--scale', type=float, default=1.0, help="multiplier for the number of files in each tree")
+    sync.add_argument('--latency-ms', type=float, default=0, help="round-trip time added to the SFTP connection")
+    sync.add_argument('--parallelism', type=int, default=4)
+    sync.add_argument('--pack-kb', type=int, default=0, help="pack SFTP files smaller than this into bundles (0: off)")
+    sync.add_argument('--seed', type=int, default=1)
+    sync.add_argument('--output', default=RESULTS_FILE, help="file results are appended to ('' to not save)")
+
+    startup = subparsers.add_parser('startup', help=bench_startup.__doc__)
+    startup.add_argument('--target', choices=['local', 'sftp', 'both'], default='both')
+    startup.add_argument('--runs', type=int, default=5)
+    startup.add_argument('--output', default=RESULTS_FILE, help="file results are appended to ('' to not save)")
+
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args)
+
+if __name__ == "__main__":
+    main()
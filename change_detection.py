@@ -0,0 +1,93 @@
+import hashlib
+import os
+
+HASH_READ_SIZE = 1024 * 1024
+# SFTP (protocol 3) keeps whole seconds and FAT keeps even seconds, so preserved times can round;
+# NTFS and SMB shares keep 100 ns steps, and most other local file systems nanoseconds
+SFTP_MTIME_TOLERANCE = 1.0
+LOCAL_MTIME_TOLERANCE = 1e-6
+FAT_MTIME_TOLERANCE = 2.0
+
+def same_mtime(mtime, stored_mtime, tolerance):
+    """True if a preserved modification time matches the original within the storage's granularity (0: exactly)."""
+    if stored_mtime is None:
+        return False
+    return abs(mtime - stored_mtime) < tolerance if tolerance else mtime == stored_mtime
+
+def filesystem_type(path):
+    """Name of the file system path is on (e.g. 'ext4', 'vfat', 'exFAT'), or None if it can't be told."""
+    path = os.path.realpath(path)
+    if os.name == 'nt':
+        import ctypes
+        name = ctypes.create_unicode_buffer(261)
+        root = os.path.splitdrive(path)[0] + '\\'
+        if ctypes.windll.kernel32.GetVolumeInformationW(root, None, 0, None, None, None, name, len(name)):
+            return name.value
+        return None
+    try:
+        with open('/proc/mounts') as mounts:
+            entries = [line.split()[1:3] for line in mounts]
+    except OSError:
+        return None
+    found = None
+    for mount_point, fstype in entries:
+        mount_point = mount_point.replace('\\040', ' ')
+        # The last of several mounts on the same point is the one in use
+        if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and \
+                (found is None or len(mount_point) >= len(found[0])):
+            found = (mount_point, fstype)
+    return found[1] if found else None
+
+def local_mtime_tolerance(dest_dir):
+    """How far a local copy's preserved time may be from its source's: 2 seconds on FAT or exFAT, otherwise 1 µs."""
+    fstype = (filesystem_type(dest_dir) or '').lower()
+    return FAT_MTIME_TOLERANCE if 'fat' in fstype or fstype == 'msdos' else LOCAL_MTIME_TOLERANCE
+
+def file_digest(path):
+    """BLAKE2b digest of a file's contents, read in constant memory."""
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as data_file:
+        while True:
+            data = data_file.read(HASH_READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+class ChangeDetector:
+    """Decides whether a source file differs from its backed-up copy; shared by the local and SFTP backends.
+
+    Copies keep their source's size and modification time, so comparing the two is
+    enough. With use_hashes, a file whose time moved but whose size did not is also
+    compared by content. Digests are cached in the manifest against the file's
+    (device, inode, size, mtime), so a file is only read again once it really changes.
+    """
+
+    def __init__(self, manifest=None, use_hashes=False, tolerance=SFTP_MTIME_TOLERANCE):
+        self.manifest = manifest
+        self.use_hashes = use_hashes and manifest is not None
+        self.tolerance = tolerance
+
+    def unchanged(self, local_stat, stored_size, stored_mtime):
+        """True if the stored copy has the local file's size and modification time.
+
+        stored_size is None when the copy is compressed or encrypted and its size says nothing.
+        """
+        if stored_size is not None and stored_size != local_stat.st_size:
+            return False
+        return same_mtime(local_stat.st_mtime, stored_mtime, self.tolerance)
+
+    def digest(self, path, file_stat):
+        """Content digest of path, from the cache unless the file changed since it was hashed."""
+        if not file_stat.st_ino:
+            # Directory listings on Windows leave out the file id, which a stat of the file has
+            file_stat = os.stat(path)
+        if not file_stat.st_ino:
+            # No stable file identity to cache against
+            return file_digest(path)
+        cached = self.manifest.get_hash(file_stat)
+        if cached is not None:
+            return cached
+        digest = file_digest(path)
+        self.manifest.put_hash(file_stat, digest)
+        return digest
@@ -0,0 +1,253 @@
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import stat
+from integrity import IntegrityError
+from resumable import finish_partial, partial_name
+
+MIN_CHUNK_SIZE = 256 * 1024
+AVG_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+READ_SIZE = 8 * 1024 * 1024
+
+# Fixed gear table so chunk boundaries stay stable between runs and versions
+GEAR = [int.from_bytes(hashlib.sha256(b'gear%d' % index).digest()[:4], 'big') for index in range(256)]
+
+WINDOW = 32
+# Fingerprints are worked out SCAN_BLOCK bytes at a time with big-integer arithmetic rather than
+# a Python loop per byte. Each byte's gear value goes in its own 64-bit slot (GEAR_LANES holds
+# its four bytes, for bytes.translate), and shifted sums spread it into the next WINDOW - 1
+# slots, doubled once per slot. Slot i then holds sum(GEAR[data[i - k]] << k), which is below
+# 2 ** 64 so never carries into the next slot, and whose low 32 bits are the fingerprint.
+SCAN_BLOCK = 128 * 1024
+GEAR_LANES = [bytes((value >> (8 * lane)) & 0xFF for value in GEAR) for lane in range(4)]
+
+def _mask(bits):
+    # Use the high bits: they mix in the most bytes of history.
+    return ((1 << bits) - 1) << (32 - bits)
+
+def _gear_sums(data, start, end):
+    """Return the gear sums after each byte of data[start:end], as 8-byte little-endian slots."""
+    first = max(0, start - (WINDOW - 1))
+    part = data[first:end]
+    slots = bytearray(len(part) * 8)
+    for lane, table in enumerate(GEAR_LANES):
+        slots[lane::8] = part.translate(table)
+    sums = int.from_bytes(slots, 'little')
+    step = 1
+    while step < WINDOW:
+        sums += sums << (step * 65)
+        step *= 2
+    return memoryview(sums.to_bytes((len(part) + WINDOW) * 8, 'little'))[(start - first) * 8:len(part) * 8]
+
+def find_boundary(data, min_size=MIN_CHUNK_SIZE, avg_size=AVG_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+    """Return the length of the first chunk in data.
+
+    This is FastCDC normalized chunking: the gear fingerprint of the last WINDOW bytes is
+    tested at every byte after min_size, with a stricter mask before the average size and
+    a looser one after it. Cut points depend only on the bytes just before them.
+    """
+    length = len(data)
+    if length <= min_size:
+        return length
+    max_size = min(max_size, length)
+    normal_size = min(avg_size, max_size)
+    bits = avg_size.bit_length() - 1
+    mask_small = _mask(bits + 2)  # harder to match before the average size
+    mask_large = _mask(bits - 2)  # easier to match after it
+    # Only fingerprints whose top byte passes the looser mask need a closer look
+    top_byte = bytes(0 if not value & (mask_large >> 24) else 1 for value in range(256))
+    for start in range(min_size - 1, max_size, SCAN_BLOCK):
+        sums = _gear_sums(data, start, min(start + SCAN_BLOCK, max_size))
+        candidates = sums[3::8].tobytes().translate(top_byte)
+        index = candidates.find(0)
+        while index != -1:
+            end = start + index + 1
+            mask = mask_small if end < normal_size else mask_large
+            if not int.from_bytes(sums[index * 8:index * 8 + 4], 'little') & mask:
+                return end
+            index = candidates.find(0, index + 1)
+    return max_size
+
+def iter_chunks(file_obj, min_size=MIN_CHUNK_SIZE, avg_size=AVG_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+    """Yield the content-defined chunks of a binary file object."""
+    buffer = b''
+    offset = 0
+    eof = False
+    while True:
+        if not eof and len(buffer) - offset < max_size:
+            data = file_obj.read(max(READ_SIZE, max_size))
+            if data:
+                buffer = buffer[offset:] + data
+                offset = 0
+                continue
+            eof = True
+        if offset >= len(buffer):
+            return
+        window = buffer[offset:offset + max_size]
+        cut = find_boundary(window, min_size, avg_size, max_size)
+        yield window[:cut]
+        offset += cut
+
+def chunk_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+class LocalChunkBackend:
+    """Chunk store kept in a local directory; with create=False, as for restores, it is only read."""
+
+    def __init__(self, root, throttle=None, create=True):
+        self.root = root
+        self.throttle = throttle
+        if create:
+            os.makedirs(os.path.join(root, 'chunks'), exist_ok=True)
+            os.makedirs(os.path.join(root, 'files'), exist_ok=True)
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.root, 'chunks', digest[:2], digest)
+
+    def _recipe_path(self, relative_path):
+        return os.path.join(self.root, 'files', *relative_path.split('/')) + '.json'
+
+    def has_chunk(self, digest):
+        return os.path.exists(self._chunk_path(digest))
+
+    def put_chunk(self, digest, data):
+        path = self._chunk_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        if self.throttle:
+            self.throttle.consume(len(data))
+        with open(temp_path, 'wb') as chunk_file:
+            chunk_file.write(data)
+        os.replace(temp_path, path)
+
+    def get_chunk(self, digest):
+        with open(self._chunk_path(digest), 'rb') as chunk_file:
+            return chunk_file.read()
+
+    def get_recipe(self, relative_path):
+        try:
+            with open(self._recipe_path(relative_path), 'r') as recipe_file:
+                return json.load(recipe_file)
+        except (OSError, ValueError):
+            return None
+
+    def put_recipe(self, relative_path, recipe):
+        path = self._recipe_path(relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as recipe_file:
+            json.dump(recipe, recipe_file)
+        os.replace(temp_path, path)
+
+class SFTPChunkBackend:
+    """Chunk store kept in a directory on an SFTP server.
+
+    The chunk directories are listed once per run so existing chunks are found
+    without a stat per chunk. With create=False, as for restores, nothing is
+    created on the server, so a read-only account can restore.
+    """
+
+    def __init__(self, sftp, root, tree, throttle=None, create=True):
+        self.sftp = sftp
+        self.root = root
+        self.tree = tree
+        self.throttle = throttle
+        self.known_chunks = None
+        if create:
+            tree.ensure_dir(sftp, posixpath.join(root, 'chunks'))
+            tree.ensure_dir(sftp, posixpath.join(root, 'files'))
+
+    def _chunk_path(self, digest):
+        return posixpath.join(self.root, 'chunks', digest[:2], digest)
+
+    def _recipe_path(self, relative_path):
+        return posixpath.join(self.root, 'files', relative_path) + '.json'
+
+    def _load_known_chunks(self):
+        self.known_chunks = set()
+        chunks_dir = posixpath.join(self.root, 'chunks')
+        for prefix in self.sftp.listdir_attr(chunks_dir):
+            if stat.S_ISDIR(prefix.st_mode or 0):
+                names = self.sftp.listdir(posixpath.join(chunks_dir, prefix.filename))
+                self.known_chunks.update(name for name in names if not name.endswith('.tmp'))
+
+    def has_chunk(self, digest):
+        if self.known_chunks is None:
+            self._load_known_chunks()
+        return digest in self.known_chunks
+
+    def put_chunk(self, digest, data):
+        path = self._chunk_path(digest)
+        self.tree.ensure_dir(self.sftp, posixpath.dirname(path))
+        temp_path = path + '.tmp'
+        if self.throttle:
+            self.throttle.consume(len(data))
+        with self.sftp.open(temp_path, 'wb') as chunk_file:
+            chunk_file.set_pipelined(True)
+            chunk_file.write(data)
+        self.sftp.posix_rename(temp_path, path)
+        if self.known_chunks is not None:
+            self.known_chunks.add(digest)
+
+    def get_chunk(self, digest):
+        with self.sftp.open(self._chunk_path(digest), 'rb') as chunk_file:
+            chunk_file.prefetch()
+            return chunk_file.read()
+
+    def get_recipe(self, relative_path):
+        try:
+            with self.sftp.open(self._recipe_path(relative_path), 'r') as recipe_file:
+                return json.loads(recipe_file.read())
+        except (IOError, ValueError):
+            return None
+
+    def put_recipe(self, relative_path, recipe):
+        path = self._recipe_path(relative_path)
+        self.tree.ensure_dir(self.sftp, posixpath.dirname(path))
+        temp_path = path + '.tmp'
+        with self.sftp.open(temp_path, 'w') as recipe_file:
+            recipe_file.write(json.dumps(recipe))
+        self.sftp.posix_rename(temp_path, path)
+
+def store_file(backend, src_file, relative_path, local_stat):
+    """Chunk a file into the store, sending only chunks it does not have yet.
+
+    Returns (new_chunks, new_bytes).
+    """
+    digests = []
+    new_chunks = 0
+    new_bytes = 0
+    with open(src_file, 'rb') as source:
+        for data in iter_chunks(source):
+            digest = chunk_digest(data)
+            if not backend.has_chunk(digest):
+                backend.put_chunk(digest, data)
+                new_chunks += 1
+                new_bytes += len(data)
+            digests.append(digest)
+    backend.put_recipe(relative_path, {"size": local_stat.st_size, "mtime": local_stat.st_mtime, "chunks": digests})
+    logging.debug(f"Stored: {src_file} ({len(digests)} chunks, {new_chunks} new)")
+    return new_chunks, new_bytes
+
+def restore_file(backend, relative_path, dest_file, recipe=None):
+    """Rebuild a file from its recipe, fetching the recipe unless it is given.
+
+    It is written to a partial file and moved into place once complete. Each chunk
+    is checked against the hash it is named by, and IntegrityError is raised if one
+    is damaged, so a bad chunk never ends up in a restored file.
+    """
+    if recipe is None:
+        recipe = backend.get_recipe(relative_path)
+    if recipe is None:
+        raise FileNotFoundError(relative_path)
+    partial_file = partial_name(dest_file)
+    with open(partial_file, 'wb') as target:
+        for digest in recipe["chunks"]:
+            data = backend.get_chunk(digest)
+            if chunk_digest(data) != digest:
+                raise IntegrityError(f"Chunk {digest} of {relative_path} is damaged")
+            target.write(data)
+    finish_partial(partial_file, dest_file, recipe["mtime"])
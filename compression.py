@@ -0,0 +1,113 @@
+import itertools
+import logging
+import math
+import os
+import zlib
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+COMPRESSED_SUFFIX = '.rbz'
+READ_SIZE = 1024 * 1024
+SAMPLE_SIZE = 64 * 1024
+ENTROPY_THRESHOLD = 7.5  # bits per byte; random or already-compressed data is close to 8
+
+# Formats that are already compressed and are passed through unchanged
+COMPRESSED_EXTENSIONS = {
+    '.7z', '.aac', '.avi', '.bz2', '.docx', '.flac', '.gif', '.gz', '.heic', '.jpeg', '.jpg',
+    '.lz4', '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.ogg', '.pdf', '.png', '.pptx', '.rar',
+    '.tgz', '.webm', '.webp', '.xlsx', '.xz', '.zip', '.zst', COMPRESSED_SUFFIX,
+}
+
+# Frame magic numbers, so restores can tell the codec from the data itself
+MAGIC = {
+    'zstd': b'\x28\xb5\x2f\xfd',
+    'lz4': b'\x04\x22\x4d\x18',
+    'gzip': b'\x1f\x8b',
+}
+
+def available_codec(codec):
+    """Return codec if it can be used here, falling back to gzip for a missing library."""
+    if codec == 'zstd' and zstandard is None or codec == 'lz4' and lz4 is None:
+        logging.error(f"Compression codec {codec} is not installed; using gzip instead.")
+        return 'gzip'
+    if codec not in MAGIC:
+        raise ValueError(f"Unknown compression codec: {codec}")
+    return codec
+
+def sample_entropy(path, sample_size=SAMPLE_SIZE):
+    """Shannon entropy in bits per byte of the start of a file."""
+    with open(path, 'rb') as sample_file:
+        sample = sample_file.read(sample_size)
+    if not sample:
+        return 0.0
+    length = len(sample)
+    return -sum(count / length * math.log2(count / length) for count in Counter(sample).values())
+
+def choose_codec(path, codec):
+    """Return the codec to use for a file, or None to pass it through unchanged."""
+    if not codec:
+        return None
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return None
+    if sample_entropy(path) > ENTROPY_THRESHOLD:
+        return None
+    return codec
+
+def read_chunks(file_obj, size=READ_SIZE):
+    """Yield a binary file in fixed-size pieces."""
+    while True:
+        data = file_obj.read(size)
+        if not data:
+            return
+        yield data
+
+def compress_chunks(chunks, codec):
+    """Compress a stream of byte chunks without holding more than one chunk in memory."""
+    if codec == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+    elif codec == 'lz4':
+        compressor = lz4.frame.LZ4FrameCompressor()
+        yield compressor.begin()
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for data in chunks:
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def detect_codec(header):
+    """Return the codec whose frame magic starts header."""
+    for codec, magic in MAGIC.items():
+        if header.startswith(magic):
+            return codec
+    raise ValueError("Unrecognised compressed data")
+
+def decompress_chunks(chunks):
+    """Decompress a stream produced by compress_chunks, detecting the codec from its magic."""
+    chunks = iter(chunks)
+    first = next(chunks, b'')
+    if not first:
+        return
+    codec = detect_codec(first)
+    if codec == 'zstd':
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    elif codec == 'lz4':
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+    else:
+        decompressor = zlib.decompressobj(31)
+    for data in itertools.chain([first], chunks):
+        output = decompressor.decompress(data)
+        if output:
+            yield output
+    if codec == 'gzip':
+        yield decompressor.flush()
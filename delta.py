@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import zlib
+from throttle import throttled
+
+BLOCK_SIZE = 64 * 1024
+ENTRY_SIZE = 20  # 4-byte adler32 + 16-byte blake2b per block
+
+def block_signature(block):
+    """Weak rolling checksum plus strong hash of one block."""
+    return zlib.adler32(block).to_bytes(4, 'big') + hashlib.blake2b(block, digest_size=16).digest()
+
+def file_signature(file_obj, block_size=BLOCK_SIZE):
+    """Signature of a whole file: one entry per block."""
+    entries = []
+    while True:
+        block = file_obj.read(block_size)
+        if not block:
+            return b''.join(entries)
+        entries.append(block_signature(block))
+
+def signature_matcher(old_signature):
+    """Match blocks against a cached signature, checking the cheap weak sum first."""
+    def matches(index, block):
+        old_entry = old_signature[index * ENTRY_SIZE:(index + 1) * ENTRY_SIZE]
+        if len(old_entry) != ENTRY_SIZE:
+            return False
+        if zlib.adler32(block).to_bytes(4, 'big') != old_entry[:4]:
+            return False
+        return hashlib.blake2b(block, digest_size=16).digest() == old_entry[4:]
+    return matches
+
+def hash_matcher(remote_hashes):
+    """Match blocks against sha1 block hashes computed by the server."""
+    def matches(index, block):
+        return hashlib.sha1(block).digest() == remote_hashes[index * 20:(index + 1) * 20]
+    return matches
+
+def upload_with_signature(source, remote_file, block_size=BLOCK_SIZE):
+    """Copy source to remote_file while computing the signature for the next delta.
+
+    Returns (signature, bytes_sent).
+    """
+    entries = []
+    bytes_sent = 0
+    while True:
+        block = source.read(block_size)
+        if not block:
+            break
+        remote_file.write(block)
+        entries.append(block_signature(block))
+        bytes_sent += len(block)
+    return b''.join(entries), bytes_sent
+
+def patch_remote(source, remote_file, block_matches, old_size, block_size=BLOCK_SIZE):
+    """Rewrite only the blocks of remote_file that differ from source.
+
+    remote_file must be opened for in-place update, and block_matches(index, block)
+    tells whether the remote copy already holds that block. Returns (new_signature, bytes_sent).
+    """
+    entries = []
+    bytes_sent = 0
+    offset = 0
+    index = 0
+    while True:
+        block = source.read(block_size)
+        if not block:
+            break
+        if not block_matches(index, block):
+            remote_file.seek(offset)
+            remote_file.write(block)
+            bytes_sent += len(block)
+        entries.append(block_signature(block))
+        offset += len(block)
+        index += 1
+    if offset < old_size:
+        remote_file.truncate(offset)
+    return b''.join(entries), bytes_sent
+
+def remote_block_hashes(remote_file, size, block_size=BLOCK_SIZE):
+    """Ask the server for per-block hashes with the check-file extension, or None if unsupported."""
+    if size == 0:
+        return None
+    try:
+        return remote_file.check('sha1', 0, size, block_size)
+    except IOError as e:
+        logging.debug(f"Server-side block hashes unavailable: {e}")
+        return None
+
+def delta_upload(sftp, src_file, dest_file, old_signature=None, remote_size=None, throttle=None, hasher=None):
+    """Upload src_file to dest_file, sending only changed blocks where the remote copy allows it.
+
+    old_signature is the cached signature of the current remote copy, if known.
+    Without it the server is asked for block hashes; failing that the whole file is sent.
+    Every block is read, sent or not, so a hasher sees the whole file.
+    Returns (new_signature, bytes_sent).
+    """
+    # Imported here, since integrity imports this module for its block size
+    from integrity import hashing
+    with open(src_file, 'rb') as source:
+        source = hashing(source, hasher)
+        if remote_size:
+            with sftp.open(dest_file, 'r+') as remote_file:
+                if old_signature is not None:
+                    block_matches = signature_matcher(old_signature)
+                else:
+                    remote_hashes = remote_block_hashes(remote_file, remote_size)
+                    block_matches = hash_matcher(remote_hashes) if remote_hashes else None
+                if block_matches is not None:
+                    remote_file.set_pipelined(True)
+                    return patch_remote(source, throttled(remote_file, throttle), block_matches, remote_size)
+        with sftp.open(dest_file, 'wb') as remote_file:
+            remote_file.set_pipelined(True)
+            return upload_with_signature(source, throttled(remote_file, throttle))
@@ -0,0 +1,222 @@
+import hashlib
+import logging
+import re
+import shlex
+import threading
+from delta import BLOCK_SIZE
+
+WHOLE_FILE = 'sha256'
+# The sha1 of each block, as the check-file extension returns them for delta uploads; the
+# list is kept as its sha256. Whole-file check-file hashes are skipped, since paramiko's
+# server reads past the first 64 KB of a block wrongly.
+BLOCKS = 'sha1-blocks'
+DIGEST_KINDS = (BLOCKS, WHOLE_FILE)
+VERIFY_READ_SIZE = 1024 * 1024
+COMMAND_TIMEOUT = 300
+SHA256_OUTPUT = re.compile(r'\\?([0-9a-f]{64})\s')
+
+class IntegrityError(IOError):
+    """A stored copy differs from the bytes that were sent."""
+
+class _BlockHashes:
+    """sha256 over the sha1 of each BLOCK_SIZE block, taken as the bytes stream past."""
+
+    def __init__(self):
+        self.blocks = hashlib.sha256()
+        self.block = hashlib.sha1()
+        self.filled = 0
+
+    def update(self, data):
+        view = memoryview(data).cast('B')
+        while len(view):
+            take = min(len(view), BLOCK_SIZE - self.filled)
+            self.block.update(view[:take])
+            self.filled += take
+            view = view[take:]
+            if self.filled == BLOCK_SIZE:
+                self.blocks.update(self.block.digest())
+                self.block = hashlib.sha1()
+                self.filled = 0
+
+    def hexdigest(self):
+        blocks = self.blocks.copy()
+        if self.filled:
+            blocks.update(self.block.digest())
+        return blocks.hexdigest()
+
+def _new_digest(kind):
+    return _BlockHashes() if kind == BLOCKS else hashlib.new(kind)
+
+class StreamHasher:
+    """Digests of the bytes read from or written to a file object, taken as they stream.
+
+    Hashing runs on the thread moving the data, so a copy is checked without
+    reading its source a second time, and since hashlib lets go of the GIL for
+    large buffers, parallel transfers hash in parallel.
+    """
+
+    def __init__(self, kinds=DIGEST_KINDS):
+        self.digests = {kind: _new_digest(kind) for kind in kinds}
+
+    def update(self, data):
+        for digest in self.digests.values():
+            digest.update(data)
+
+    def hexdigests(self):
+        """Return {kind: hex digest} of everything seen so far."""
+        return {kind: digest.hexdigest() for kind, digest in self.digests.items()}
+
+class HashingFile:
+    """File object wrapper that feeds every byte read or written to a StreamHasher."""
+
+    def __init__(self, file_obj, hasher):
+        self.file_obj = file_obj
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        data = self.file_obj.read(size)
+        self.hasher.update(data)
+        return data
+
+    def readinto(self, buffer):
+        read = self.file_obj.readinto(buffer)
+        if read:
+            self.hasher.update(memoryview(buffer)[:read])
+        return read
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.file_obj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file_obj, name)
+
+def hashing(file_obj, hasher):
+    """Wrap file_obj so the bytes passing through it are hashed, or return it unchanged when there is no hasher."""
+    return HashingFile(file_obj, hasher) if hasher else file_obj
+
+def read_digests(file_obj, kinds):
+    """Return {kind: hex digest} of the rest of a readable file object."""
+    hasher = StreamHasher(kinds)
+    while True:
+        data = file_obj.read(VERIFY_READ_SIZE)
+        if not data:
+            return hasher.hexdigests()
+        hasher.update(data)
+
+def parse_digest(recorded):
+    """Split a digest recorded as 'kind:hex' into {kind: hex}."""
+    kind, _, value = recorded.partition(':')
+    return {kind: value}
+
+def verify_file(path, expected):
+    """Read a local copy back and check it against expected ({kind: hex digest}).
+
+    Returns the digest to record, as 'kind:hex'; raises IntegrityError if the copy differs.
+    """
+    kind = next(iter(expected))
+    with open(path, 'rb') as copy:
+        value = read_digests(copy, (kind,))[kind]
+    if value != expected[kind]:
+        raise IntegrityError(f"{path} does not match what was written ({kind} {value}, expected {expected[kind]})")
+    return f"{kind}:{value}"
+
+class _Unsupported(Exception):
+    pass
+
+class RemoteHasher:
+    """Hash files on an SFTP server as cheaply as the server allows.
+
+    The check-file extension hashes on the server and sends back only block
+    hashes; failing that, sha256sum run over SSH does the same; failing both,
+    the copy is read back and hashed here. A method the server turns down is
+    not tried again, and once one works only the digest it needs is taken of
+    what is sent. One instance is shared by the upload workers of a run.
+    """
+
+    # The digests each method can produce, the one it prefers first
+    METHOD_KINDS = {'check-file': (BLOCKS,), 'command': (WHOLE_FILE,), 'read-back': (WHOLE_FILE, BLOCKS)}
+
+    def __init__(self):
+        self.methods = list(self.METHOD_KINDS)
+        self.settled = False
+        self.lock = threading.Lock()
+
+    @property
+    def kinds(self):
+        """The digests to take of what is sent, so some method can check it."""
+        with self.lock:
+            return self.METHOD_KINDS[self.methods[0]][:1] if self.settled else DIGEST_KINDS
+
+    def verify(self, sftp, path, expected):
+        """Check a remote file against expected ({kind: hex digest}).
+
+        Returns the digest to record, as 'kind:hex'; raises IntegrityError if the copy differs.
+        """
+        with self.lock:
+            methods = list(self.methods)
+        for method in methods:
+            kind = next((kind for kind in self.METHOD_KINDS[method] if kind in expected), None)
+            if kind is None:
+                continue
+            try:
+                value = self._digest(method, sftp, path, kind)
+            except _Unsupported as e:
+                self._drop(method, e)
+                continue
+            if value is None:
+                continue
+            if value != expected[kind] and method != 'read-back':
+                # A server's check-file may be buggy, and its shell may see other paths than SFTP does
+                # (a chroot, say); only a read-back is conclusive
+                value = self._digest('read-back', sftp, path, kind)
+                if value == expected[kind]:
+                    self._drop(method, "its hash differed from the file's contents")
+            with self.lock:
+                self.settled = True
+            if value != expected[kind]:
+                raise IntegrityError(f"{path} does not match what was sent ({kind} {value}, expected {expected[kind]})")
+            return f"{kind}:{value}"
+        raise IntegrityError(f"{path} can't be checked against a {', '.join(expected)} digest")
+
+    def _drop(self, method, reason):
+        with self.lock:
+            if method in self.methods:
+                self.methods.remove(method)
+                logging.info(f"Copies can't be hashed with {method} on this server ({reason}); trying the next method.")
+
+    def _digest(self, method, sftp, path, kind):
+        if method == 'check-file':
+            with sftp.open(path, 'rb') as remote_file:
+                size = remote_file.stat().st_size
+                if not size:
+                    # Servers refuse to hash nothing, which says nothing about the extension
+                    return None
+                try:
+                    return hashlib.sha256(remote_file.check('sha1', 0, size, BLOCK_SIZE)).hexdigest()
+                except IOError as e:
+                    raise _Unsupported(e)
+        if method == 'command':
+            return _run_sha256sum(sftp, path)
+        with sftp.open(path, 'rb') as remote_file:
+            remote_file.prefetch()
+            return read_digests(remote_file, (kind,))[kind]
+
+def _run_sha256sum(sftp, path):
+    try:
+        channel = sftp.get_channel().get_transport().open_session(timeout=COMMAND_TIMEOUT)
+    except Exception as e:
+        raise _Unsupported(e)
+    try:
+        channel.settimeout(COMMAND_TIMEOUT)
+        channel.exec_command(f"sha256sum -- {shlex.quote(path)}")
+        output = channel.makefile('rb').read().decode('utf-8', 'replace')
+        status = channel.recv_exit_status()
+    except Exception as e:
+        raise _Unsupported(e)
+    finally:
+        channel.close()
+    match = SHA256_OUTPUT.match(output)
+    if status != 0 or match is None:
+        raise _Unsupported(f"sha256sum exited with {status}")
+    return match.group(1)
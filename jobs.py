@@ -0,0 +1,123 @@
+import logging
+import os
+import queue
+import threading
+
+DEFAULT_JOB = 'default'
+FAN_OUT_QUEUE_SIZE = 1024
+PUT_TIMEOUT = 0.1
+
+def job_configs(config):
+    """Return (name, config) for every backup job.
+
+    Without a 'jobs' list the whole configuration is one job. Each entry of 'jobs'
+    is merged over the top-level settings, so values every job shares, such as the
+    SFTP login or encryption, need only be given once.
+    """
+    jobs = config.get('jobs')
+    if not jobs:
+        return [(config.get('name') or DEFAULT_JOB, config)]
+    shared = {key: value for key, value in config.items() if key != 'jobs'}
+    configs = []
+    for index, job in enumerate(jobs, 1):
+        name = job.get('name') or f"job{index}"
+        if any(name == existing for existing, _ in configs):
+            raise ValueError(f"Job name {name} is used more than once")
+        configs.append((name, {**shared, **job, 'name': name}))
+    return configs
+
+def job_sources(config):
+    """Return (source_dir, subdir) for each source folder of a job.
+
+    A single source is backed up into the root of each target; several sources
+    each go into a folder named after them.
+    """
+    sources = config.get('source_folders') or [config.get('source_folder')]
+    if len(sources) == 1:
+        return [(sources[0], '')]
+    names = [os.path.basename(os.path.normpath(source)) for source in sources]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Source folders of job {config.get('name', DEFAULT_JOB)} need distinct folder names")
+    return list(zip(sources, names))
+
+class _End:
+    """Marks the end of a walk, and carries the error that cut it short, if any."""
+
+    def __init__(self, error=None):
+        self.error = error
+
+class FanOut:
+    """Walk a source once and hand every file to several consumers.
+
+    Each consumer reads its own bounded queue, so the fastest target runs at most
+    queue_size files ahead of the slowest. A consumer that stops early must call
+    close() so the walk does not wait for it.
+    """
+
+    def __init__(self, iterable, consumers, queue_size=FAN_OUT_QUEUE_SIZE):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(consumers)]
+        self.closed = [threading.Event() for _ in range(consumers)]
+        self.thread = threading.Thread(target=self._walk, args=(iterable,), name='source-walk', daemon=True)
+        self.thread.start()
+
+    def _walk(self, iterable):
+        end = _End()
+        try:
+            for item in iterable:
+                for index in range(len(self.queues)):
+                    self._put(index, item)
+        except Exception as e:
+            # Consumers re-raise it, so an incomplete walk is never taken for the whole source
+            end = _End(e)
+        finally:
+            for index in range(len(self.queues)):
+                self._put(index, end)
+
+    def _put(self, index, item):
+        while not self.closed[index].is_set():
+            try:
+                self.queues[index].put(item, timeout=PUT_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    def branch(self, index):
+        """Yield the files for one consumer."""
+        while True:
+            item = self.queues[index].get()
+            if isinstance(item, _End):
+                if item.error is not None:
+                    raise item.error
+                return
+            yield item
+
+    def close(self, index):
+        self.closed[index].set()
+
+class JobRunner:
+    """Start each job on a thread of its own, so one job never delays another.
+
+    A job whose previous run is still going is skipped rather than started twice.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}
+
+    def start(self, name, function, *args):
+        with self.lock:
+            thread = self.running.get(name)
+            if thread is not None and thread.is_alive():
+                logging.info(f"Job {name} is still running; skipping this run.")
+                return False
+            thread = threading.Thread(target=function, args=args, name=f"job-{name}", daemon=True)
+            self.running[name] = thread
+            thread.start()
+        return True
+
+    def join(self, timeout=None):
+        """Wait for the jobs that are running now."""
+        with self.lock:
+            threads = list(self.running.values())
+        for thread in threads:
+            thread.join(timeout)
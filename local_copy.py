@@ -0,0 +1,88 @@
+import os
+import shutil
+from integrity import hashing
+from resumable import partial_name
+from throttle import throttled
+
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+KERNEL_COPY_CHUNK = 64 * 1024 * 1024
+THROTTLED_CHUNK = 1024 * 1024  # small enough for a rate limit to take effect smoothly
+
+def _copy_file_range(src_fd, dst_fd, size, throttle=None):
+    # In-kernel copy; can also reflink on btrfs/XFS or copy server-side on NFS/SMB.
+    chunk = THROTTLED_CHUNK if throttle else KERNEL_COPY_CHUNK
+    copied = 0
+    while copied < size:
+        if throttle:
+            throttle.consume(min(chunk, size - copied))
+        sent = os.copy_file_range(src_fd, dst_fd, min(chunk, size - copied))
+        if sent == 0:
+            break
+        copied += sent
+    return copied
+
+def _sendfile(src_fd, dst_fd, size, throttle=None):
+    chunk = THROTTLED_CHUNK if throttle else KERNEL_COPY_CHUNK
+    copied = 0
+    while copied < size:
+        if throttle:
+            throttle.consume(min(chunk, size - copied))
+        sent = os.sendfile(dst_fd, src_fd, copied, min(chunk, size - copied))
+        if sent == 0:
+            break
+        copied += sent
+    return copied
+
+def _buffered_copy(src_file, dst_file, throttle=None):
+    dst_file = throttled(dst_file, throttle)
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    while True:
+        read = src_file.readinto(buffer)
+        if not read:
+            break
+        dst_file.write(view[:read])
+
+def copy_file_data(src, dst, throttle=None, hasher=None):
+    """Copy file contents using the fastest mechanism the OS offers, within throttle's rate if given.
+
+    With a hasher the data has to pass through this process to be hashed, so plain reads are used.
+    """
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        if hasher:
+            _buffered_copy(hashing(src_file, hasher), dst_file, throttle)
+            return
+        size = os.fstat(src_file.fileno()).st_size
+        src_fd = src_file.fileno()
+        dst_fd = dst_file.fileno()
+        for kernel_copy in (getattr(os, 'copy_file_range', None) and _copy_file_range,
+                            getattr(os, 'sendfile', None) and _sendfile):
+            if not kernel_copy:
+                continue
+            try:
+                copied = kernel_copy(src_fd, dst_fd, size, throttle)
+            except OSError:
+                # Not supported between these filesystems; start over with the next method
+                src_file.seek(0)
+                dst_file.seek(0)
+                dst_file.truncate()
+                continue
+            if copied >= size:
+                return
+            # The kernel stopped early (the file shrank or was replaced); finish with plain reads
+            src_file.seek(copied)
+            dst_file.seek(copied)
+            break
+        _buffered_copy(src_file, dst_file, throttle)
+
+def copy_file(src, dst, throttle=None, hasher=None):
+    """Copy data and metadata like shutil.copy2, replacing dst only once the copy is complete."""
+    partial_file = partial_name(dst)
+    try:
+        copy_file_data(src, partial_file, throttle, hasher)
+        shutil.copystat(src, partial_file)
+        os.replace(partial_file, dst)
+    except BaseException:
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+        raise
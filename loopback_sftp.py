@@ -0,0 +1,254 @@
+import logging
+import os
+import posixpath
+import queue
+import socket
+import threading
+import time
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface, ServerInterface
+
+RELAY_READ_SIZE = 64 * 1024
+
+class LoopbackServer(ServerInterface):
+    """Accepts any password and the sftp subsystem; for local testing only."""
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+class LoopbackHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            if attr._flags & attr.FLAG_SIZE:
+                self.writefile.flush()
+                os.truncate(self.filename, attr.st_size)
+                attr._flags &= ~attr.FLAG_SIZE
+            SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+class LoopbackSFTP(SFTPServerInterface):
+    """Serves a local directory as the root of the SFTP server."""
+
+    def __init__(self, server, root):
+        super().__init__(server)
+        self.root = root
+
+    def canonicalize(self, path):
+        return posixpath.normpath('/' + path.lstrip('/'))
+
+    def _local(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def list_folder(self, path):
+        local_dir = self._local(path)
+        try:
+            entries = []
+            for name in os.listdir(local_dir):
+                try:
+                    attributes = SFTPAttributes.from_stat(os.stat(os.path.join(local_dir, name)))
+                except FileNotFoundError:
+                    # Renamed or removed since the directory was read
+                    continue
+                attributes.filename = name
+                entries.append(attributes)
+            return entries
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        local_file = self._local(path)
+        try:
+            fd = os.open(local_file, flags | getattr(os, 'O_BINARY', 0), 0o666)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = LoopbackHandle(flags)
+        handle.filename = local_file
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def _call(self, operation, *paths):
+        try:
+            operation(*(self._local(path) for path in paths))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def remove(self, path):
+        return self._call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        return self._call(os.rename, oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        return self._call(os.replace, oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, path)
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, path)
+
+    def chattr(self, path, attr):
+        try:
+            SFTPServer.set_file_attr(self._local(path), attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+class LoopbackSFTPServer:
+    """In-process SFTP server on localhost for benchmarks and tests.
+
+    Any username and password are accepted. With latency (seconds of round-trip
+    time), clients connect through a relay that holds every packet back by half
+    of it in each direction, so pipelined requests still overlap as they would on
+    a slow link.
+    """
+
+    def __init__(self, root, latency=0.0):
+        self.root = os.path.abspath(root)
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.closed = threading.Event()
+        self.transports = []
+        self.listener = _listen()
+        self.port = self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self._accept, name='sftp-server', daemon=True)
+        self.thread.start()
+        self.relay = None
+        if latency:
+            self.relay = DelayRelay(self.port, latency / 2)
+            self.port = self.relay.port
+
+    def _accept(self):
+        while not self.closed.is_set():
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                return
+            if self.closed.is_set():
+                connection.close()
+                return
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', SFTPServer, LoopbackSFTP, self.root)
+            try:
+                transport.start_server(server=LoopbackServer())
+            except Exception as e:
+                logging.error(f"SFTP handshake failed: {e}")
+                continue
+            self.transports.append(transport)
+
+    def close(self):
+        self.closed.set()
+        _close_listener(self.listener, self.thread)
+        if self.relay:
+            self.relay.close()
+        for transport in self.transports:
+            transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class DelayRelay:
+    """TCP relay to a local port that delays data by a fixed time in each direction."""
+
+    def __init__(self, target_port, delay):
+        self.target_port = target_port
+        self.delay = delay
+        self.listener = _listen()
+        self.port = self.listener.getsockname()[1]
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._accept, name='delay-relay', daemon=True)
+        self.thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            if self.closed.is_set():
+                client.close()
+                return
+            server = socket.create_connection(('127.0.0.1', self.target_port))
+            for source, destination in ((client, server), (server, client)):
+                source.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                threading.Thread(target=self._relay, args=(source, destination), daemon=True).start()
+
+    def _relay(self, source, destination):
+        pending = queue.Queue()
+        threading.Thread(target=self._deliver, args=(pending, destination), daemon=True).start()
+        while True:
+            try:
+                data = source.recv(RELAY_READ_SIZE)
+            except OSError:
+                data = b''
+            pending.put((time.monotonic() + self.delay, data))
+            if not data:
+                return
+
+    def _deliver(self, pending, destination):
+        while True:
+            due, data = pending.get()
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                if not data:
+                    destination.shutdown(socket.SHUT_WR)
+                    return
+                destination.sendall(data)
+            except OSError:
+                return
+
+    def close(self):
+        self.closed.set()
+        _close_listener(self.listener, self.thread)
+
+def _close_listener(listener, thread):
+    # Closing alone does not wake a thread blocked in accept() on Linux, and a later
+    # listener could then reuse the descriptor and have its connections taken
+    try:
+        listener.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    listener.close()
+    thread.join(1.0)
+
+def _listen():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(50)
+    return listener
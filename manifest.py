@@ -0,0 +1,379 @@
+import logging
+import os
+import posixpath
+import sqlite3
+import stat
+import threading
+import time
+from change_detection import SFTP_MTIME_TOLERANCE
+from packs import live_entries
+from payload import is_transformed, original_name
+
+MANIFEST_FILE = 'manifest.db'
+COMMIT_EVERY = 1000
+COMMIT_SECONDS = 5
+READ_BATCH = 1000
+
+# Runs in one process share a connection per manifest file, so concurrent jobs
+# take turns on one lock instead of waiting out each other's batched transactions
+_connections = {}
+_connections_lock = threading.Lock()
+
+def _open(path):
+    # Upload workers record results from their own threads
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS files ("
+        " target TEXT NOT NULL,"
+        " path TEXT NOT NULL,"
+        " size INTEGER NOT NULL,"
+        " mtime REAL NOT NULL,"
+        " remote_size INTEGER,"
+        " remote_mtime REAL,"
+        " codec TEXT,"
+        " digest TEXT,"
+        " snapshot TEXT,"
+        " bundle TEXT,"
+        " stored_digest TEXT,"
+        " PRIMARY KEY (target, path))"
+    )
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+    if 'codec' not in columns:
+        conn.execute("ALTER TABLE files ADD COLUMN codec TEXT")
+    if 'digest' not in columns:
+        conn.execute("ALTER TABLE files ADD COLUMN digest TEXT")
+    if 'snapshot' not in columns:
+        conn.execute("ALTER TABLE files ADD COLUMN snapshot TEXT")
+    if 'bundle' not in columns:
+        conn.execute("ALTER TABLE files ADD COLUMN bundle TEXT")
+    if 'stored_digest' not in columns:
+        conn.execute("ALTER TABLE files ADD COLUMN stored_digest TEXT")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS signatures ("
+        " target TEXT NOT NULL,"
+        " path TEXT NOT NULL,"
+        " signature BLOB NOT NULL,"
+        " PRIMARY KEY (target, path))"
+    )
+    # Uploads that were started but not recorded as finished: the run checkpoint
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS uploads ("
+        " target TEXT NOT NULL,"
+        " path TEXT NOT NULL,"
+        " size INTEGER NOT NULL,"
+        " mtime REAL NOT NULL,"
+        " PRIMARY KEY (target, path))"
+    )
+    # Content digests of local files, valid while the file's size and mtime are unchanged
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS hashes ("
+        " device INTEGER NOT NULL,"
+        " inode INTEGER NOT NULL,"
+        " size INTEGER NOT NULL,"
+        " mtime_ns INTEGER NOT NULL,"
+        " digest TEXT NOT NULL,"
+        " PRIMARY KEY (device, inode))"
+    )
+    # Move detection looks up earlier uploads by size
+    conn.execute("CREATE INDEX IF NOT EXISTS files_by_size ON files (target, size)")
+    conn.commit()
+    return conn
+
+class Manifest:
+    """Persistent record of the files already uploaded to each backup target."""
+
+    def __init__(self, path=MANIFEST_FILE):
+        self.path = path
+        self.key = os.path.abspath(path)
+        with _connections_lock:
+            shared = _connections.get(self.key)
+            if shared is None:
+                shared = _connections[self.key] = [_open(path), threading.Lock(), 0]
+            shared[2] += 1
+        self.conn, self.lock = shared[0], shared[1]
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def get(self, target, path):
+        """Return (size, mtime, remote_size, remote_mtime) for a file, or None."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT size, mtime, remote_size, remote_mtime FROM files WHERE target = ? AND path = ?",
+                (target, path)
+            ).fetchone()
+
+    def is_unchanged(self, target, path, size, mtime):
+        """Check whether a local file matches what was last uploaded."""
+        entry = self.get(target, path)
+        return entry is not None and entry[0] == size and entry[1] == mtime
+
+    def get_digest(self, target, path):
+        """Return the content digest recorded for the uploaded copy, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT digest FROM files WHERE target = ? AND path = ?", (target, path)
+            ).fetchone()
+        return row[0] if row else None
+
+    def record(self, target, path, size, mtime, remote_size=None, remote_mtime=None, codec=None, digest=None,
+               snapshot=None, bundle=None, stored_digest=None):
+        """Record a file as present on the target, with the codec it was compressed with and its digest, if known.
+
+        snapshot is the snapshot that wrote the copy; without one, the recorded snapshot is kept.
+        bundle is the bundle of small files the copy is packed in, or None for a file stored on its own.
+        stored_digest is the verified digest of the stored copy as 'kind:hex', for audits.
+        """
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO files (target, path, size, mtime, remote_size, remote_mtime, codec, digest, snapshot, bundle,"
+                " stored_digest) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (target, path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime,"
+                " remote_size = excluded.remote_size, remote_mtime = excluded.remote_mtime, codec = excluded.codec,"
+                " digest = excluded.digest, snapshot = COALESCE(excluded.snapshot, files.snapshot),"
+                " bundle = excluded.bundle, stored_digest = excluded.stored_digest",
+                (target, path, size, mtime, remote_size, remote_mtime, codec, digest, snapshot, bundle, stored_digest)
+            )
+            self.conn.execute("DELETE FROM uploads WHERE target = ? AND path = ?", (target, path))
+            self._maybe_commit()
+
+    def set_digest(self, target, path, digest):
+        with self.lock:
+            self.conn.execute("UPDATE files SET digest = ? WHERE target = ? AND path = ?", (digest, target, path))
+            self._maybe_commit()
+
+    def paths(self, target):
+        """Yield every path recorded for the target in sorted order, reading a batch at a time.
+
+        SQLite compares text as UTF-8 bytes, which sorts like Python compares str,
+        so the paths can be merged with other sorted path lists.
+        """
+        last = ''
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT path FROM files WHERE target = ? AND path > ? ORDER BY path LIMIT ?", (target, last, READ_BATCH)
+                ).fetchall()
+            if not rows:
+                return
+            for (path,) in rows:
+                yield path
+            last = rows[-1][0]
+
+    def count(self, target):
+        """Return the number of files recorded for the target."""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM files WHERE target = ?", (target,)).fetchone()[0]
+
+    def sample(self, target, count):
+        """Return (path, size, mtime, stored_digest) for count files picked at random, leaving out packed ones."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT path, size, mtime, stored_digest FROM files WHERE target = ? AND bundle IS NULL"
+                " ORDER BY random() LIMIT ?", (target, count)
+            ).fetchall()
+
+    def move_candidates(self, target, size):
+        """Return (path, digest) for the recorded files of a size whose contents digest is known."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT path, digest FROM files WHERE target = ? AND size = ? AND digest IS NOT NULL", (target, size)
+            ).fetchall()
+
+    def rename(self, target, old_path, new_path, size, mtime, remote_mtime=None):
+        """Move the record of a file, and its cached signature, to the path and times of its new source."""
+        with self.lock:
+            for table in ('files', 'signatures'):
+                self.conn.execute(f"DELETE FROM {table} WHERE target = ? AND path = ?", (target, new_path))
+                self.conn.execute(f"UPDATE {table} SET path = ? WHERE target = ? AND path = ?", (new_path, target, old_path))
+            self.conn.execute(
+                "UPDATE files SET size = ?, mtime = ?, remote_mtime = COALESCE(?, remote_mtime) WHERE target = ? AND path = ?",
+                (size, mtime, remote_mtime, target, new_path)
+            )
+            self.conn.commit()
+            self.pending = 0
+
+    def get_snapshot(self, target, path):
+        """Return the id of the snapshot that wrote the copy on the target, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT snapshot FROM files WHERE target = ? AND path = ?", (target, path)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_bundle(self, target, path):
+        """Return the id of the bundle the copy on the target is packed in, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT bundle FROM files WHERE target = ? AND path = ?", (target, path)
+            ).fetchone()
+        return row[0] if row else None
+
+    def bundles(self, target):
+        """Return the ids of the bundles that still hold a recorded copy."""
+        with self.lock:
+            return {row[0] for row in self.conn.execute(
+                "SELECT DISTINCT bundle FROM files WHERE target = ? AND bundle IS NOT NULL", (target,))}
+
+    def remove(self, target, path):
+        """Forget a file on the target."""
+        with self.lock:
+            self.conn.execute("DELETE FROM files WHERE target = ? AND path = ?", (target, path))
+            self.conn.execute("DELETE FROM uploads WHERE target = ? AND path = ?", (target, path))
+            self._maybe_commit()
+
+    def start_upload(self, target, path, size, mtime):
+        """Note an upload immediately, before the remote copy is touched, so an interrupted one is resumed."""
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO uploads (target, path, size, mtime) VALUES (?, ?, ?, ?)",
+                (target, path, size, mtime)
+            )
+            self.conn.commit()
+            self.pending = 0
+
+    def interrupted_uploads(self, target):
+        """Return {path: (size, mtime)} for uploads a previous run started but did not finish."""
+        with self.lock:
+            rows = self.conn.execute("SELECT path, size, mtime FROM uploads WHERE target = ?", (target,)).fetchall()
+        return {path: (size, mtime) for path, size, mtime in rows}
+
+    def get_hash(self, file_stat):
+        """Return the cached digest of a local file, or None if it changed since it was hashed."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, digest FROM hashes WHERE device = ? AND inode = ?",
+                (file_stat.st_dev, file_stat.st_ino)
+            ).fetchone()
+        if row is None or (row[0], row[1]) != (file_stat.st_size, file_stat.st_mtime_ns):
+            return None
+        return row[2]
+
+    def put_hash(self, file_stat, digest):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO hashes (device, inode, size, mtime_ns, digest) VALUES (?, ?, ?, ?, ?)",
+                (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns, digest)
+            )
+            self._maybe_commit()
+
+    def get_signature(self, target, path):
+        """Return the cached block signature of the uploaded copy, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT signature FROM signatures WHERE target = ? AND path = ?", (target, path)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put_signature(self, target, path, signature):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO signatures (target, path, signature) VALUES (?, ?, ?)",
+                (target, path, signature)
+            )
+            self._maybe_commit()
+
+    def drop_signature(self, target, path):
+        """Forget a signature immediately, before the remote copy is modified."""
+        with self.lock:
+            self.conn.execute("DELETE FROM signatures WHERE target = ? AND path = ?", (target, path))
+            self.conn.commit()
+            self.pending = 0
+
+    def clear(self, target):
+        """Forget every file recorded for the target."""
+        with self.lock:
+            self.conn.execute("DELETE FROM files WHERE target = ?", (target,))
+            self.conn.execute("DELETE FROM signatures WHERE target = ?", (target,))
+            self.conn.execute("DELETE FROM uploads WHERE target = ?", (target,))
+            self.conn.commit()
+            self.pending = 0
+
+    def _maybe_commit(self):
+        # Commit in batches, and at least every few seconds, so an interrupted run keeps its progress.
+        self.pending += 1
+        if self.pending >= COMMIT_EVERY or time.monotonic() - self.last_commit >= COMMIT_SECONDS:
+            self.conn.commit()
+            self.pending = 0
+            self.last_commit = time.monotonic()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        with _connections_lock:
+            shared = _connections[self.key]
+            shared[2] -= 1
+            if shared[2] == 0:
+                del _connections[self.key]
+                self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def sftp_target(host, port, username, remote_dir):
+    """Build the manifest key for an SFTP destination."""
+    remote_dir = posixpath.normpath('/' + remote_dir.replace('\\', '/').lstrip('/'))
+    return f"sftp://{username}@{host}:{port}{remote_dir}"
+
+def walk_remote(sftp, remote_dir):
+    """Yield (relative_path, attributes) for every file under remote_dir, one listing per directory."""
+    pending = ['']
+    while pending:
+        relative_dir = pending.pop()
+        current = posixpath.join(remote_dir, relative_dir) if relative_dir else remote_dir
+        try:
+            entries = sftp.listdir_attr(current)
+        except IOError:
+            continue
+        for entry in entries:
+            relative_path = posixpath.join(relative_dir, entry.filename) if relative_dir else entry.filename
+            if stat.S_ISDIR(entry.st_mode or 0):
+                pending.append(relative_path)
+            else:
+                yield relative_path, entry
+
+def rebuild_from_remote(manifest, target, sftp, remote_dir, local_stat):
+    """Rebuild the manifest for a target from a bulk listing of the remote tree.
+
+    local_stat maps a relative path to the local os.stat_result, or None if the file is gone.
+    Only remote files the same size as their local source and at least as new are
+    recorded, so a truncated or interrupted upload is sent again. Files packed into
+    bundles are recorded from the bundle indexes.
+    """
+    manifest.clear(target)
+    recorded = 0
+    for stored_path, attributes in walk_remote(sftp, remote_dir):
+        # Compressed and encrypted copies say nothing about the size of their source
+        if is_transformed(stored_path):
+            continue
+        relative_path = original_name(stored_path)
+        local = local_stat(relative_path)
+        # Uploads keep the local mtime, truncated to whole seconds
+        if local is None or local.st_mtime >= (attributes.st_mtime or 0) + SFTP_MTIME_TOLERANCE:
+            continue
+        # Only plain copies are listed under their source's name, so their sizes must agree
+        if attributes.st_size != local.st_size:
+            continue
+        manifest.record(target, relative_path, local.st_size, local.st_mtime, attributes.st_size, attributes.st_mtime)
+        recorded += 1
+    for relative_path, (bundle_id, entry) in live_entries(sftp, remote_dir).items():
+        local = local_stat(relative_path)
+        if local is None or (local.st_size, local.st_mtime) != (entry['size'], entry['mtime']):
+            continue
+        # A copy stored on its own at least as new as the packed one replaced it
+        stored = manifest.get(target, relative_path)
+        if stored is not None and (stored[3] or 0) >= int(entry['mtime']):
+            continue
+        manifest.record(target, relative_path, local.st_size, local.st_mtime, codec=entry['codec'], bundle=bundle_id)
+        recorded += 1
+    manifest.commit()
+    logging.info(f"Manifest rebuilt for {target}: {recorded} files recorded.")
+    return recorded
@@ -0,0 +1,236 @@
+import json
+import logging
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+RUN_SUMMARY_FILE = 'backup_runs.jsonl'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PREFIX = 'remotebackup_'
+
+# name: (type, help) for everything the exporter can show
+METRICS = {
+    'files_total': ('counter', 'Files processed, by backend and result.'),
+    'bytes_total': ('counter', 'Bytes of files processed, by backend and result.'),
+    'sent_bytes_total': ('counter', 'Bytes actually written to the destination.'),
+    'phase_seconds_total': ('counter', 'Time spent per phase; transfer time is summed over parallel workers.'),
+    'runs_total': ('counter', 'Completed backup runs.'),
+    'remote_call_seconds': ('histogram', 'Latency of remote SFTP calls.'),
+    'last_run_timestamp_seconds': ('gauge', 'Unix time the last run finished.'),
+    'last_run_duration_seconds': ('gauge', 'Wall-clock duration of the last run.'),
+    'last_run_throughput_bytes_per_second': ('gauge', 'Bytes sent per second during the last run.'),
+    'last_run_failed_files': ('gauge', 'Files that failed in the last run.'),
+    'peak_rss_bytes': ('gauge', 'Most memory the process has held at once, as of the last run.'),
+}
+
+class MetricsRegistry:
+    """Process-wide metric values, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = defaultdict(float)
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.values[(name, _label_key(labels))] += value
+
+    def set(self, name, labels, value):
+        with self.lock:
+            self.values[(name, _label_key(labels))] = value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            key = (name, _label_key(labels))
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * len(LATENCY_BUCKETS) + [0.0, 0]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: list(histogram) for key, histogram in self.histograms.items()}
+        lines = []
+        for name, (metric_type, help_text) in METRICS.items():
+            full_name = PREFIX + name
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {metric_type}")
+            for (value_name, labels), value in sorted(values.items()):
+                if value_name == name:
+                    lines.append(f"{full_name}{_format_labels(labels)} {_format_value(value)}")
+            for (value_name, labels), histogram in sorted(histograms.items()):
+                if value_name != name:
+                    continue
+                for bound, count in zip(LATENCY_BUCKETS, histogram):
+                    lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', f'{bound:g}'),))} {count}")
+                lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram[-1]}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {_format_value(histogram[-2])}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {histogram[-1]}")
+        return '\n'.join(lines) + '\n'
+
+def _format_value(value):
+    # %g would round large byte counts to six significant digits
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+REGISTRY = MetricsRegistry()
+
+class RunMetrics:
+    """Counters, phase timings and remote call latencies for one run of one backend.
+
+    Values are added to the registry as they happen, so /metrics shows a run in
+    progress, and finish() writes the run's totals as one line of JSON.
+    """
+
+    def __init__(self, backend, registry=REGISTRY):
+        self.backend = backend
+        self.registry = registry
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.start_clock = time.monotonic()
+        self.files = Counter()
+        self.bytes = Counter()
+        self.sent_bytes = 0
+        self.phases = defaultdict(float)
+        self.calls = {}
+
+    def count(self, result, size=0):
+        """Count a file as scanned, copied, skipped or failed."""
+        with self.lock:
+            self.files[result] += 1
+            self.bytes[result] += size
+        labels = {'backend': self.backend, 'result': result}
+        self.registry.inc('files_total', labels)
+        self.registry.inc('bytes_total', labels, size)
+
+    def sent(self, size):
+        """Count bytes written to the destination."""
+        with self.lock:
+            self.sent_bytes += size
+        self.registry.inc('sent_bytes_total', {'backend': self.backend}, size)
+
+    def add_phase(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] += seconds
+        self.registry.inc('phase_seconds_total', {'backend': self.backend, 'phase': phase}, seconds)
+
+    @contextmanager
+    def phase(self, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(phase, time.monotonic() - start)
+
+    def timed(self, phase, iterable):
+        """Yield from iterable, charging the time spent producing each item to phase."""
+        iterator = iter(iterable)
+        while True:
+            start = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_phase(phase, time.monotonic() - start)
+                return
+            self.add_phase(phase, time.monotonic() - start)
+            yield item
+
+    def observe_call(self, operation, seconds):
+        with self.lock:
+            calls = self.calls.setdefault(operation, [0, 0.0, 0.0])
+            calls[0] += 1
+            calls[1] += seconds
+            calls[2] = max(calls[2], seconds)
+        self.registry.observe('remote_call_seconds', {'backend': self.backend, 'operation': operation}, seconds)
+
+    def summary(self):
+        with self.lock:
+            duration = time.monotonic() - self.start_clock
+            return {
+                'backend': self.backend,
+                'started': self.started,
+                'duration_seconds': round(duration, 3),
+                'files': dict(self.files),
+                'bytes': dict(self.bytes),
+                'sent_bytes': self.sent_bytes,
+                'throughput_bytes_per_second': round(self.sent_bytes / duration) if duration else 0,
+                'phase_seconds': {phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+                'peak_rss_bytes': peak_rss(),
+                'remote_calls': {
+                    operation: {'count': count, 'mean_ms': round(total / count * 1000, 2), 'max_ms': round(longest * 1000, 2)}
+                    for operation, (count, total, longest) in self.calls.items()
+                },
+            }
+
+    def finish(self, summary_file=None):
+        """Publish last-run gauges and append the run summary to summary_file (RUN_SUMMARY_FILE by default)."""
+        summary = self.summary()
+        summary_file = summary_file or RUN_SUMMARY_FILE
+        labels = {'backend': self.backend}
+        self.registry.inc('runs_total', labels)
+        self.registry.set('last_run_timestamp_seconds', labels, time.time())
+        self.registry.set('last_run_duration_seconds', labels, summary['duration_seconds'])
+        self.registry.set('last_run_throughput_bytes_per_second', labels, summary['throughput_bytes_per_second'])
+        self.registry.set('last_run_failed_files', labels, summary['files'].get('failed', 0))
+        if summary['peak_rss_bytes']:
+            self.registry.set('peak_rss_bytes', {}, summary['peak_rss_bytes'])
+        try:
+            with open(summary_file, 'a') as summaries:
+                summaries.write(json.dumps(summary) + '\n')
+        except OSError as e:
+            logging.error(f"Failed to write run summary: {e}")
+        return summary
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, or None where it is not available."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == 'darwin' else peak * 1024
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    except (ImportError, AttributeError):
+        return None
+
+class InstrumentedSFTP:
+    """Proxy for an SFTP client that times every remote call into a RunMetrics."""
+
+    def __init__(self, sftp, metrics):
+        self.sftp = sftp
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self.sftp, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def timed(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                self.metrics.observe_call(name, time.monotonic() - start)
+        return timed
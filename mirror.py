@@ -0,0 +1,67 @@
+import logging
+import os
+import posixpath
+
+DEFAULT_MAX_DELETE_PERCENT = 10
+
+def source_missing(source_dir, relative_path):
+    """True only if a file is certainly gone from the source, not merely unreadable."""
+    try:
+        os.lstat(os.path.join(source_dir, *relative_path.split('/')))
+    except FileNotFoundError:
+        return True
+    except OSError:
+        return False
+    return False
+
+def deletions_allowed(vanished, total, max_percent=DEFAULT_MAX_DELETE_PERCENT):
+    """True if deleting vanished of total backed-up files stays within the safety limit.
+
+    A source folder that is unmounted or emptied by mistake would otherwise wipe
+    the backup, so a run that would delete more than max_percent deletes nothing.
+    """
+    if not vanished:
+        return False
+    if vanished > total * max_percent / 100:
+        logging.error(f"Not deleting {vanished} of {total} backed-up files: more than {max_percent}% of the backup. "
+                      f"Check the source folder, or raise mirror_max_delete_percent if this is intended.")
+        return False
+    return True
+
+def find_move(manifest, detector, target, source_dir, src_file, local_stat):
+    """Return the recorded path of a file gone from the source with the same contents as src_file, or None.
+
+    Candidates are narrowed by size first, so a new file is only hashed when an
+    earlier upload of the same size has disappeared.
+    """
+    if not local_stat.st_size:
+        return None
+    candidates = [(path, digest) for path, digest in manifest.move_candidates(target, local_stat.st_size)
+                  if source_missing(source_dir, path)]
+    if not candidates:
+        return None
+    digest = detector.digest(src_file, local_stat)
+    for path, candidate_digest in candidates:
+        if candidate_digest == digest:
+            return path
+    return None
+
+def remove_empty_dirs(remove_dir, relative_paths):
+    """Remove the folders left empty by deleting or moving relative_paths, deepest first.
+
+    remove_dir takes a folder relative to the backup root and raises OSError if it is not empty.
+    """
+    dirs = set()
+    for relative_path in relative_paths:
+        parent = posixpath.dirname(relative_path)
+        while parent:
+            dirs.add(parent)
+            parent = posixpath.dirname(parent)
+    removed = 0
+    for relative_dir in sorted(dirs, key=lambda path: path.count('/'), reverse=True):
+        try:
+            remove_dir(relative_dir)
+            removed += 1
+        except OSError:
+            continue
+    return removed
@@ -0,0 +1,185 @@
+import io
+import json
+import logging
+import posixpath
+import threading
+from datetime import datetime
+from compression import choose_codec
+from integrity import StreamHasher, hashing
+from payload import stored_base, stored_suffix, write_payload
+from resumable import PARTIAL_SUFFIX, partial_name, replace_remote
+from throttle import throttled
+
+PACKS_DIR = '.packs'
+PACK_SUFFIX = '.pack'
+INDEX_SUFFIX = '.index.json'
+DROP_SUFFIX = '.drop.json'
+DEFAULT_PACK_THRESHOLD = 256 * 1024  # files smaller than this are packed
+DEFAULT_BUNDLE_SIZE = 64 * 1024 * 1024
+MAX_BUNDLE_FILES = 10000  # files held back for one bundle, however small they are
+RUN_ID_FORMAT = '%Y%m%d-%H%M%S-%f'
+
+class Packer:
+    """Group small files into bundles as they are found, and track files that leave them.
+
+    Each full bundle is handed to submit_bundle(bundle_id, files) with files as
+    (src_file, relative_path, local_stat, stored_infos), so it can be uploaded as
+    one sequential write while the walk goes on. Bundle ids start with the run's
+    id and sort in the order they were written; a file that later leaves its
+    bundle, by being stored on its own or deleted, is listed in the run's drop
+    list, which sorts before the bundles of the same run.
+    """
+
+    def __init__(self, submit_bundle, bundle_size=DEFAULT_BUNDLE_SIZE):
+        self.submit_bundle = submit_bundle
+        self.bundle_size = bundle_size
+        self.run_id = datetime.now().strftime(RUN_ID_FORMAT)
+        self.bundles = 0
+        self.files = []
+        self.size = 0
+        self.dropped = []
+        self.lock = threading.Lock()
+
+    def add(self, src_file, relative_path, local_stat, stored_infos):
+        self.files.append((src_file, relative_path, local_stat, stored_infos))
+        self.size += local_stat.st_size
+        if self.size >= self.bundle_size or len(self.files) >= MAX_BUNDLE_FILES:
+            self.flush()
+
+    def flush(self):
+        """Hand over the files collected so far as a bundle of their own."""
+        if not self.files:
+            return
+        self.bundles += 1
+        files, self.files, self.size = self.files, [], 0
+        self.submit_bundle(f"{self.run_id}-{self.bundles:05}", files)
+
+    def drop(self, relative_path):
+        with self.lock:
+            self.dropped.append(relative_path)
+
+    @property
+    def changed(self):
+        return bool(self.bundles or self.dropped)
+
+    def finish(self, sftp, remote_dir, live_bundles):
+        """Write the run's drop list, then delete the bundles no recorded file is in any more.
+
+        A bundle is only deleted if neither the manifest nor the bundles' own
+        indexes and drop lists still place a file in it, so a lost or rebuilt
+        manifest, or a bundle whose files were never recorded, costs no data.
+        """
+        with self.lock:
+            dropped = sorted(self.dropped)
+        packs_dir = posixpath.join(remote_dir, PACKS_DIR)
+        if dropped:
+            write_json(sftp, posixpath.join(packs_dir, self.run_id + DROP_SUFFIX), {'id': self.run_id, 'dropped': dropped})
+        held = {bundle_id for bundle_id, _ in live_entries(sftp, remote_dir).values()}
+        unrecorded = held - set(live_bundles)
+        if unrecorded:
+            logging.warning(f"Keeping {len(unrecorded)} bundles that hold files the manifest does not place in them.")
+        return prune_bundles(sftp, packs_dir, held | set(live_bundles))
+
+def write_json(sftp, path, data):
+    partial_file = partial_name(path)
+    with sftp.open(partial_file, 'w') as data_file:
+        data_file.write(json.dumps(data))
+    replace_remote(sftp, partial_file, path)
+
+def write_bundle(sftp, pack_file, files, compression=None, encryption=None, throttle=None, verifier=None):
+    """Stream files one after another into pack_file, then write its index.
+
+    Each file is compressed and encrypted on its own, so it can be read back
+    without the rest of the bundle. The index is written last, so a bundle only
+    counts once it is complete. With a verifier (an integrity.RemoteHasher) the
+    bundle is checked against what was sent before it is moved into place.
+    Returns (entries, bytes written); files that could not be read are left out
+    of the entries.
+    """
+    entries = []
+    partial_file = partial_name(pack_file)
+    hasher = StreamHasher(verifier.kinds) if verifier else None
+    with sftp.open(partial_file, 'wb') as remote_file:
+        remote_file.set_pipelined(True)
+        writer = hashing(throttled(remote_file, throttle), hasher)
+        for src_file, relative_path, local_stat, _ in files:
+            offset = remote_file.tell()
+            codec = choose_codec(src_file, compression)
+            try:
+                length = write_payload(src_file, writer, codec, encryption)
+            except OSError as e:
+                # Whatever was written of it stays in the bundle, unreferenced
+                logging.error(f"Failed to pack {src_file}: {e}")
+                continue
+            entries.append({'path': relative_path, 'stored': stored_base(relative_path) + stored_suffix(codec, encryption),
+                            'codec': codec, 'offset': offset, 'length': length,
+                            'size': local_stat.st_size, 'mtime': local_stat.st_mtime})
+        written = remote_file.tell()
+    if verifier:
+        verifier.verify(sftp, partial_file, hasher.hexdigests())
+    replace_remote(sftp, partial_file, pack_file)
+    write_json(sftp, pack_file[:-len(PACK_SUFFIX)] + INDEX_SUFFIX, {'files': entries})
+    return entries, written
+
+def prune_bundles(sftp, packs_dir, live_bundles):
+    """Delete bundles outside live_bundles, unfinished uploads, and drop lists older than every bundle left.
+
+    Returns the number of bundles deleted.
+    """
+    try:
+        names = sftp.listdir(packs_dir)
+    except IOError:
+        return 0
+    removed = 0
+    for name in names:
+        if name.endswith(PARTIAL_SUFFIX):
+            sftp.remove(posixpath.join(packs_dir, name))
+            continue
+        for suffix in (PACK_SUFFIX, INDEX_SUFFIX):
+            # Includes packs whose index was never written, since nothing was recorded in them
+            if name.endswith(suffix) and name[:-len(suffix)] not in live_bundles:
+                sftp.remove(posixpath.join(packs_dir, name))
+                removed += suffix == PACK_SUFFIX
+    remaining = sorted(name[:-len(INDEX_SUFFIX)] for name in names
+                       if name.endswith(INDEX_SUFFIX) and name[:-len(INDEX_SUFFIX)] in live_bundles)
+    for name in names:
+        # A drop list only hides entries of bundles written before it
+        if name.endswith(DROP_SUFFIX) and (not remaining or name[:-len(DROP_SUFFIX)] < remaining[0]):
+            sftp.remove(posixpath.join(packs_dir, name))
+    if removed:
+        logging.info(f"Deleted {removed} bundles of small files that were replaced or removed.")
+    return removed
+
+def live_entries(sftp, remote_dir):
+    """Return {relative_path: (bundle_id, entry)} for the packed files no later bundle or drop list replaced.
+
+    This reads every index, so it is for restores, manifest rebuilds and runs
+    that are about to delete bundles; backups know where each file went from
+    the manifest.
+    """
+    packs_dir = posixpath.join(remote_dir, PACKS_DIR)
+    try:
+        names = sftp.listdir(packs_dir)
+    except IOError:
+        return {}
+    history = sorted((name[:-len(suffix)], suffix) for name in names for suffix in (INDEX_SUFFIX, DROP_SUFFIX)
+                     if name.endswith(suffix))
+    live = {}
+    for item_id, suffix in history:
+        with sftp.open(posixpath.join(packs_dir, item_id + suffix), 'r') as data_file:
+            data = json.loads(data_file.read())
+        if suffix == DROP_SUFFIX:
+            for relative_path in data['dropped']:
+                live.pop(relative_path, None)
+        else:
+            for entry in data['files']:
+                live[entry['path']] = (item_id, entry)
+    return live
+
+def open_packed(sftp, remote_dir, bundle_id, entry, offset=0):
+    """Return a readable file object of a packed file's stored bytes, starting offset bytes in."""
+    pack_file = posixpath.join(remote_dir, PACKS_DIR, bundle_id + PACK_SUFFIX)
+    with sftp.open(pack_file, 'rb') as bundle:
+        # One pipelined read of the file's range, not a download of the bundle
+        data = b''.join(bundle.readv([(entry['offset'] + offset, entry['length'] - offset)]))
+    return io.BytesIO(data)
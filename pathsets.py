@@ -0,0 +1,81 @@
+import heapq
+import json
+import os
+import tempfile
+
+SPILL_EVERY = 100000  # paths held in memory before a sorted run is written to disk
+
+class PathSet:
+    """A set of relative paths that moves to sorted files on disk as it grows.
+
+    Paths are kept in memory until there are spill_every of them, then sorted and
+    written out as a run. Iterating merges the runs, so even millions of paths are
+    read back in sorted order, each once, with only one path per run in memory.
+    len() counts the paths added, duplicates included.
+    """
+
+    def __init__(self, spill_every=SPILL_EVERY):
+        self.spill_every = spill_every
+        self.buffer = []
+        self.runs = []
+        self.count = 0
+        self.directory = None
+
+    def add(self, relative_path):
+        self.buffer.append(relative_path)
+        self.count += 1
+        if len(self.buffer) >= self.spill_every:
+            self._spill()
+
+    def _spill(self):
+        if self.directory is None:
+            self.directory = tempfile.TemporaryDirectory(prefix='remotebackup-paths-')
+        run_file = os.path.join(self.directory.name, f"{len(self.runs)}.run")
+        with open(run_file, 'w', encoding='utf-8') as run:
+            for relative_path in sorted(self.buffer):
+                # JSON keeps names with line breaks or undecodable bytes on one line
+                run.write(json.dumps(relative_path) + '\n')
+        self.runs.append(run_file)
+        self.buffer = []
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Yield the paths in sorted order, each once."""
+        previous = None
+        for relative_path in heapq.merge(sorted(self.buffer), *(_read_run(run_file) for run_file in self.runs)):
+            if relative_path != previous:
+                yield relative_path
+                previous = relative_path
+
+    def close(self):
+        if self.directory is not None:
+            self.directory.cleanup()
+            self.directory = None
+        self.buffer = []
+        self.runs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _read_run(run_file):
+    with open(run_file, encoding='utf-8') as run:
+        for line in run:
+            yield json.loads(line)
+
+def missing(paths, present):
+    """Yield the paths of sorted iterable paths that are not in sorted iterable present.
+
+    Both are read once, side by side (a merge join), so neither is held in memory.
+    """
+    present = iter(present)
+    current = next(present, None)
+    for path in paths:
+        while current is not None and current < path:
+            current = next(present, None)
+        if current != path:
+            yield path
@@ -0,0 +1,62 @@
+from collections import namedtuple
+from compression import COMPRESSED_SUFFIX, compress_chunks, decompress_chunks, read_chunks
+from stream_crypto import decrypt_chunks, encrypt_chunks
+
+ENCRYPTED_SUFFIX = '.rbe'
+# Added to source names that already end in a payload suffix, so they are not taken for transformed copies
+ESCAPED_SUFFIX = '.rbn'
+
+# Every name a file can be stored under; a run removes the ones it did not write
+STORED_SUFFIXES = ('', COMPRESSED_SUFFIX, ENCRYPTED_SUFFIX, COMPRESSED_SUFFIX + ENCRYPTED_SUFFIX)
+
+Encryption = namedtuple('Encryption', ['cipher', 'key'])
+
+def stored_suffix(codec=None, encryption=None):
+    """Suffix recording how a file's contents were transformed."""
+    return (COMPRESSED_SUFFIX if codec else '') + (ENCRYPTED_SUFFIX if encryption else '')
+
+def payload_chunks(src_file, codec=None, encryption=None):
+    """Yield the contents of src_file compressed and/or encrypted, in constant memory."""
+    with open(src_file, 'rb') as source:
+        chunks = read_chunks(source)
+        if codec:
+            chunks = compress_chunks(chunks, codec)
+        if encryption:
+            chunks = encrypt_chunks(chunks, encryption.key, encryption.cipher)
+        yield from chunks
+
+def write_payload(src_file, dest_obj, codec=None, encryption=None):
+    """Stream the transformed contents of src_file into a writable file object. Returns bytes written."""
+    written = 0
+    for data in payload_chunks(src_file, codec, encryption):
+        dest_obj.write(data)
+        written += len(data)
+    return written
+
+def stored_base(relative_path):
+    """Name a file's copies are stored under, before the payload suffix of each."""
+    if relative_path.endswith((COMPRESSED_SUFFIX, ENCRYPTED_SUFFIX, ESCAPED_SUFFIX)):
+        return relative_path + ESCAPED_SUFFIX
+    return relative_path
+
+def is_transformed(stored_name):
+    """True if a stored file's contents were compressed or encrypted."""
+    return stored_name.endswith((COMPRESSED_SUFFIX, ENCRYPTED_SUFFIX))
+
+def original_name(stored_name):
+    """Strip the payload suffixes, and the escape of stored_base, from a stored file name."""
+    for suffix in (ENCRYPTED_SUFFIX, COMPRESSED_SUFFIX, ESCAPED_SUFFIX):
+        if stored_name.endswith(suffix):
+            stored_name = stored_name[:-len(suffix)]
+    return stored_name
+
+def restore_chunks(chunks, stored_name, key=None):
+    """Undo the transformations recorded in stored_name on a stream of stored bytes."""
+    if stored_name.endswith(ENCRYPTED_SUFFIX):
+        if key is None:
+            raise ValueError(f"{stored_name} is encrypted and no key was given")
+        chunks = decrypt_chunks(chunks, key)
+        stored_name = stored_name[:-len(ENCRYPTED_SUFFIX)]
+    if stored_name.endswith(COMPRESSED_SUFFIX):
+        chunks = decompress_chunks(chunks)
+    return chunks
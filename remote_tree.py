@@ -0,0 +1,87 @@
+import logging
+import posixpath
+import stat
+import threading
+from collections import OrderedDict
+
+LISTING_CACHE_SIZE = 64
+
+class RemoteTree:
+    """Cache of the remote tree built from one listdir_attr call per directory.
+
+    Listings are loaded lazily and only the most recent ones are kept, since the
+    local walk visits one directory at a time. Directories known to exist are
+    remembered for the whole run so they are never checked or created twice.
+    """
+
+    def __init__(self, sftp, cache_size=LISTING_CACHE_SIZE):
+        self.sftp = sftp
+        self.cache_size = cache_size
+        self.listings = OrderedDict()
+        self.known_dirs = {'/'}
+        self.missing_dirs = set()
+        self.lock = threading.Lock()
+
+    def listing(self, remote_dir):
+        """Return {filename: attributes} for a remote directory, empty if it does not exist."""
+        remote_dir = normalize(remote_dir)
+        with self.lock:
+            if remote_dir in self.listings:
+                self.listings.move_to_end(remote_dir)
+                return self.listings[remote_dir]
+            missing = remote_dir in self.missing_dirs
+        entries = {}
+        if not missing:
+            try:
+                entries = {entry.filename: entry for entry in self.sftp.listdir_attr(remote_dir)}
+            except IOError:
+                missing = True
+        with self.lock:
+            if missing:
+                self.missing_dirs.add(remote_dir)
+            else:
+                self.known_dirs.add(remote_dir)
+                self.known_dirs.update(
+                    posixpath.join(remote_dir, name) for name, entry in entries.items() if stat.S_ISDIR(entry.st_mode or 0)
+                )
+            self.listings[remote_dir] = entries
+            if len(self.listings) > self.cache_size:
+                self.listings.popitem(last=False)
+        return entries
+
+    def stat(self, remote_path):
+        """Return the cached attributes of a remote file, or None if it does not exist."""
+        remote_path = normalize(remote_path)
+        return self.listing(posixpath.dirname(remote_path)).get(posixpath.basename(remote_path))
+
+    def ensure_dir(self, sftp, remote_dir):
+        """Create remote_dir and any missing parents, using sftp for the calls."""
+        remote_dir = normalize(remote_dir)
+        with self.lock:
+            if remote_dir in self.known_dirs:
+                return
+            path = ''
+            parent_missing = False
+            for part in remote_dir.split('/'):
+                if not part:
+                    continue
+                path += f'/{part}'
+                if path in self.known_dirs:
+                    continue
+                if not parent_missing and path not in self.missing_dirs:
+                    try:
+                        sftp.stat(path)
+                        self.known_dirs.add(path)
+                        continue
+                    except IOError:
+                        pass
+                sftp.mkdir(path)
+                logging.info(f"Created remote directory: {path}")
+                # Everything below a directory we just created is missing too
+                parent_missing = True
+                self.missing_dirs.discard(path)
+                self.listings.pop(path, None)
+                self.known_dirs.add(path)
+
+def normalize(remote_path):
+    return posixpath.normpath('/' + remote_path.replace('\\', '/').lstrip('/'))
@@ -0,0 +1,356 @@
+"""Restore files from a backup destination.
+
+Usage: python restore.py [--job NAME] [--from local|sftp] [--parallelism N] [--snapshot ID] PATTERN [PATTERN ...] TARGET_DIR
+       python restore.py [--job NAME] [--from local|sftp] --list-snapshots
+"""
+import argparse
+import fnmatch
+import logging
+import os
+import posixpath
+import threading
+from chunkstore import LocalChunkBackend, SFTPChunkBackend, restore_file
+from compression import read_chunks
+from jobs import job_configs
+from local_copy import copy_file_data
+from manifest import walk_remote
+from packs import live_entries, open_packed
+from payload import is_transformed, original_name, restore_chunks
+from remote_tree import RemoteTree, normalize as normalize_remote_path
+from resumable import PARTIAL_SUFFIX, finish_partial
+from sftp_pool import SFTPSessionPool
+from snapshots import LocalSnapshotStore, SFTPSnapshotStore
+from utils import load_key, load_config, derive_payload_key
+from workers import WorkerPool
+
+DEFAULT_PARALLELISM = 4
+
+def path_matches(relative_path, patterns):
+    """True if a backed-up path matches a glob or lies under a directory in patterns."""
+    if not patterns:
+        return True
+    for pattern in patterns:
+        pattern = pattern.replace('\\', '/').strip('/')
+        if not pattern or fnmatch.fnmatchcase(relative_path, pattern) or relative_path.startswith(pattern + '/'):
+            return True
+    return False
+
+def walk_local(backup_dir):
+    """Yield (relative_path, os.stat_result) for every file under backup_dir, one scandir per directory."""
+    pending = ['']
+    while pending:
+        relative_dir = pending.pop()
+        try:
+            entries = list(os.scandir(os.path.join(backup_dir, relative_dir)))
+        except OSError:
+            continue
+        for entry in entries:
+            relative_path = posixpath.join(relative_dir, entry.name) if relative_dir else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(relative_path)
+            elif entry.is_file(follow_symlinks=False):
+                yield relative_path, entry.stat()
+
+def is_restored(dest_file, size, mtime):
+    """True if an earlier run already finished dest_file; size is None when it is not known in advance."""
+    try:
+        dest_stat = os.stat(dest_file)
+    except OSError:
+        return False
+    return dest_stat.st_mtime == mtime and (size is None or dest_stat.st_size == size)
+
+def restore_stream(open_stored, stored_name, stored_size, dest_file, key=None):
+    """Stream a stored file into dest_file's partial file, decoding it on the way.
+
+    Plain copies resume from the end of an existing partial file; compressed or
+    encrypted copies can only be decoded from the start, so they begin again.
+    open_stored(offset) returns a readable file object positioned at offset.
+    """
+    partial_file = dest_file + PARTIAL_SUFFIX
+    transformed = is_transformed(stored_name)
+    offset = 0
+    if not transformed and os.path.exists(partial_file):
+        offset = min(os.path.getsize(partial_file), stored_size)
+    with open_stored(offset) as stored, open(partial_file, 'r+b' if offset else 'wb') as target:
+        target.seek(offset)
+        target.truncate()
+        chunks = read_chunks(stored)
+        if transformed:
+            chunks = restore_chunks(chunks, stored_name, key)
+        for data in chunks:
+            target.write(data)
+    if offset:
+        logging.info(f"Resumed {dest_file} at byte {offset}.")
+    return partial_file
+
+class Restorer:
+    """Restore the files of one backup destination that match a set of patterns."""
+
+    def __init__(self, target_dir, patterns=None, key=None):
+        self.target_dir = target_dir
+        self.patterns = patterns
+        self.key = key
+        self.counts = {"restored": 0, "skipped": 0, "failed": 0}
+        self.counts_lock = threading.Lock()
+
+    def count(self, result):
+        with self.counts_lock:
+            self.counts[result] += 1
+
+    def dest_file(self, relative_path):
+        dest_file = os.path.join(self.target_dir, *relative_path.split('/'))
+        os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+        return dest_file
+
+    def selected(self, stored_path):
+        """Return the original path of a stored file if it should be restored, otherwise None."""
+        if stored_path.endswith(PARTIAL_SUFFIX) or stored_path.endswith('.tmp'):
+            return None
+        relative_path = original_name(stored_path)
+        return relative_path if path_matches(relative_path, self.patterns) else None
+
+    def run(self, task):
+        """Wrap a restore callable so its outcome is counted and failures are logged."""
+        def counted(session):
+            try:
+                self.count("restored" if task(session) else "skipped")
+            except Exception as e:
+                logging.error(f"Restore failed: {e}")
+                self.count("failed")
+        return counted
+
+    def summary(self):
+        logging.info(f"Restore Completed: {self.counts['restored']} files restored, {self.counts['skipped']} files skipped, "
+                     f"{self.counts['failed']} files failed.")
+        return dict(self.counts)
+
+def restore_from_sftp(restorer, remote_dir, host, port, username, password, parallelism=DEFAULT_PARALLELISM, chunks=False,
+                      snapshot=None):
+    """Download matching files from an SFTP backup, or one of its snapshots, several at a time."""
+    logging.info("Connecting to SFTP...")
+    pool = SFTPSessionPool(host, port, username, password)
+    try:
+        sftp = pool.open_session()
+        remote_dir = normalize_remote_path(remote_dir)
+        tree = RemoteTree(sftp)
+
+        def download(location, stored_path, attributes, relative_path):
+            remote_file = posixpath.join(remote_dir, location)
+
+            def task(worker_sftp):
+                dest_file = restorer.dest_file(relative_path)
+                transformed = is_transformed(stored_path)
+                if is_restored(dest_file, None if transformed else attributes.st_size, attributes.st_mtime):
+                    return False
+
+                def open_stored(offset):
+                    stored = worker_sftp.open(remote_file, 'rb')
+                    stored.seek(offset)
+                    # Keep many reads in flight so latency does not cap throughput
+                    stored.prefetch(attributes.st_size)
+                    return stored
+
+                partial_file = restore_stream(open_stored, stored_path, attributes.st_size, dest_file, restorer.key)
+                finish_partial(partial_file, dest_file, attributes.st_mtime)
+                logging.debug(f"Restored: {remote_file} to {dest_file}")
+                return True
+            return task
+
+        def extract(bundle_id, entry, relative_path):
+            def task(worker_sftp):
+                dest_file = restorer.dest_file(relative_path)
+                if is_restored(dest_file, entry['size'], entry['mtime']):
+                    return False
+
+                def open_stored(offset):
+                    return open_packed(worker_sftp, remote_dir, bundle_id, entry, offset)
+
+                partial_file = restore_stream(open_stored, entry['stored'], entry['length'], dest_file, restorer.key)
+                finish_partial(partial_file, dest_file, entry['mtime'])
+                logging.debug(f"Restored: {relative_path} from bundle {bundle_id} to {dest_file}")
+                return True
+            return task
+
+        def rebuild(relative_path):
+            def task(worker_sftp):
+                backend = SFTPChunkBackend(worker_sftp, remote_dir, tree, create=False)
+                return rebuild_from_chunks(backend, relative_path, restorer.dest_file(relative_path))
+            return task
+
+        # The listing feeds a bounded queue, so downloads start before it finishes
+        workers = WorkerPool(parallelism, pool.open_session, 'sftp-restore')
+        try:
+            if chunks:
+                try:
+                    sftp.stat(posixpath.join(remote_dir, 'files'))
+                except IOError:
+                    raise FileNotFoundError(f"No chunk store at {remote_dir}")
+                for recipe_path, _ in walk_remote(sftp, posixpath.join(remote_dir, 'files')):
+                    relative_path = recipe_path[:-len('.json')]
+                    if recipe_path.endswith('.json') and path_matches(relative_path, restorer.patterns):
+                        workers.submit(restorer.run(rebuild(relative_path)))
+            else:
+                # Small files may be packed into bundles; snapshots are never packed
+                packed = live_entries(sftp, remote_dir) if snapshot is None else {}
+                for location, stored_path, attributes in SFTPSnapshotStore(sftp, remote_dir, tree).files(snapshot):
+                    relative_path = restorer.selected(stored_path)
+                    if not relative_path:
+                        continue
+                    # Of a packed copy and one stored on its own, the newer is the file's latest backup
+                    bundle_id, entry = packed.get(relative_path, (None, None))
+                    if entry is not None and int(entry['mtime']) > (attributes.st_mtime or 0):
+                        continue
+                    packed.pop(relative_path, None)
+                    workers.submit(restorer.run(download(location, stored_path, attributes, relative_path)))
+                for relative_path, (bundle_id, entry) in packed.items():
+                    if path_matches(relative_path, restorer.patterns):
+                        workers.submit(restorer.run(extract(bundle_id, entry, relative_path)))
+        finally:
+            workers.join()
+    finally:
+        pool.close()
+    return restorer.summary()
+
+def restore_from_local(restorer, backup_dir, parallelism=DEFAULT_PARALLELISM, chunks=False, snapshot=None):
+    """Copy matching files back from a local backup folder, or one of its snapshots."""
+    def copy(location, stored_path, stored_stat, relative_path):
+        def task(session):
+            stored_file = os.path.join(backup_dir, *location.split('/'))
+            dest_file = restorer.dest_file(relative_path)
+            transformed = is_transformed(stored_path)
+            if is_restored(dest_file, None if transformed else stored_stat.st_size, stored_stat.st_mtime):
+                return False
+            if transformed:
+                def open_stored(offset):
+                    stored = open(stored_file, 'rb')
+                    stored.seek(offset)
+                    return stored
+                partial_file = restore_stream(open_stored, stored_path, stored_stat.st_size, dest_file, restorer.key)
+            else:
+                # A local copy is fast enough to redo, and the kernel copy beats resuming by hand
+                partial_file = dest_file + PARTIAL_SUFFIX
+                copy_file_data(stored_file, partial_file)
+            finish_partial(partial_file, dest_file, stored_stat.st_mtime)
+            logging.debug(f"Restored: {stored_file} to {dest_file}")
+            return True
+        return task
+
+    def rebuild(backend, relative_path):
+        def task(session):
+            return rebuild_from_chunks(backend, relative_path, restorer.dest_file(relative_path))
+        return task
+
+    workers = WorkerPool(parallelism, name='local-restore')
+    try:
+        if chunks:
+            if not os.path.isdir(os.path.join(backup_dir, 'files')):
+                raise FileNotFoundError(f"No chunk store at {backup_dir}")
+            backend = LocalChunkBackend(backup_dir, create=False)
+            for recipe_path, _ in walk_local(os.path.join(backup_dir, 'files')):
+                relative_path = recipe_path[:-len('.json')]
+                if recipe_path.endswith('.json') and path_matches(relative_path, restorer.patterns):
+                    workers.submit(restorer.run(rebuild(backend, relative_path)))
+        else:
+            for location, stored_path, stored_stat in LocalSnapshotStore(backup_dir).files(snapshot):
+                relative_path = restorer.selected(stored_path)
+                if relative_path:
+                    workers.submit(restorer.run(copy(location, stored_path, stored_stat, relative_path)))
+    finally:
+        workers.join()
+    return restorer.summary()
+
+def rebuild_from_chunks(backend, relative_path, dest_file):
+    """Rebuild one file from a chunk store unless an earlier run already did."""
+    recipe = backend.get_recipe(relative_path)
+    if recipe is None:
+        raise FileNotFoundError(relative_path)
+    if is_restored(dest_file, recipe["size"], recipe["mtime"]):
+        return False
+    restore_file(backend, relative_path, dest_file, recipe)
+    return True
+
+def restore_backup(config, patterns, target_dir, source=None, parallelism=None, key=None, snapshot=None):
+    """Restore files matching patterns from the configured backup, or one of its snapshots, into target_dir."""
+    source = source or default_source(config)
+    payload_key = derive_payload_key(key) if key else None
+    restorer = Restorer(target_dir, patterns, payload_key)
+    os.makedirs(target_dir, exist_ok=True)
+    snapshot_text = f"snapshot {snapshot} of " if snapshot else ""
+    logging.info(f"Restoring {', '.join(patterns) or 'everything'} from {snapshot_text}the {source} backup to {target_dir}...")
+    if source == 'sftp':
+        return restore_from_sftp(restorer, config.get('remote_backup_directory'), config.get('remote_host'),
+                                 config.get('remote_port'), config.get('remote_username'), config.get('remote_password'),
+                                 parallelism=parallelism or config.get('remote_parallelism') or DEFAULT_PARALLELISM,
+                                 chunks=config.get('remote_backup_format') == 'chunks', snapshot=snapshot)
+    return restore_from_local(restorer, config.get('local_backup_folder'),
+                              parallelism=parallelism or config.get('local_parallelism') or DEFAULT_PARALLELISM,
+                              chunks=config.get('local_backup_format') == 'chunks', snapshot=snapshot)
+
+def default_source(config):
+    return 'sftp' if config.get('sftp_sync', False) else 'local'
+
+def list_backup_snapshots(config, source=None):
+    """Return [(snapshot_id, files_changed)] for the configured backup, oldest first."""
+    source = source or default_source(config)
+    if source == 'local':
+        store = LocalSnapshotStore(config.get('local_backup_folder'))
+        return [(snapshot_id, len(store.read_snapshot(snapshot_id)['changed'])) for snapshot_id in store.list_snapshots()]
+    pool = SFTPSessionPool(config.get('remote_host'), config.get('remote_port'), config.get('remote_username'),
+                           config.get('remote_password'))
+    try:
+        sftp = pool.open_session()
+        store = SFTPSnapshotStore(sftp, normalize_remote_path(config.get('remote_backup_directory')), RemoteTree(sftp))
+        return [(snapshot_id, len(store.read_snapshot(snapshot_id)['changed'])) for snapshot_id in store.list_snapshots()]
+    finally:
+        pool.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Restore files from a RemoteBackup destination")
+    parser.add_argument('patterns', nargs='*', metavar='PATTERN',
+                        help="relative path, folder or glob to restore (default: everything)")
+    parser.add_argument('target_dir', nargs='?', metavar='TARGET_DIR', help="folder to restore into")
+    parser.add_argument('--job', help="backup job to restore from (needed when the configuration has several)")
+    parser.add_argument('--from', dest='source', choices=('local', 'sftp'),
+                        help="backup to restore from (default: sftp when enabled, otherwise local)")
+    parser.add_argument('--parallelism', type=int, help="files to transfer at once")
+    parser.add_argument('--snapshot', metavar='ID', help="restore the files as they were in this snapshot")
+    parser.add_argument('--list-snapshots', action='store_true', help="list the backup's snapshots and exit")
+    args = parser.parse_args()
+    if args.target_dir is None and args.patterns:
+        # PATTERN takes every positional it can, so the target is the last of them
+        args.target_dir = args.patterns.pop()
+    if not args.list_snapshots and not args.target_dir:
+        parser.error("TARGET_DIR is required")
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    key = load_key()
+    config = load_config(key)
+    if not config:
+        logging.error("Failed to load configuration.")
+        return 1
+    try:
+        jobs = dict(job_configs(config))
+    except ValueError as e:
+        logging.error(f"Invalid job configuration: {e}")
+        return 1
+    if args.job is None and len(jobs) > 1:
+        logging.error(f"Choose a backup job with --job: {', '.join(jobs)}")
+        return 1
+    if args.job is not None and args.job not in jobs:
+        logging.error(f"No backup job {args.job}; jobs: {', '.join(jobs)}")
+        return 1
+    config = jobs[args.job] if args.job else next(iter(jobs.values()))
+    if args.list_snapshots:
+        for snapshot_id, changed in list_backup_snapshots(config, args.source):
+            print(f"{snapshot_id}  {changed} files changed")
+        return 0
+    try:
+        counts = restore_backup(config, args.patterns, args.target_dir, args.source, args.parallelism, key, args.snapshot)
+    except (ValueError, OSError) as e:
+        logging.error(f"Restore failed: {e}")
+        return 1
+    print(f"{counts['restored']} restored, {counts['skipped']} already present, {counts['failed']} failed.")
+    return 1 if counts['failed'] else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
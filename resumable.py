@@ -0,0 +1,62 @@
+import logging
+import os
+from integrity import hashing
+from throttle import throttled
+
+PARTIAL_SUFFIX = '.part'
+READ_SIZE = 1024 * 1024
+
+def partial_name(dest_file):
+    """Name a file is uploaded under until it is complete."""
+    return dest_file + PARTIAL_SUFFIX
+
+def resumable_put(sftp, src_file, partial_file, offset=0, throttle=None, hasher=None):
+    """Send src_file to partial_file, starting at offset if an earlier attempt got that far.
+
+    Returns the number of bytes sent. Raises IOError if the remote copy does not end
+    up the same size as the local file. With a hasher, the whole file is hashed as it is read.
+    """
+    sent = 0
+    with open(src_file, 'rb') as source, sftp.open(partial_file, 'r+' if offset else 'wb') as remote_file:
+        remote_file.set_pipelined(True)
+        source = hashing(source, hasher)
+        if offset:
+            if hasher:
+                # Read rather than skip what an earlier attempt sent, so the digest covers the whole file
+                while source.tell() < offset and source.read(min(READ_SIZE, offset - source.tell())):
+                    pass
+            else:
+                source.seek(offset)
+            remote_file.seek(offset)
+            remote_file.truncate(offset)
+        destination = throttled(remote_file, throttle)
+        while True:
+            data = source.read(READ_SIZE)
+            if not data:
+                break
+            destination.write(data)
+            sent += len(data)
+        expected_size = source.tell()
+    # The size seen by the server is the last confirmed offset
+    remote_size = sftp.stat(partial_file).st_size
+    if remote_size != expected_size:
+        raise IOError(f"{partial_file} is {remote_size} bytes after upload, expected {expected_size}")
+    return sent
+
+def replace_remote(sftp, partial_file, dest_file):
+    """Move a completed upload into place in one step, so dest_file is never seen half-written."""
+    try:
+        sftp.posix_rename(partial_file, dest_file)
+    except IOError as e:
+        # Servers without the posix-rename extension refuse to overwrite an existing file
+        logging.debug(f"posix_rename unavailable ({e}), removing {dest_file} before renaming.")
+        try:
+            sftp.remove(dest_file)
+        except IOError:
+            pass
+        sftp.rename(partial_file, dest_file)
+
+def finish_partial(partial_file, dest_file, mtime):
+    """Move a completed partial file into place, stamped with the backup's modification time."""
+    os.replace(partial_file, dest_file)
+    os.utime(dest_file, (mtime, mtime))
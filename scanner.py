@@ -0,0 +1,246 @@
+import fnmatch
+import logging
+import os
+import posixpath
+import queue
+import threading
+from collections import OrderedDict, namedtuple
+
+SCAN_WORKERS = 4
+SCAN_QUEUE_SIZE = 64  # batches of files, each from one directory
+SCAN_BATCH_FILES = 256  # so a huge directory does not fill memory while it waits for the consumer
+LISTING_CACHE_SIZE = 64
+POLL_SECONDS = 0.1
+
+# path is the file to open, relative_path its name under the source with '/' separators
+SourceFile = namedtuple('SourceFile', ['path', 'relative_path', 'stat'])
+
+class FileStat:
+    """The fields of an os.stat_result a backup uses, in half the memory.
+
+    Every file waiting in a queue carries one, so a bounded queue of them stays small.
+    """
+
+    __slots__ = ('st_size', 'st_mtime', 'st_atime', 'st_mtime_ns', 'st_dev', 'st_ino')
+
+    def __init__(self, stat_result):
+        self.st_size = stat_result.st_size
+        self.st_mtime = stat_result.st_mtime
+        self.st_atime = stat_result.st_atime
+        self.st_mtime_ns = stat_result.st_mtime_ns
+        self.st_dev = stat_result.st_dev
+        self.st_ino = stat_result.st_ino
+
+def _split(pattern):
+    parts = [part for part in pattern.replace('\\', '/').split('/') if part]
+    # Like .gitignore, a pattern without a folder matches the name at any depth
+    return parts if len(parts) > 1 else ['**'] + parts
+
+def _matches(parts, pattern):
+    if not pattern:
+        return not parts
+    if pattern[0] == '**':
+        return any(_matches(parts[index:], pattern[1:]) for index in range(len(parts) + 1))
+    return bool(parts) and fnmatch.fnmatch(parts[0], pattern[0]) and _matches(parts[1:], pattern[1:])
+
+def _may_match_below(parts, pattern):
+    # True if some path strictly below the folder parts could match pattern
+    for index, part in enumerate(parts):
+        if index >= len(pattern):
+            return False
+        if pattern[index] == '**':
+            return True
+        if not fnmatch.fnmatch(part, pattern[index]):
+            return False
+    return len(pattern) > len(parts)
+
+class PathFilter:
+    """Include and exclude glob rules for relative paths.
+
+    A pattern containing '/' is matched against the whole relative path, and '**'
+    matches any number of folders; a pattern without one matches a name at any
+    depth. A pattern that matches a folder covers everything below it. A path is
+    backed up if it matches no exclude rule and, when there are include rules, at
+    least one of those.
+    """
+
+    def __init__(self, include=None, exclude=None):
+        self.include = [_split(pattern) for pattern in include or []]
+        self.exclude = [_split(pattern) for pattern in exclude or []]
+
+    def excluded(self, relative_path):
+        parts = relative_path.split('/')
+        return any(_matches(parts, pattern) for pattern in self.exclude)
+
+    def included(self, relative_path):
+        parts = relative_path.split('/')
+        return not self.include or any(_matches(parts, pattern) for pattern in self.include)
+
+    def may_include_below(self, relative_dir):
+        """True if a folder that is not itself included may still hold included files."""
+        parts = relative_dir.split('/')
+        return any(_may_match_below(parts, pattern) for pattern in self.include)
+
+    def folder_state(self, relative_dir):
+        """Return (walk, included) for a folder: whether to walk it at all, and whether all of it is included."""
+        included = not self.include
+        ancestor = ''
+        for part in [part for part in relative_dir.split('/') if part]:
+            ancestor = f"{ancestor}/{part}" if ancestor else part
+            if self.excluded(ancestor):
+                return False, False
+            included = included or self.included(ancestor)
+        return included or not relative_dir or self.may_include_below(relative_dir), included
+
+    def accepts(self, relative_path):
+        """Check a single file against the rules, including those for the folders above it."""
+        walk, included = self.folder_state(posixpath.dirname(relative_path))
+        return walk and not self.excluded(relative_path) and (included or self.included(relative_path))
+
+ALL_FILES = PathFilter()
+
+def scan_dir(source_dir, relative_dir, included, path_filter=ALL_FILES):
+    """List one folder with a single scandir: return ([(subdir, included)], [SourceFile])."""
+    folder = os.path.join(source_dir, *relative_dir.split('/')) if relative_dir else source_dir
+    subdirs, files = [], []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                if path_filter.exclude and path_filter.excluded(relative_path):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdir_included = included or path_filter.included(relative_path)
+                        if subdir_included or path_filter.may_include_below(relative_path):
+                            subdirs.append((relative_path, subdir_included))
+                    elif entry.is_file() and (included or path_filter.included(relative_path)):
+                        # Free from the directory listing on Windows; one stat elsewhere
+                        files.append(SourceFile(entry.path, relative_path, FileStat(entry.stat())))
+                except OSError as e:
+                    logging.error(f"Source file does not exist: {entry.path} ({e})")
+    except OSError as e:
+        logging.error(f"Failed to scan {folder}: {e}")
+    return subdirs, files
+
+def scan(source_dir, path_filter=ALL_FILES, workers=SCAN_WORKERS, start=''):
+    """Yield a SourceFile for every file under source_dir (or its folder start) that the filter accepts.
+
+    Folders are listed by a pool of threads, so a large tree on a network share
+    is read several folders at a time, and files are handed over one folder at a
+    time through a bounded queue while the scan goes on. Excluded folders are
+    never opened.
+    """
+    walk, included = path_filter.folder_state(start)
+    if not walk:
+        return
+    if workers <= 1:
+        pending = [(start, included)]
+        while pending:
+            subdirs, files = scan_dir(source_dir, *pending.pop(), path_filter)
+            pending.extend(subdirs)
+            yield from files
+        return
+    scanner = ParallelScan(source_dir, path_filter, workers)
+    try:
+        yield from scanner.run(start, included)
+    finally:
+        scanner.stop()
+
+class ParallelScan:
+    """Folder listing spread over threads, with the files streamed back to one consumer."""
+
+    def __init__(self, source_dir, path_filter, workers):
+        self.source_dir = source_dir
+        self.path_filter = path_filter
+        self.workers = workers
+        # Last in, first out: the scan goes deep before wide, so few folders wait at a time
+        self.dirs = queue.LifoQueue()
+        self.batches = queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.stopped = threading.Event()
+
+    def run(self, start, included):
+        self.pending = 1
+        self.dirs.put((start, included))
+        for index in range(self.workers):
+            threading.Thread(target=self._work, name=f"scan-{index}", daemon=True).start()
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            yield from batch
+
+    def _work(self):
+        while not self.stopped.is_set():
+            try:
+                folder = self.dirs.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if folder is None:
+                return
+            subdirs, files = scan_dir(self.source_dir, *folder, self.path_filter)
+            with self.lock:
+                self.pending += len(subdirs)
+            for subdir in subdirs:
+                self.dirs.put(subdir)
+            for start in range(0, len(files), SCAN_BATCH_FILES):
+                self._put(files[start:start + SCAN_BATCH_FILES])
+            with self.lock:
+                self.pending -= 1
+                finished = self.pending == 0
+            if finished:
+                self._put(None)
+                for _ in range(self.workers):
+                    self.dirs.put(None)
+
+    def _put(self, batch):
+        # Give up if the consumer went away, rather than blocking forever on a full queue
+        while not self.stopped.is_set():
+            try:
+                self.batches.put(batch, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def stop(self):
+        self.stopped.set()
+
+class ListingCache:
+    """Stat results from one scandir per local folder, for checking many names in the same folders."""
+
+    def __init__(self, cache_size=LISTING_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.listings = OrderedDict()
+        self.lock = threading.Lock()
+
+    def listing(self, folder):
+        with self.lock:
+            if folder in self.listings:
+                self.listings.move_to_end(folder)
+                return self.listings[folder]
+        try:
+            with os.scandir(folder) as entries:
+                listing = {entry.name: entry for entry in entries}
+        except OSError:
+            listing = {}
+        with self.lock:
+            self.listings[folder] = listing
+            if len(self.listings) > self.cache_size:
+                self.listings.popitem(last=False)
+        return listing
+
+    def stat(self, path):
+        """Return the stat result of a file as of its folder's listing, or None if it did not exist."""
+        listing = self.listing(os.path.dirname(path))
+        entry = listing.get(os.path.basename(path))
+        if entry is None or isinstance(entry, FileStat):
+            return entry
+        try:
+            file_stat = FileStat(entry.stat())
+        except OSError:
+            return None
+        # A DirEntry keeps its whole stat result; the cache keeps only what is needed
+        listing[os.path.basename(path)] = file_stat
+        return file_stat
@@ -0,0 +1,81 @@
+import logging
+import time
+from datetime import datetime, timedelta
+from scanner import PathFilter
+
+TRANSFER_ORDERS = ('walk', 'smallest_first', 'interleave')
+SCHEDULE_WINDOW = 10000  # queued transfers the order is chosen from
+
+class TransferPolicy:
+    """Which queued transfer starts next, and when to stop starting them.
+
+    order is 'walk' (the order files are found in), 'smallest_first', or
+    'interleave', where one stream works through the largest files while the
+    others take the smallest. priority is a list of glob patterns, most urgent
+    first; files matching an earlier pattern are always started before the
+    rest. deadline is a time.time() value after which no new transfer starts,
+    and cancel a threading.Event that stops new transfers once it is set.
+    """
+
+    def __init__(self, order='walk', priority=None, deadline=None, cancel=None):
+        if order not in TRANSFER_ORDERS:
+            raise ValueError(f"Unknown transfer order {order}; use one of {', '.join(TRANSFER_ORDERS)}")
+        self.order = order
+        self.priority = [PathFilter(include=[pattern]) for pattern in priority or []]
+        self.deadline = deadline
+        self.cancel = cancel
+
+    @property
+    def reorders(self):
+        return self.order != 'walk' or bool(self.priority)
+
+    def rank(self, relative_path):
+        """Index of the first priority pattern the path matches; unmatched paths come last."""
+        for index, rule in enumerate(self.priority):
+            if rule.accepts(relative_path):
+                return index
+        return len(self.priority)
+
+    def key(self, relative_path, size, sequence):
+        if self.order == 'walk':
+            return (self.rank(relative_path), 0, sequence)
+        return (self.rank(relative_path), size, sequence)
+
+    def expired(self):
+        return (self.cancel is not None and self.cancel.is_set()) or \
+            (self.deadline is not None and time.time() >= self.deadline)
+
+    @property
+    def stop_reason(self):
+        return 'cancelled' if self.cancel is not None and self.cancel.is_set() else 'deadline reached'
+
+
+WALK_ORDER = TransferPolicy()
+
+def parse_deadline(value, now=None):
+    """Return the time.time() of the next occurrence of an 'HH:MM' time of day."""
+    now = now or datetime.now()
+    hour, minute = (int(part) for part in value.split(':'))
+    deadline = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if deadline <= now:
+        deadline += timedelta(days=1)
+    return deadline.timestamp()
+
+def create_policy(config, now=None, cancel=None):
+    """Build the transfer policy of a run that starts now, from the configuration."""
+    now = now or datetime.now()
+    deadlines = []
+    if config.get('run_deadline'):
+        deadlines.append(parse_deadline(config['run_deadline'], now))
+    if config.get('max_run_minutes'):
+        deadlines.append((now + timedelta(minutes=config['max_run_minutes'])).timestamp())
+    deadline = min(deadlines) if deadlines else None
+    if deadline is not None:
+        logging.info(f"No new transfers will start after {datetime.fromtimestamp(deadline):%Y-%m-%d %H:%M}.")
+    return TransferPolicy(config.get('transfer_order', 'walk'), config.get('transfer_priority'), deadline, cancel)
+
+def log_stopped(title, reason, deferred, deferred_bytes, walk_finished):
+    """Report what a run stopped early, at its deadline or when cancelled, left for the next one."""
+    rest = "" if walk_finished else ", and the rest of the source was not checked"
+    logging.info(f"{title}: {reason}; {deferred} queued files ({deferred_bytes} bytes) were not started{rest}. "
+                 f"They will be backed up by the next run.")
@@ -109,7 +109,7 @@ def prompt_user_for_config_gui():
     tk.Entry(root, textvariable=remote_password_var, width=50, show="*").pack(anchor="w", padx=10, pady=2)
 
     # Schedule Interval
-    tk.Label(root, text="Schedule Interval (daily/weekly/custom):").pack(anchor="w", padx=10, pady=2)
+    tk.Label(root, text="Schedule Interval (daily/weekly/custom/watch):").pack(anchor="w", padx=10, pady=2)
     schedule_interval_var = tk.StringVar()
     tk.Entry(root, textvariable=schedule_interval_var, width=50).pack(anchor="w", padx=10, pady=2)
 
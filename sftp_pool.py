@@ -0,0 +1,55 @@
+import logging
+import threading
+import paramiko
+from metrics import InstrumentedSFTP
+from workers import WorkerPool
+
+class SFTPSessionPool:
+    """Open SFTP sessions as extra channels on one SSH transport where the server allows it."""
+
+    def __init__(self, host, port, username, password, metrics=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.metrics = metrics
+        self.clients = [self._connect()]
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(self.host, self.port, self.username, self.password)
+        return ssh
+
+    def open_session(self):
+        """Open a new SFTP session, falling back to a new connection if the server refuses another channel."""
+        with self.lock:
+            try:
+                sftp = self.clients[0].open_sftp()
+            except (paramiko.ChannelException, paramiko.SSHException) as e:
+                logging.info(f"Server refused another SFTP channel ({e}), opening a new connection.")
+                ssh = self._connect()
+                self.clients.append(ssh)
+                sftp = ssh.open_sftp()
+            self.sessions.append(sftp)
+            return InstrumentedSFTP(sftp, self.metrics) if self.metrics else sftp
+
+    def close(self):
+        with self.lock:
+            for sftp in self.sessions:
+                try:
+                    sftp.close()
+                except Exception:
+                    pass
+            for ssh in self.clients:
+                ssh.close()
+            self.sessions = []
+            self.clients = []
+
+class UploadWorkers(WorkerPool):
+    """Run upload tasks, each worker with its own SFTP session from the pool."""
+
+    def __init__(self, pool, parallelism, queue_size=None, policy=None):
+        super().__init__(parallelism, pool.open_session, 'sftp-upload', queue_size, policy)
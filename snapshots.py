@@ -0,0 +1,310 @@
+import json
+import logging
+import os
+import posixpath
+import shutil
+import stat
+import threading
+import time
+from datetime import datetime
+from manifest import walk_remote
+from packs import PACKS_DIR
+from payload import original_name
+
+SNAPSHOTS_DIR = '.snapshots'
+VERSIONS_DIR = '.versions'
+SNAPSHOT_ID_FORMAT = '%Y%m%d-%H%M%S'
+DEFAULT_RETENTION = {'daily': 7, 'weekly': 4, 'monthly': 12}
+# Retention rule: how snapshot times are grouped into periods
+RETENTION_PERIODS = {
+    'hourly': '%Y-%m-%d %H',
+    'daily': '%Y-%m-%d',
+    'weekly': '%G-W%V',
+    'monthly': '%Y-%m',
+    'yearly': '%Y',
+}
+
+def snapshot_time(snapshot_id):
+    return datetime.strptime(snapshot_id[:15], SNAPSHOT_ID_FORMAT)
+
+def snapshots_to_keep(snapshot_ids, retention):
+    """Return the snapshot ids a retention policy keeps.
+
+    retention maps a period ('daily', 'weekly', ...) to how many of the most recent
+    periods keep their newest snapshot, and 'last' to a number of newest snapshots
+    kept regardless. The newest snapshot is always kept; without any rules, all are.
+    """
+    ordered = sorted(snapshot_ids, reverse=True)
+    if not any(retention.get(rule) for rule in ('last', *RETENTION_PERIODS)):
+        return set(ordered)
+    keep = set(ordered[:max(1, retention.get('last', 0))])
+    for period, period_format in RETENTION_PERIODS.items():
+        periods = set()
+        for snapshot_id in ordered:
+            if len(periods) >= retention.get(period, 0):
+                break
+            key = snapshot_time(snapshot_id).strftime(period_format)
+            if key not in periods:
+                periods.add(key)
+                keep.add(snapshot_id)
+    return keep
+
+def version_dir_name(first, last):
+    return f"{first}_{last}"
+
+def parse_version_dir(name):
+    """Return the (first, last) snapshot ids a versions directory covers, or None."""
+    first, separator, last = name.partition('_')
+    return (first, last) if separator and first and last else None
+
+class SnapshotStore:
+    """Point-in-time snapshots of a mirrored backup.
+
+    The mirror itself always holds the newest copy of every file, so a file that
+    did not change is shared by every snapshot without being copied or linked.
+    When a run replaces a copy, the old one is moved (never copied) to
+    .versions/<first>_<last>/, named for the range of snapshots it belonged to,
+    and each run that changed something writes .snapshots/<id>.json listing the
+    files it wrote. A run therefore costs time and space only for what changed,
+    and a range of versions is deleted once retention keeps no snapshot in it.
+    """
+
+    def __init__(self):
+        self.id = None
+        self.previous = None
+        self.oldest = None
+        self.changed = []
+        self.lock = threading.Lock()
+
+    def begin(self, now=None):
+        """Choose the id of the snapshot this run creates."""
+        ids = self.list_snapshots()
+        self.previous = ids[-1] if ids else None
+        self.oldest = ids[0] if ids else None
+        snapshot_id = (now or datetime.now()).strftime(SNAPSHOT_ID_FORMAT)
+        if self.previous is not None and snapshot_id <= self.previous:
+            # Ids sort in time order; keep them increasing if the clock did not move on
+            counter = int(self.previous[16:] or 0) + 1
+            snapshot_id = f"{self.previous[:15]}-{counter:03}"
+        self.id = snapshot_id
+        self.changed = []
+        return snapshot_id
+
+    def retire(self, session, stored_path, first):
+        """Move the copy at stored_path into the versions of the earlier snapshots that contain it.
+
+        first is the snapshot that wrote the copy (None if unknown). Returns False,
+        leaving the copy in place, if no earlier snapshot exists to keep it for.
+        """
+        if self.previous is None:
+            return False
+        if first is None or not self.oldest <= first <= self.previous:
+            first = self.oldest
+        version_path = posixpath.join(VERSIONS_DIR, version_dir_name(first, self.previous), stored_path)
+        self._move(session, stored_path, version_path)
+        logging.debug(f"Kept previous version of {stored_path} in {posixpath.dirname(version_path)}")
+        return True
+
+    def record_change(self, relative_path):
+        with self.lock:
+            self.changed.append(relative_path)
+
+    def finish(self, retention=None):
+        """Write this run's snapshot, if it changed anything, and prune what retention no longer keeps."""
+        with self.lock:
+            changed = sorted(self.changed)
+        if changed:
+            log = {'id': self.id, 'created': time.time(), 'changed': changed}
+            self._write(posixpath.join(SNAPSHOTS_DIR, f"{self.id}.json"), json.dumps(log))
+            logging.info(f"Snapshot {self.id} created: {len(changed)} files changed.")
+        else:
+            logging.info(f"No files changed; snapshot {self.previous} is still current.")
+        if retention:
+            self.prune(retention)
+
+    def prune(self, retention):
+        """Delete snapshots retention does not keep, and the old versions only they used."""
+        ids = self.list_snapshots()
+        keep = sorted(snapshots_to_keep(ids, retention))
+        removed = [snapshot_id for snapshot_id in ids if snapshot_id not in keep]
+        # A kept snapshot's list must cover every change since the kept one before it,
+        # so restores can still tell which current copies are too new for it
+        carried, pending = None, []
+        for snapshot_id in ids:
+            if snapshot_id in removed:
+                if carried is not None:
+                    carried.update(self.read_snapshot(snapshot_id)['changed'])
+                pending.append(snapshot_id)
+                continue
+            if carried:
+                log = self.read_snapshot(snapshot_id)
+                log['changed'] = sorted(carried.union(log['changed']))
+                self._write(posixpath.join(SNAPSHOTS_DIR, f"{snapshot_id}.json"), json.dumps(log))
+            # Only delete once their changes are safely merged into a kept snapshot
+            for removed_id in pending:
+                self._remove(posixpath.join(SNAPSHOTS_DIR, f"{removed_id}.json"))
+            carried, pending = set(), []
+        versions = 0
+        for name in self._list(VERSIONS_DIR):
+            span = parse_version_dir(name)
+            if span and not any(span[0] <= snapshot_id <= span[1] for snapshot_id in keep):
+                self._remove_tree(posixpath.join(VERSIONS_DIR, name))
+                versions += 1
+        if removed or versions:
+            logging.info(f"Pruned {len(removed)} snapshots and {versions} version folders; {len(keep)} snapshots kept.")
+        return removed
+
+    def list_snapshots(self):
+        """Ids of the existing snapshots, oldest first."""
+        return sorted(name[:-len('.json')] for name in self._list(SNAPSHOTS_DIR) if name.endswith('.json'))
+
+    def read_snapshot(self, snapshot_id):
+        return json.loads(self._read(posixpath.join(SNAPSHOTS_DIR, f"{snapshot_id}.json")))
+
+    def files(self, snapshot_id=None):
+        """Yield (location, stored_path, attributes) for every stored file of a snapshot.
+
+        location is relative to the backup root and stored_path is the file's name
+        in the mirror. Without a snapshot id, the current mirror is listed.
+        """
+        changed_since = set()
+        versions = {}
+        if snapshot_id is not None:
+            ids = self.list_snapshots()
+            if snapshot_id not in ids:
+                raise ValueError(f"No snapshot {snapshot_id}; available: {', '.join(ids) or 'none'}")
+            for later_id in ids:
+                if later_id > snapshot_id:
+                    changed_since.update(self.read_snapshot(later_id)['changed'])
+            for name in self._list(VERSIONS_DIR):
+                span = parse_version_dir(name)
+                if not span or not span[0] <= snapshot_id <= span[1]:
+                    continue
+                location_dir = posixpath.join(VERSIONS_DIR, name)
+                for stored_path, attributes in self._walk(location_dir):
+                    relative_path = original_name(stored_path)
+                    # Should ranges overlap, the version written most recently is the right one
+                    if relative_path not in versions or versions[relative_path][0] < span[0]:
+                        versions[relative_path] = (span[0], posixpath.join(location_dir, stored_path), stored_path, attributes)
+        for stored_path, attributes in self._walk(''):
+            if stored_path.split('/')[0] in (SNAPSHOTS_DIR, VERSIONS_DIR, PACKS_DIR):
+                continue
+            relative_path = original_name(stored_path)
+            # A copy written after the snapshot, or replaced since, is not the snapshot's
+            if relative_path not in changed_since and relative_path not in versions:
+                yield stored_path, stored_path, attributes
+        for _, location, stored_path, attributes in versions.values():
+            yield location, stored_path, attributes
+
+class LocalSnapshotStore(SnapshotStore):
+    """Snapshots of a mirror in a local directory."""
+
+    def __init__(self, root):
+        super().__init__()
+        self.root = root
+
+    def _local(self, path):
+        return os.path.join(self.root, *[part for part in path.split('/') if part])
+
+    def _list(self, directory):
+        try:
+            return os.listdir(self._local(directory))
+        except FileNotFoundError:
+            return []
+
+    def _walk(self, directory):
+        top = self._local(directory)
+        for root, dirs, files in os.walk(top):
+            if root == top and not directory:
+                dirs[:] = [name for name in dirs if name not in (SNAPSHOTS_DIR, VERSIONS_DIR)]
+            for name in files:
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, top).replace(os.sep, '/'), os.stat(path)
+
+    def _read(self, path):
+        with open(self._local(path), 'r') as data_file:
+            return data_file.read()
+
+    def _write(self, path, data):
+        path = self._local(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as data_file:
+            data_file.write(data)
+        os.replace(path + '.tmp', path)
+
+    def _move(self, session, source, destination):
+        destination = self._local(destination)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(self._local(source), destination)
+
+    def _remove(self, path):
+        os.remove(self._local(path))
+
+    def _remove_tree(self, path):
+        shutil.rmtree(self._local(path))
+
+class SFTPSnapshotStore(SnapshotStore):
+    """Snapshots of a mirror on an SFTP server; moves run on the session they are given."""
+
+    def __init__(self, sftp, root, tree):
+        super().__init__()
+        self.sftp = sftp
+        self.root = root
+        self.tree = tree
+
+    def _remote(self, path):
+        return posixpath.join(self.root, path) if path else self.root
+
+    def _list(self, directory):
+        try:
+            return self.sftp.listdir(self._remote(directory))
+        except IOError:
+            return []
+
+    def _walk(self, directory):
+        if directory:
+            yield from walk_remote(self.sftp, self._remote(directory))
+            return
+        # Leave the snapshot folders out of the mirror's listing instead of walking them
+        try:
+            entries = self.sftp.listdir_attr(self.root)
+        except IOError:
+            return
+        for entry in entries:
+            if not stat.S_ISDIR(entry.st_mode or 0):
+                yield entry.filename, entry
+            elif entry.filename not in (SNAPSHOTS_DIR, VERSIONS_DIR, PACKS_DIR):
+                for relative_path, attributes in walk_remote(self.sftp, self._remote(entry.filename)):
+                    yield posixpath.join(entry.filename, relative_path), attributes
+
+    def _read(self, path):
+        with self.sftp.open(self._remote(path), 'r') as data_file:
+            return data_file.read().decode()
+
+    def _write(self, path, data):
+        path = self._remote(path)
+        self.tree.ensure_dir(self.sftp, posixpath.dirname(path))
+        with self.sftp.open(path + '.tmp', 'w') as data_file:
+            data_file.write(data)
+        self.sftp.posix_rename(path + '.tmp', path)
+
+    def _move(self, session, source, destination):
+        destination = self._remote(destination)
+        self.tree.ensure_dir(session, posixpath.dirname(destination))
+        session.rename(self._remote(source), destination)
+
+    def _remove(self, path):
+        self.sftp.remove(self._remote(path))
+
+    def _remove_tree(self, path):
+        remove_remote_tree(self.sftp, self._remote(path))
+
+def remove_remote_tree(sftp, remote_dir):
+    """Delete a remote directory and everything below it."""
+    for entry in sftp.listdir_attr(remote_dir):
+        path = posixpath.join(remote_dir, entry.filename)
+        if stat.S_ISDIR(entry.st_mode or 0):
+            remove_remote_tree(sftp, path)
+        else:
+            sftp.remove(path)
+    sftp.rmdir(remote_dir)
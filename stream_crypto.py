@@ -0,0 +1,85 @@
+import itertools
+import os
+import struct
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+MAGIC = b'RBE1'
+SEGMENT_SIZE = 1024 * 1024
+TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+HEADER = struct.Struct('>4sB7sI')  # magic, cipher id, nonce prefix, segment size
+
+CIPHERS = {
+    'aes-gcm': (1, AESGCM),
+    'chacha20': (2, ChaCha20Poly1305),
+}
+CIPHER_IDS = {cipher_id: cipher for cipher_id, cipher in CIPHERS.values()}
+
+class DecryptionError(Exception):
+    """Raised when encrypted data is truncated, reordered or tampered with."""
+
+def _nonce(prefix, counter, final):
+    # STREAM construction: a segment can't be moved, dropped or passed off as the last one
+    return prefix + struct.pack('>IB', counter, 1 if final else 0)
+
+def _segments(chunks, segment_size):
+    """Re-cut a byte stream into fixed-size segments, flagging the last one."""
+    buffer = bytearray()
+    pending = None
+    for data in chunks:
+        buffer += data
+        while len(buffer) >= segment_size:
+            if pending is not None:
+                yield pending, False
+            pending = bytes(buffer[:segment_size])
+            del buffer[:segment_size]
+    if buffer or pending is None:
+        if pending is not None:
+            yield pending, False
+        yield bytes(buffer), True
+    else:
+        yield pending, True
+
+def encrypt_chunks(chunks, key, cipher='aes-gcm', segment_size=SEGMENT_SIZE):
+    """Encrypt a stream of byte chunks in constant memory with a 32-byte key."""
+    cipher_id, cipher_class = CIPHERS[cipher]
+    aead = cipher_class(key)
+    prefix = os.urandom(NONCE_PREFIX_SIZE)
+    header = HEADER.pack(MAGIC, cipher_id, prefix, segment_size)
+    yield header
+    for counter, (segment, final) in enumerate(_segments(chunks, segment_size)):
+        yield aead.encrypt(_nonce(prefix, counter, final), segment, header)
+
+def decrypt_chunks(chunks, key):
+    """Decrypt a stream produced by encrypt_chunks, verifying every segment."""
+    buffer = bytearray()
+    chunks = iter(chunks)
+    for data in chunks:
+        buffer += data
+        if len(buffer) >= HEADER.size:
+            break
+    if len(buffer) < HEADER.size:
+        raise DecryptionError("Encrypted stream is truncated")
+    header = bytes(buffer[:HEADER.size])
+    magic, cipher_id, prefix, segment_size = HEADER.unpack(header)
+    if magic != MAGIC or cipher_id not in CIPHER_IDS:
+        raise DecryptionError("Not an encrypted backup stream")
+    aead = CIPHER_IDS[cipher_id](key)
+    del buffer[:HEADER.size]
+    sealed_size = segment_size + TAG_SIZE
+    counter = 0
+
+    def open_segment(sealed, final):
+        try:
+            return aead.decrypt(_nonce(prefix, counter, final), sealed, header)
+        except Exception:
+            raise DecryptionError(f"Segment {counter} failed authentication")
+
+    for data in itertools.chain([b''], chunks):
+        buffer += data
+        # Keep at least one full segment back: only the last one is opened as final
+        while len(buffer) > sealed_size:
+            yield open_segment(bytes(buffer[:sealed_size]), False)
+            del buffer[:sealed_size]
+            counter += 1
+    yield open_segment(bytes(buffer), True)
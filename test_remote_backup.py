@@ -1,8 +1,46 @@
+import asyncio
 import os
+import io
+import json
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
-from unittest.mock import patch, MagicMock
+from datetime import datetime
+from functools import partial
+from unittest.mock import ANY, patch, MagicMock
 from utils import generate_key, load_key, save_config, load_config, validate_config, add_to_startup
-from RemoteBackup import run_backup, schedule_backup
+from RemoteBackup import iter_source_files, local_sync_directories, run_backup, schedule_backup, sftp_chunk_sync, sftp_sync_directories
+from manifest import Manifest, rebuild_from_remote
+from sftp_pool import UploadWorkers
+from remote_tree import RemoteTree
+from chunkstore import GEAR, MAX_CHUNK_SIZE, WINDOW, LocalChunkBackend, find_boundary, iter_chunks, store_file, restore_file
+from delta import BLOCK_SIZE, patch_remote, signature_matcher, upload_with_signature
+from local_copy import copy_file
+from watcher import ChangeSet, create_watcher
+from compression import choose_codec, compress_chunks, decompress_chunks
+from stream_crypto import DecryptionError, decrypt_chunks, encrypt_chunks
+from restore import Restorer, path_matches, restore_from_local, restore_from_sftp
+from change_detection import FAT_MTIME_TOLERANCE, LOCAL_MTIME_TOLERANCE, ChangeDetector, local_mtime_tolerance
+from throttle import BandwidthLimiter, TokenBucket
+from metrics import InstrumentedSFTP, MetricsRegistry, RunMetrics
+from loopback_sftp import LoopbackSFTPServer
+from benchmark import make_tree
+from snapshots import LocalSnapshotStore, snapshots_to_keep
+from jobs import FanOut, job_configs, job_sources
+from mirror import deletions_allowed
+from pathsets import PathSet, missing
+from scanner import PathFilter, scan
+from scheduling import TransferPolicy, create_policy
+from workers import WorkerPool
+from backup_daemon import BackupDaemon, send_command
+from integrity import IntegrityError, RemoteHasher, StreamHasher
+from audit import audit_local, audit_sftp, run_audit
 
 class TestUtils(unittest.TestCase):
     def setUp(self):
@@ -81,10 +119,1017 @@ class TestRemoteBackup(unittest.TestCase):
             "remote_password": "pass",
         }
         run_backup(config)
-        mock_local_sync.assert_called_once_with("test_source", "test_backup")
+        mock_local_sync.assert_called_once_with(
+            "test_source", "test_backup", parallelism=1, compression=None, encryption=None, change_detection="mtime",
+            throttle=None, snapshot_retention=None, mirror=False, max_delete_percent=10, verify=False, audit=False, policy=ANY,
+            paths=None, source_files=ANY, mtime_tolerance=None
+        )
         mock_sftp_sync.assert_called_once_with(
-            "test_source", "test_remote", "localhost", 22, "user", "pass"
+            "test_source", "test_remote", "localhost", 22, "user", "pass", parallelism=1, delta=False,
+            compression=None, encryption=None, change_detection="mtime", throttle=None,
+            snapshot_retention=None, mirror=False, max_delete_percent=10, pack_threshold=None,
+            bundle_size=64 * 1024 * 1024, verify=False, policy=ANY, paths=None, source_files=ANY
         )
 
+    def test_startup_loads_no_heavy_modules(self):
+        """Test that starting the scheduler loads neither SFTP, GUI nor Windows-only modules."""
+        code = ("import sys, RemoteBackup; "
+                "print(' '.join(name for name in ('paramiko', 'tkinter', 'win32com', 'setup') if name in sys.modules))")
+        with tempfile.TemporaryDirectory() as workdir:
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+            output = subprocess.run([sys.executable, "-c", code], cwd=workdir, env=env, capture_output=True, text=True,
+                                    check=True).stdout
+        self.assertEqual(output.strip(), "")
+
+class TestJobs(unittest.TestCase):
+    def test_jobs_inherit_shared_settings(self):
+        """Test that each job overrides the top-level settings and gets a name."""
+        config = {"remote_host": "backup.example", "schedule_interval": "daily",
+                  "jobs": [{"name": "photos", "source_folders": ["C:/Photos", "D:/Camera"]},
+                           {"source_folder": "C:/Work", "schedule_interval": "custom"}]}
+        (photos_name, photos), (work_name, work) = job_configs(config)
+        self.assertEqual((photos_name, work_name), ("photos", "job2"))
+        self.assertEqual((photos["remote_host"], work["schedule_interval"]), ("backup.example", "custom"))
+        self.assertNotIn("jobs", work)
+        self.assertEqual(job_sources(photos), [("C:/Photos", "Photos"), ("D:/Camera", "Camera")])
+        self.assertEqual(job_sources(work), [("C:/Work", "")])
+
+    def test_fan_out_feeds_every_consumer(self):
+        """Test that one walk reaches every branch, even after another branch stops reading."""
+        fan_out = FanOut(iter(range(100)), 3, queue_size=4)
+        fan_out.close(2)
+        results = {}
+
+        def consume(index):
+            results[index] = list(fan_out.branch(index))
+        threads = [threading.Thread(target=consume, args=(index,)) for index in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, {0: list(range(100)), 1: list(range(100))})
+
+class TestBackupDaemon(unittest.TestCase):
+    def test_control_socket_runs_and_cancels_jobs(self):
+        """Test that jobs started over the control socket never overlap and stop when cancelled."""
+        started = threading.Event()
+
+        def run_job(config, cancel=None):
+            started.set()
+            return cancel.wait(5)
+
+        with tempfile.TemporaryDirectory() as workdir:
+            token_file = os.path.join(workdir, "control.token")
+            daemon = BackupDaemon([("photos", {}), ("work", {})], run_job, control_port=0, token_file=token_file)
+            thread = threading.Thread(target=asyncio.run, args=(daemon.serve(),))
+            thread.start()
+            try:
+                port = self.wait_for_port(daemon)
+                command = partial(send_command, port=port, token_file=token_file)
+                self.assertTrue(command("run", "photos")["done"])
+                self.assertTrue(started.wait(5))
+                self.assertFalse(command("run", "photos")["done"])
+                self.assertFalse(command("run", None)["ok"])
+                status = {job["job"]: job for job in command("status")["jobs"]}
+                self.assertTrue(status["photos"]["running"])
+                self.assertFalse(status["work"]["running"])
+                self.assertTrue(command("cancel", "photos")["done"])
+                for _ in range(100):
+                    status = {job["job"]: job for job in command("status")["jobs"]}
+                    if not status["photos"]["running"]:
+                        break
+                    time.sleep(0.05)
+                self.assertEqual(status["photos"]["last_result"], "cancelled")
+            finally:
+                daemon.stop()
+                thread.join(5)
+            self.assertFalse(thread.is_alive())
+            self.assertFalse(os.path.exists(token_file))
+
+    def test_control_socket_refuses_requests_without_token(self):
+        """Test that the control token is private to its owner and requests without it are refused."""
+        run_job = MagicMock()
+        with tempfile.TemporaryDirectory() as workdir:
+            token_file = os.path.join(workdir, "control.token")
+            daemon = BackupDaemon([("photos", {})], run_job, control_port=0, token_file=token_file)
+            thread = threading.Thread(target=asyncio.run, args=(daemon.serve(),))
+            thread.start()
+            try:
+                port = self.wait_for_port(daemon)
+                if os.name == "posix":
+                    self.assertEqual(os.stat(token_file).st_mode & 0o777, 0o600)
+                for request in ({"command": "run", "job": "photos"}, {"command": "run", "job": "photos", "token": "guess"}):
+                    with socket.create_connection(("127.0.0.1", port), timeout=5) as connection:
+                        connection.sendall(json.dumps(request).encode() + b"\n")
+                        with connection.makefile("rb") as responses:
+                            self.assertEqual(json.loads(responses.readline()), {"ok": False, "error": "Not authorized"})
+                self.assertTrue(send_command("status", port=port, token_file=token_file)["ok"])
+            finally:
+                daemon.stop()
+                thread.join(5)
+        run_job.assert_not_called()
+
+    def wait_for_port(self, daemon):
+        for _ in range(100):
+            if daemon.control_port:
+                break
+            time.sleep(0.05)
+        return daemon.control_port
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.manifest = Manifest("test_manifest.db")
+
+    def tearDown(self):
+        self.manifest.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists("test_manifest.db" + suffix):
+                os.remove("test_manifest.db" + suffix)
+
+    def test_record_and_is_unchanged(self):
+        """Test that recorded files are reported unchanged until size or mtime moves."""
+        self.manifest.record("target", "dir/file.txt", 10, 100.0, 10, 150.0)
+        self.assertTrue(self.manifest.is_unchanged("target", "dir/file.txt", 10, 100.0))
+        self.assertFalse(self.manifest.is_unchanged("target", "dir/file.txt", 10, 101.0))
+        self.assertFalse(self.manifest.is_unchanged("other", "dir/file.txt", 10, 100.0))
+
+    def test_interrupted_uploads(self):
+        """Test that started uploads are checkpointed until they are recorded as finished."""
+        self.manifest.start_upload("target", "big.iso", 100, 5.0)
+        self.manifest.start_upload("target", "small.txt", 1, 6.0)
+        self.manifest.record("target", "small.txt", 1, 6.0, 1, 7.0)
+        self.assertEqual(self.manifest.interrupted_uploads("target"), {"big.iso": (100, 5.0)})
+        self.assertEqual(self.manifest.interrupted_uploads("other"), {})
+
+    def test_rebuild_from_remote(self):
+        """Test rebuilding the manifest from a remote listing."""
+        directory = MagicMock(filename="dir", st_mode=0o040755)
+        fresh = MagicMock(filename="fresh.txt", st_mode=0o100644, st_size=5, st_mtime=200.0)
+        stale = MagicMock(filename="stale.txt", st_mode=0o100644, st_size=5, st_mtime=50.0)
+        truncated = MagicMock(filename="truncated.txt", st_mode=0o100644, st_size=3, st_mtime=200.0)
+        sftp = MagicMock()
+        sftp.listdir_attr.side_effect = lambda path: [directory] if path == "/backup" else [fresh, stale, truncated]
+        local = MagicMock(st_size=5, st_mtime=100.0)
+        self.manifest.record("target", "gone.txt", 1, 1.0)
+
+        recorded = rebuild_from_remote(self.manifest, "target", sftp, "/backup", lambda path: local)
+
+        self.assertEqual(recorded, 1)
+        self.assertTrue(self.manifest.is_unchanged("target", "dir/fresh.txt", 5, 100.0))
+        self.assertIsNone(self.manifest.get("target", "dir/stale.txt"))
+        self.assertIsNone(self.manifest.get("target", "dir/truncated.txt"))
+        self.assertIsNone(self.manifest.get("target", "gone.txt"))
+
+class TestUploadWorkers(unittest.TestCase):
+    def test_tasks_run_on_every_session(self):
+        """Test that queued tasks are spread over the pool's sessions and all complete."""
+        pool = MagicMock()
+        pool.open_session.side_effect = lambda: MagicMock()
+        workers = UploadWorkers(pool, 4)
+        seen = []
+        for _ in range(50):
+            workers.submit(lambda sftp: seen.append(sftp))
+        workers.join()
+        self.assertEqual(pool.open_session.call_count, 4)
+        self.assertEqual(len(seen), 50)
+
+class TestRemoteTree(unittest.TestCase):
+    def test_one_listing_per_directory(self):
+        """Test that files in the same directory share a single listdir_attr call."""
+        sftp = MagicMock()
+        sftp.listdir_attr.return_value = [MagicMock(filename="a.txt", st_mode=0o100644, st_mtime=10.0)]
+        tree = RemoteTree(sftp)
+        self.assertEqual(tree.stat("/backup/a.txt").st_mtime, 10.0)
+        self.assertIsNone(tree.stat("/backup/b.txt"))
+        sftp.listdir_attr.assert_called_once_with("/backup")
+        sftp.stat.assert_not_called()
+
+    def test_ensure_dir_creates_only_missing(self):
+        """Test that only missing directories are created, and each only once."""
+        sftp = MagicMock()
+        sftp.listdir_attr.side_effect = IOError
+        sftp.stat.side_effect = lambda path: MagicMock() if path == "/backup" else (_ for _ in ()).throw(IOError())
+        tree = RemoteTree(sftp)
+        tree.ensure_dir(sftp, "/backup/a/b")
+        tree.ensure_dir(sftp, "/backup/a/b")
+        self.assertEqual([c.args[0] for c in sftp.mkdir.call_args_list], ["/backup/a", "/backup/a/b"])
+        self.assertEqual(sftp.stat.call_count, 2)
+
+class TestChunkStore(unittest.TestCase):
+    def test_chunks_survive_insertion(self):
+        """Test that inserting bytes only changes the chunks around the insertion."""
+        data = os.urandom(8 * 1024 * 1024)
+        before = list(iter_chunks(io.BytesIO(data)))
+        after = list(iter_chunks(io.BytesIO(data[:3000000] + b"inserted" + data[3000000:])))
+        self.assertEqual(b"".join(before), data)
+        self.assertGreaterEqual(len(set(before) & set(after)), len(before) - 2)
+
+    def test_text_chunks_survive_insertion(self):
+        """Test that text, which may not hold every byte value, is cut by content and survives an insertion."""
+        rng = random.Random(4)
+        data = "".join(f"{index},{rng.random():.6f},user{rng.randrange(10000)},GET /files/{rng.randrange(10 ** 6)}\n"
+                       for index in range(250000)).encode()
+        before = list(iter_chunks(io.BytesIO(data)))
+        after = list(iter_chunks(io.BytesIO(b"inserted line\n" + data)))
+        self.assertEqual(b"".join(before), data)
+        self.assertLess(max(map(len, before)), MAX_CHUNK_SIZE)
+        self.assertGreaterEqual(len(set(before) & set(after)), len(before) - 2)
+
+    def test_boundaries_match_gear_hash_at_every_byte(self):
+        """Test that the block-wise fingerprints cut where a byte-at-a-time gear hash does."""
+        def reference(data, min_size, avg_size, max_size):
+            max_size = min(max_size, len(data))
+            bits = avg_size.bit_length() - 1
+            fingerprint = 0
+            for position in range(max(0, min_size - 1 - WINDOW), max_size):
+                fingerprint = ((fingerprint << 1) + GEAR[data[position]]) & 0xFFFFFFFF
+                end = position + 1
+                mask = ((1 << (bits + 2)) - 1) << (30 - bits) if end < avg_size else ((1 << (bits - 2)) - 1) << (34 - bits)
+                if end >= min_size and not fingerprint & mask:
+                    return end
+            return max_size
+
+        rng = random.Random(10)
+        for min_size in (64, 1000, 40000):
+            for data in (rng.randbytes(min_size * 20), bytes(rng.choice(b"abc,\n0123") for _ in range(min_size * 20))):
+                self.assertEqual(find_boundary(data, min_size, min_size * 4, min_size * 16),
+                                 reference(data, min_size, min_size * 4, min_size * 16))
+
+    def test_store_deduplicates_and_restores(self):
+        """Test that identical files share chunks and restore byte for byte."""
+        with tempfile.TemporaryDirectory() as workdir:
+            data = os.urandom(3 * 1024 * 1024)
+            source = os.path.join(workdir, "source.bin")
+            with open(source, "wb") as source_file:
+                source_file.write(data)
+            backend = LocalChunkBackend(os.path.join(workdir, "store"))
+            first = store_file(backend, source, "a/source.bin", os.stat(source))
+            second = store_file(backend, source, "b/copy.bin", os.stat(source))
+            self.assertEqual(first[1], len(data))
+            self.assertEqual(second, (0, 0))
+            restored = os.path.join(workdir, "restored.bin")
+            restore_file(backend, "b/copy.bin", restored)
+            with open(restored, "rb") as restored_file:
+                self.assertEqual(restored_file.read(), data)
+
+    def test_restore_refuses_damaged_chunk(self):
+        """Test that a chunk that no longer matches its name fails the restore without touching the target."""
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, "source.bin")
+            with open(source, "wb") as source_file:
+                source_file.write(os.urandom(1024 * 1024))
+            backend = LocalChunkBackend(os.path.join(workdir, "store"))
+            store_file(backend, source, "source.bin", os.stat(source))
+            digest = backend.get_recipe("source.bin")["chunks"][0]
+            corrupt(backend._chunk_path(digest))
+            restored = os.path.join(workdir, "restored.bin")
+            with open(restored, "wb") as previous:
+                previous.write(b"previous version")
+            with self.assertRaises(IntegrityError):
+                restore_file(backend, "source.bin", restored)
+            with open(restored, "rb") as restored_file:
+                self.assertEqual(restored_file.read(), b"previous version")
+
+class TestDelta(unittest.TestCase):
+    def test_patch_sends_only_changed_blocks(self):
+        """Test that a delta upload rewrites only the changed block and handles truncation."""
+        data = bytearray(os.urandom(BLOCK_SIZE * 8))
+        remote = io.BytesIO()
+        signature, sent = upload_with_signature(io.BytesIO(bytes(data)), remote)
+        self.assertEqual(sent, len(data))
+
+        data[BLOCK_SIZE * 3 + 10:BLOCK_SIZE * 3 + 20] = b"x" * 10
+        del data[BLOCK_SIZE * 6:]
+        signature, sent = patch_remote(io.BytesIO(bytes(data)), remote, signature_matcher(signature), BLOCK_SIZE * 8)
+        self.assertEqual(sent, BLOCK_SIZE)
+        self.assertEqual(remote.getvalue(), bytes(data))
+
+class TestLocalCopy(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.workdir.name, "source.bin")
+        self.dest = os.path.join(self.workdir.name, "dest.bin")
+        self.data = os.urandom(3 * 1024 * 1024 + 123)
+        with open(self.source, "wb") as source_file:
+            source_file.write(self.data)
+        os.chmod(self.source, 0o640)
+        os.utime(self.source, (1000000000, 1000000000))
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def assertCopied(self):
+        with open(self.dest, "rb") as dest_file:
+            self.assertEqual(dest_file.read(), self.data)
+        self.assertEqual(os.stat(self.dest).st_mtime, 1000000000)
+        self.assertEqual(os.stat(self.dest).st_mode, os.stat(self.source).st_mode)
+
+    def test_copy_preserves_data_and_metadata(self):
+        """Test that copy_file matches shutil.copy2."""
+        copy_file(self.source, self.dest)
+        self.assertCopied()
+
+    @patch("os.sendfile", side_effect=OSError, create=True)
+    @patch("os.copy_file_range", side_effect=OSError, create=True)
+    def test_copy_falls_back_to_buffered(self, mock_copy_file_range, mock_sendfile):
+        """Test the large-buffer fallback when the kernel copy calls are unavailable."""
+        copy_file(self.source, self.dest)
+        self.assertCopied()
+
+    def test_copy_file_replaces_destination_atomically(self):
+        """Test that copies go through a partial file that is gone once the copy is complete."""
+        with tempfile.TemporaryDirectory() as workdir:
+            src = os.path.join(workdir, "src.txt")
+            dst = os.path.join(workdir, "dst.txt")
+            with open(src, "wb") as src_file:
+                src_file.write(b"new contents")
+            with open(dst, "wb") as dst_file:
+                dst_file.write(b"old")
+            copy_file(src, dst)
+            with open(dst, "rb") as dst_file:
+                self.assertEqual(dst_file.read(), b"new contents")
+            self.assertEqual(sorted(os.listdir(workdir)), ["dst.txt", "src.txt"])
+
+class TestWatcher(unittest.TestCase):
+    def test_change_set_debounces(self):
+        """Test that paths still being written are held back until they go quiet."""
+        changes = ChangeSet()
+        changes.add("a.txt")
+        self.assertEqual(changes.collect(quiet_seconds=60), ([], False))
+        self.assertEqual(changes.collect(quiet_seconds=0), (["a.txt"], False))
+        changes.overflow()
+        self.assertEqual(changes.collect(quiet_seconds=0), ([], True))
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "inotify is Linux-only")
+    def test_inotify_reports_new_directories(self):
+        """Test that files in new subdirectories are reported."""
+        with tempfile.TemporaryDirectory() as source:
+            watcher = create_watcher(source)
+            watcher.start()
+            try:
+                os.makedirs(os.path.join(source, "new"))
+                time.sleep(0.2)
+                with open(os.path.join(source, "new", "file.txt"), "w") as new_file:
+                    new_file.write("data")
+                time.sleep(0.5)
+                paths, overflowed = watcher.collect(quiet_seconds=0)
+            finally:
+                watcher.stop()
+        self.assertFalse(overflowed)
+        self.assertIn("new", paths)
+        self.assertIn(os.path.join("new", "file.txt"), paths)
+
+class TestCompression(unittest.TestCase):
+    def test_round_trip(self):
+        """Test that streamed compression restores the original bytes."""
+        data = [b"timestamp,value\n" * 5000 for _ in range(10)]
+        compressed = b"".join(compress_chunks(data, "gzip"))
+        self.assertLess(len(compressed), len(b"".join(data)) // 10)
+        self.assertEqual(b"".join(decompress_chunks([compressed[:3], compressed[3:]])), b"".join(data))
+
+    def test_incompressible_files_pass_through(self):
+        """Test that compressed formats and high-entropy data are not compressed again."""
+        with tempfile.TemporaryDirectory() as workdir:
+            text = os.path.join(workdir, "export.csv")
+            random_data = os.path.join(workdir, "disk.img")
+            with open(text, "w") as text_file:
+                text_file.write("a,b,c\n" * 10000)
+            with open(random_data, "wb") as random_file:
+                random_file.write(os.urandom(100000))
+            self.assertEqual(choose_codec(text, "gzip"), "gzip")
+            self.assertIsNone(choose_codec(random_data, "gzip"))
+            self.assertIsNone(choose_codec(os.path.join(workdir, "photo.JPG"), "gzip"))
+            self.assertIsNone(choose_codec(text, None))
+
+class TestStreamCrypto(unittest.TestCase):
+    def test_round_trip(self):
+        """Test that every cipher restores the original bytes across segment boundaries."""
+        key = os.urandom(32)
+        data = [os.urandom(1000) for _ in range(10)]
+        for cipher in ("aes-gcm", "chacha20"):
+            encrypted = list(encrypt_chunks(data, key, cipher, segment_size=4096))
+            self.assertEqual(b"".join(decrypt_chunks(encrypted, key)), b"".join(data))
+
+    def test_tampering_is_detected(self):
+        """Test that modified or truncated ciphertext fails to decrypt."""
+        key = os.urandom(32)
+        encrypted = b"".join(encrypt_chunks([b"x" * 10000], key, segment_size=4096))
+        tampered = bytearray(encrypted)
+        tampered[-1] ^= 1
+        for stream in (bytes(tampered), encrypted[:-4112]):
+            with self.assertRaises(DecryptionError):
+                b"".join(decrypt_chunks([stream], key))
+
+class TestRestore(unittest.TestCase):
+    def test_path_matches(self):
+        """Test that patterns select folders, globs and exact paths."""
+        self.assertTrue(path_matches("docs/2024/report.txt", ["docs"]))
+        self.assertTrue(path_matches("docs/report.txt", ["*.txt"]))
+        self.assertTrue(path_matches("a.csv", []))
+        self.assertFalse(path_matches("docsets/a.txt", ["docs/"]))
+
+    def test_local_restore(self):
+        """Test that matching files are decoded into place and skipped on a second run."""
+        with tempfile.TemporaryDirectory() as workdir:
+            backup = os.path.join(workdir, "backup")
+            os.makedirs(os.path.join(backup, "docs"))
+            with open(os.path.join(backup, "docs", "a.txt"), "wb") as stored:
+                stored.write(b"plain")
+            with open(os.path.join(backup, "docs", "b.txt.rbz"), "wb") as stored:
+                stored.write(b"".join(compress_chunks([b"compressed"], "gzip")))
+            with open(os.path.join(backup, "other.txt"), "wb") as stored:
+                stored.write(b"other")
+            target = os.path.join(workdir, "restored")
+
+            counts = restore_from_local(Restorer(target, ["docs"]), backup, parallelism=2)
+            self.assertEqual(counts, {"restored": 2, "skipped": 0, "failed": 0})
+            with open(os.path.join(target, "docs", "b.txt"), "rb") as restored:
+                self.assertEqual(restored.read(), b"compressed")
+            self.assertFalse(os.path.exists(os.path.join(target, "other.txt")))
+
+            counts = restore_from_local(Restorer(target, ["docs"]), backup, parallelism=2)
+            self.assertEqual(counts["skipped"], 2)
+
+class TestChangeDetection(unittest.TestCase):
+    def test_unchanged_allows_for_timestamp_granularity(self):
+        """Test that preserved times match within the storage's granularity and sizes must agree."""
+        detector = ChangeDetector(tolerance=FAT_MTIME_TOLERANCE)
+        local = MagicMock(st_size=10, st_mtime=1001.7)
+        self.assertTrue(detector.unchanged(local, 10, 1002.0))
+        self.assertTrue(detector.unchanged(local, None, 1000.0))
+        self.assertFalse(detector.unchanged(local, 11, 1001.7))
+        self.assertFalse(detector.unchanged(local, 10, 990.0))
+        exact = ChangeDetector(tolerance=0)
+        self.assertTrue(exact.unchanged(local, 10, 1001.7))
+        self.assertFalse(exact.unchanged(local, 10, 1002.0))
+
+    def test_local_edit_within_two_seconds_is_copied(self):
+        """Test that an edit that keeps the size and moves the time by under 2 seconds is copied to a local folder."""
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, "source")
+            backup = os.path.join(workdir, "backup")
+            os.makedirs(source)
+            path = os.path.join(source, "notes.txt")
+            with open(path, "wb") as source_file:
+                source_file.write(b"first")
+            os.utime(path, (1000000000.0, 1000000000.0))
+            self.assertEqual(local_mtime_tolerance(backup), LOCAL_MTIME_TOLERANCE)
+            with patch("metrics.RUN_SUMMARY_FILE", os.path.join(workdir, "runs.jsonl")):
+                local_sync_directories(source, backup)
+                with open(path, "wb") as source_file:
+                    source_file.write(b"later")
+                os.utime(path, (1000000000.5, 1000000000.5))
+                summary = local_sync_directories(source, backup)
+                with patch("change_detection.filesystem_type", return_value="vfat"):
+                    self.assertEqual(local_mtime_tolerance(backup), FAT_MTIME_TOLERANCE)
+            self.assertEqual(summary["files"].get("copied"), 1)
+            with open(os.path.join(backup, "notes.txt"), "rb") as copy:
+                self.assertEqual(copy.read(), b"later")
+
+    def test_times_rounded_to_100_ns_match(self):
+        """Test that a copy whose time was rounded to 100 ns, as NTFS and SMB shares store it, is unchanged."""
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, "source")
+            backup = os.path.join(workdir, "backup")
+            os.makedirs(source)
+            path = os.path.join(source, "notes.txt")
+            with open(path, "wb") as source_file:
+                source_file.write(b"contents")
+            os.utime(path, ns=(1700000000000000133, 1700000000000000133))
+            with patch("metrics.RUN_SUMMARY_FILE", os.path.join(workdir, "runs.jsonl")):
+                local_sync_directories(source, backup)
+                copy = os.path.join(backup, "notes.txt")
+                os.utime(copy, ns=(1700000000000000100, 1700000000000000100))
+                self.assertTrue(ChangeDetector(tolerance=LOCAL_MTIME_TOLERANCE).unchanged(
+                    os.stat(path), os.path.getsize(copy), os.path.getmtime(copy)))
+                summary = local_sync_directories(source, backup)
+            self.assertEqual(summary["files"], {"scanned": 1, "skipped": 1})
+
+    def test_digests_are_cached_until_the_file_changes(self):
+        """Test that a file is only hashed again after its size or mtime moves."""
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "data.txt")
+            with open(path, "w") as data_file:
+                data_file.write("contents")
+            with Manifest(os.path.join(workdir, "manifest.db")) as manifest:
+                detector = ChangeDetector(manifest, use_hashes=True)
+                first = detector.digest(path, os.stat(path))
+                with patch("change_detection.file_digest", return_value="digest") as mock_digest:
+                    self.assertEqual(detector.digest(path, os.stat(path)), first)
+                    mock_digest.assert_not_called()
+                    os.utime(path, (2000, 2000))
+                    detector.digest(path, os.stat(path))
+                    mock_digest.assert_called_once_with(path)
+
+class TestThrottle(unittest.TestCase):
+    def test_token_bucket_limits_rate(self):
+        """Test that consumers are held to the bucket's rate."""
+        bucket = TokenBucket(1000000)
+        start = time.monotonic()
+        for _ in range(4):
+            bucket.consume(250000)
+        self.assertGreaterEqual(time.monotonic() - start, 0.4)
+
+    def test_limit_follows_business_hours_and_rtt(self):
+        """Test that the limit switches with the clock and backs off when RTT rises."""
+        now = MagicMock(hour=10)
+        limiter = BandwidthLimiter(100000, 1000000, adaptive=True, clock=lambda: now)
+        self.assertEqual(limiter.bucket.rate, 100000)
+        now.hour = 19
+        limiter.next_check = 0
+        limiter.consume(1)
+        self.assertEqual(limiter.bucket.rate, 1000000)
+
+        limiter.observe_rtt(0.01)
+        limiter.sent = 500000
+        limiter.observe_rtt(0.2)
+        self.assertLess(limiter.bucket.rate, 1000000)
+
+class TestMetrics(unittest.TestCase):
+    def test_render_counters_and_latency_histogram(self):
+        """Test that counts and remote call latencies appear in the exposition format."""
+        registry = MetricsRegistry()
+        metrics = RunMetrics("sftp", registry)
+        metrics.count("copied", 100)
+        sftp = InstrumentedSFTP(MagicMock(), metrics)
+        sftp.stat("file.txt")
+        text = registry.render()
+        self.assertIn('remotebackup_files_total{backend="sftp",result="copied"} 1', text)
+        self.assertIn('remotebackup_bytes_total{backend="sftp",result="copied"} 100', text)
+        self.assertIn('remotebackup_remote_call_seconds_bucket{backend="sftp",operation="stat",le="+Inf"} 1', text)
+
+    def test_finish_appends_run_summary(self):
+        """Test that each finished run adds one JSON line with its totals."""
+        with tempfile.TemporaryDirectory() as workdir:
+            summary_file = os.path.join(workdir, "runs.jsonl")
+            for _ in range(2):
+                metrics = RunMetrics("local", MetricsRegistry())
+                metrics.count("skipped", 5)
+                metrics.sent(42)
+                with metrics.phase("walk"):
+                    pass
+                metrics.finish(summary_file)
+            with open(summary_file) as summaries:
+                lines = [json.loads(line) for line in summaries]
+            self.assertEqual(len(lines), 2)
+            self.assertEqual(lines[0]["files"], {"skipped": 1})
+            self.assertEqual(lines[0]["sent_bytes"], 42)
+            self.assertIn("walk", lines[0]["phase_seconds"])
+
+class TestSnapshots(unittest.TestCase):
+    def test_retention_keeps_newest_per_period(self):
+        """Test that each rule keeps the newest snapshot of its most recent periods."""
+        ids = ["20240101-020000", "20240101-230000", "20240102-020000", "20240108-020000", "20240109-020000"]
+        self.assertEqual(snapshots_to_keep(ids, {"daily": 2}), {"20240109-020000", "20240108-020000"})
+        self.assertEqual(snapshots_to_keep(ids, {"weekly": 2}), {"20240109-020000", "20240102-020000"})
+        self.assertEqual(snapshots_to_keep(ids, {}), set(ids))
+
+    def test_replaced_copies_stay_restorable(self):
+        """Test that an earlier snapshot still restores the version a later run replaced."""
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, "source")
+            backup = os.path.join(workdir, "backup")
+            os.makedirs(source)
+            for name, data in (("a.txt", b"first"), ("b.txt", b"unchanged")):
+                with open(os.path.join(source, name), "wb") as source_file:
+                    source_file.write(data)
+            manifest_file = os.path.join(workdir, "manifest.db")
+            with patch("metrics.RUN_SUMMARY_FILE", os.path.join(workdir, "runs.jsonl")), \
+                    patch("snapshots.datetime") as mock_datetime:
+                mock_datetime.now.return_value = datetime(2024, 1, 1, 2)
+                mock_datetime.strptime = datetime.strptime
+                local_sync_directories(source, backup, snapshot_retention={}, manifest_file=manifest_file)
+                with open(os.path.join(source, "a.txt"), "wb") as source_file:
+                    source_file.write(b"second")
+                os.utime(os.path.join(source, "a.txt"), (time.time() + 10, time.time() + 10))
+                mock_datetime.now.return_value = datetime(2024, 1, 2, 2)
+                local_sync_directories(source, backup, snapshot_retention={}, manifest_file=manifest_file)
+
+            store = LocalSnapshotStore(backup)
+            self.assertEqual(store.list_snapshots(), ["20240101-020000", "20240102-020000"])
+            target = os.path.join(workdir, "restored")
+            restore_from_local(Restorer(target, []), backup, snapshot="20240101-020000")
+            for name, data in (("a.txt", b"first"), ("b.txt", b"unchanged")):
+                with open(os.path.join(target, name), "rb") as restored:
+                    self.assertEqual(restored.read(), data)
+            with open(os.path.join(backup, "a.txt"), "rb") as current:
+                self.assertEqual(current.read(), b"second")
+
+class TestMirror(unittest.TestCase):
+    def test_deletion_limit(self):
+        """Test that a run deleting too much of the backup deletes nothing."""
+        self.assertTrue(deletions_allowed(5, 100, 10))
+        self.assertFalse(deletions_allowed(11, 100, 10))
+        self.assertFalse(deletions_allowed(0, 100, 10))
+
+    def test_moves_are_renamed_and_deletions_mirrored(self):
+        """Test that a moved folder is renamed in the backup instead of copied, and deleted files are removed."""
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, "source")
+            backup = os.path.join(workdir, "backup")
+            os.makedirs(os.path.join(source, "old"))
+            for index in range(10):
+                with open(os.path.join(source, "old" if index else "", f"{index}.txt"), "wb") as source_file:
+                    source_file.write(f"contents {index}".encode())
+            manifest_file = os.path.join(workdir, "manifest.db")
+            with patch("metrics.RUN_SUMMARY_FILE", os.path.join(workdir, "runs.jsonl")):
+                local_sync_directories(source, backup, mirror=True, max_delete_percent=20, manifest_file=manifest_file)
+                os.rename(os.path.join(source, "old"), os.path.join(source, "new"))
+                os.remove(os.path.join(source, "0.txt"))
+                summary = local_sync_directories(source, backup, mirror=True, max_delete_percent=20,
+                                                 manifest_file=manifest_file)
+            self.assertEqual(summary["files"], {"scanned": 9, "moved": 9, "deleted": 1})
+            self.assertEqual(summary["sent_bytes"], 0)
+            self.assertGreater(summary["peak_rss_bytes"], 0)
+            self.assertEqual(sorted(os.listdir(backup)), ["new"])
+            with open(os.path.join(backup, "new", "3.txt"), "rb") as moved:
+                self.assertEqual(moved.read(), b"contents 3")
+
+    def test_source_names_with_payload_suffixes(self):
+        """Test that source files named like compressed or encrypted copies are kept, skipped and restored as they are."""
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, "source")
+            backup = os.path.join(workdir, "backup")
+            os.makedirs(source)
+            names = ["archive.rbz", "secret.rbe", "escaped.rbn", "plain.txt"]
+            for name in names:
+                with open(os.path.join(source, name), "wb") as source_file:
+                    source_file.write(f"{name} ".encode() * 100)
+            manifest_file = os.path.join(workdir, "manifest.db")
+            with patch("metrics.RUN_SUMMARY_FILE", os.path.join(workdir, "runs.jsonl")):
+                for compression in (None, "gzip"):
+                    local_sync_directories(source, backup, compression=compression, mirror=True, max_delete_percent=100,
+                                           manifest_file=manifest_file)
+                    summary = local_sync_directories(source, backup, compression=compression, mirror=True,
+                                                     max_delete_percent=100, manifest_file=manifest_file)
+                    self.assertEqual(summary["files"], {"scanned": 4, "skipped": 4})
+            target = os.path.join(workdir, "restored")
+            counts = restore_from_local(Restorer(target, []), backup)
+            self.assertEqual(counts["restored"], 4)
+            self.assertEqual(sorted(os.listdir(target)), sorted(names))
+            for name in names:
+                with open(os.path.join(target, name), "rb") as restored:
+                    self.assertEqual(restored.read(), f"{name} ".encode() * 100)
+
+    def test_vanished_files_found_in_bounded_memory(self):
+        """Test that the walk is merged against the manifest from disk, without holding either in memory."""
+        with tempfile.TemporaryDirectory() as workdir:
+            paths = [f"dir{index % 50}/file{index}.txt" for index in range(20000)] + ["line\nbreak", "caf\u00e9"]
+            random.Random(1).shuffle(paths)
+            with Manifest(os.path.join(workdir, "manifest.db")) as manifest:
+                for path in paths:
+                    manifest.record("target", path, 1, 1.0)
+                manifest.commit()
+                with PathSet(spill_every=1000) as seen:
+                    for path in paths[100:] + paths[:10] + paths[100:110]:
+                        seen.add(path)
+                    self.assertEqual(list(seen), sorted(paths[:10] + paths[100:]))
+                    tracemalloc.start()
+                    try:
+                        vanished = list(missing(manifest.paths("target"), seen))
+                        peak = tracemalloc.get_traced_memory()[1]
+                    finally:
+                        tracemalloc.stop()
+            self.assertEqual(vanished, sorted(paths[10:100]))
+            self.assertLess(peak, 1024 * 1024)
+
+class TestScanner(unittest.TestCase):
+    def make_source(self, source):
+        for folder in ("docs", "docs/drafts", "cache", "src/build"):
+            os.makedirs(os.path.join(source, *folder.split("/")))
+        for path in ("a.txt", "a.tmp", "docs/b.txt", "docs/drafts/c.txt", "cache/d.txt", "src/e.py", "src/build/f.py"):
+            with open(os.path.join(source, *path.split("/")), "w") as source_file:
+                source_file.write(path)
+
+    def test_filter_rules(self):
+        """Test that excluded folders are pruned and include globs limit the files."""
+        with tempfile.TemporaryDirectory() as source:
+            self.make_source(source)
+            path_filter = PathFilter(exclude=["*.tmp", "cache", "src/build"])
+            self.assertEqual(sorted(item.relative_path for item in scan(source, path_filter, workers=1)),
+                             ["a.txt", "docs/b.txt", "docs/drafts/c.txt", "src/e.py"])
+            path_filter = PathFilter(include=["docs/**/*.txt", "*.py"], exclude=["drafts"])
+            self.assertEqual(sorted(item.relative_path for item in scan(source, path_filter, workers=1)),
+                             ["docs/b.txt", "src/build/f.py", "src/e.py"])
+            self.assertFalse(path_filter.accepts("docs/drafts/c.txt"))
+            self.assertTrue(path_filter.accepts("src/e.py"))
+
+    def test_parallel_scan_matches_sequential(self):
+        """Test that a parallel scan finds the same files, with their stat results, as a sequential one."""
+        with tempfile.TemporaryDirectory() as source:
+            paths = make_tree(source, "deep", scale=0.05)
+            sequential = {item.relative_path: item.stat.st_size for item in scan(source, workers=1)}
+            parallel = {item.relative_path: item.stat.st_size for item in scan(source, workers=4)}
+            self.assertEqual(len(sequential), len(paths))
+            self.assertEqual(parallel, sequential)
+
+    def test_watch_paths_are_filtered(self):
+        """Test that changed paths reported by a watcher are checked against the rules too."""
+        with tempfile.TemporaryDirectory() as source:
+            self.make_source(source)
+            path_filter = PathFilter(exclude=["cache"])
+            files = iter_source_files(source, ["cache/d.txt", "docs", "a.txt", "gone.txt"], path_filter, workers=1)
+            self.assertEqual(sorted(item.relative_path for item in files),
+                             ["a.txt", "docs/b.txt", "docs/drafts/c.txt"])
+
+class TestScheduling(unittest.TestCase):
+    def run_order(self, policy, files, parallelism=1):
+        """Queue files behind a blocked task and return the order they run in."""
+        release = threading.Event()
+        order = []
+        workers = WorkerPool(parallelism, policy=policy)
+        for _ in range(parallelism):
+            workers.submit(lambda session: release.wait(5))
+        time.sleep(0.1)
+        for path, size in files:
+            workers.submit(lambda session, path=path: order.append(path), path, size)
+        release.set()
+        workers.join()
+        return order, workers
+
+    def test_priority_then_smallest_first(self):
+        """Test that priority patterns come first and smaller files start before larger ones."""
+        files = [("video.mkv", 5000), ("notes.txt", 10), ("Documents/big.docx", 900), ("Documents/a.docx", 20)]
+        order, _ = self.run_order(TransferPolicy("smallest_first", ["Documents"]), files)
+        self.assertEqual(order, ["Documents/a.docx", "Documents/big.docx", "notes.txt", "video.mkv"])
+        order, _ = self.run_order(TransferPolicy(), files)
+        self.assertEqual(order, [path for path, _ in files])
+
+    def test_interleave_alternates_large_and_small(self):
+        """Test that a single stream alternates between the largest and smallest pending files."""
+        files = [(f"{size}.bin", size) for size in (1, 2, 3, 100, 200)]
+        order, _ = self.run_order(TransferPolicy("interleave"), files)
+        self.assertEqual(order, ["1.bin", "200.bin", "2.bin", "100.bin", "3.bin"])
+
+    def test_deadline_defers_queued_transfers(self):
+        """Test that no transfer starts after the deadline and the skipped ones are reported."""
+        policy = TransferPolicy(deadline=time.time() + 0.05)
+        order, workers = self.run_order(policy, [("a", 1), ("b", 2)])
+        self.assertEqual(order, [])
+        self.assertEqual(workers.deferred, [("a", 1), ("b", 2)])
+
+    def test_deadline_from_config(self):
+        """Test that the run deadline is the next occurrence of the time, or sooner with max_run_minutes."""
+        now = datetime(2024, 3, 1, 20, 0)
+        self.assertEqual(create_policy({"run_deadline": "06:00"}, now).deadline, datetime(2024, 3, 2, 6, 0).timestamp())
+        policy = create_policy({"run_deadline": "06:00", "max_run_minutes": 90}, now)
+        self.assertEqual(policy.deadline, datetime(2024, 3, 1, 21, 30).timestamp())
+        self.assertIsNone(create_policy({}, now).deadline)
+        with self.assertRaises(ValueError):
+            create_policy({"transfer_order": "random"}, now)
+
+class TestLoopbackSFTP(unittest.TestCase):
+    def test_sftp_sync_of_synthetic_tree(self):
+        """Test that a generated tree uploads through the in-process server and is skipped on the next run."""
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, "source")
+            paths = make_tree(source, "deep", scale=0.02)
+            root = os.path.join(workdir, "sftp")
+            os.makedirs(root)
+            manifest_file = os.path.join(workdir, "manifest.db")
+            with LoopbackSFTPServer(root) as server, patch("metrics.RUN_SUMMARY_FILE", os.path.join(workdir, "runs.jsonl")):
+                first = sftp_sync_directories(source, "backup", "127.0.0.1", server.port, "user", "password",
+                                              parallelism=2, manifest_file=manifest_file)
+                second = sftp_sync_directories(source, "backup", "127.0.0.1", server.port, "user", "password",
+                                               manifest_file=manifest_file)
+            self.assertEqual(first["files"]["copied"], len(paths))
+            self.assertEqual(second["files"]["skipped"], len(paths))
+            relative_path = os.path.relpath(paths[-1], source)
+            with open(paths[-1], "rb") as original, open(os.path.join(root, "backup", relative_path), "rb") as uploaded:
+                self.assertEqual(uploaded.read(), original.read())
+
+    def test_small_files_packed_and_restored(self):
+        """Test that small files are uploaded in bundles, restored one by one, and replaced when they grow."""
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, "source")
+            os.makedirs(os.path.join(source, "notes"))
+            for index in range(20):
+                with open(os.path.join(source, "notes", f"{index}.txt"), "wb") as source_file:
+                    source_file.write(f"note {index}".encode() * (index + 1))
+            root = os.path.join(workdir, "sftp")
+            os.makedirs(root)
+            manifest_file = os.path.join(workdir, "manifest.db")
+            with LoopbackSFTPServer(root) as server, patch("metrics.RUN_SUMMARY_FILE", os.path.join(workdir, "runs.jsonl")):
+                def sync():
+                    return sftp_sync_directories(source, "backup", "127.0.0.1", server.port, "user", "password",
+                                                 compression="gzip", pack_threshold=1024, bundle_size=500,
+                                                 manifest_file=manifest_file)
+                first = sync()
+                with open(os.path.join(source, "notes", "3.txt"), "wb") as grown:
+                    grown.write(b"x" * 4096)
+                second = sync()
+                restorer = Restorer(os.path.join(workdir, "restored"), ["notes/1*", "notes/3.txt"])
+                counts = restore_from_sftp(restorer, "backup", "127.0.0.1", server.port, "user", "password")
+            self.assertEqual(first["files"]["packed"], 20)
+            self.assertEqual(second["files"]["copied"], 1)
+            self.assertNotIn("packed", second["files"])
+            self.assertEqual(sorted(os.listdir(os.path.join(root, "backup"))), [".packs", "notes"])
+            self.assertEqual(counts["restored"], 12)
+            with open(os.path.join(workdir, "restored", "notes", "12.txt"), "rb") as restored:
+                self.assertEqual(restored.read(), b"note 12" * 13)
+            with open(os.path.join(workdir, "restored", "notes", "3.txt"), "rb") as restored:
+                self.assertEqual(restored.read(), b"x" * 4096)
+
+    def test_bundles_kept_when_manifest_misses_them(self):
+        """Test that a bundle still holding files is kept when the manifest does not record them."""
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, "source")
+            os.makedirs(source)
+            for index in range(10):
+                with open(os.path.join(source, f"{index}.txt"), "wb") as source_file:
+                    source_file.write(f"note {index}".encode() * (index + 1))
+            root = os.path.join(workdir, "sftp")
+            os.makedirs(root)
+            manifest_file = os.path.join(workdir, "manifest.db")
+            with LoopbackSFTPServer(root) as server, patch("metrics.RUN_SUMMARY_FILE", os.path.join(workdir, "runs.jsonl")):
+                def sync():
+                    return sftp_sync_directories(source, "backup", "127.0.0.1", server.port, "user", "password",
+                                                 pack_threshold=1024, manifest_file=manifest_file)
+                sync()
+                bundles = sorted(os.listdir(os.path.join(root, "backup", ".packs")))
+                with open(os.path.join(source, "3.txt"), "wb") as grown:
+                    grown.write(b"x" * 4096)
+                with patch("manifest.Manifest.bundles", return_value=set()):
+                    sync()
+                counts = restore_from_sftp(Restorer(os.path.join(workdir, "restored"), []), "backup", "127.0.0.1",
+                                           server.port, "user", "password")
+            packs_dir = os.path.join(root, "backup", ".packs")
+            self.assertTrue(set(bundles) <= set(os.listdir(packs_dir)))
+            self.assertEqual(counts["restored"], 10)
+            with open(os.path.join(workdir, "restored", "9.txt"), "rb") as restored:
+                self.assertEqual(restored.read(), b"note 9" * 10)
+
+    def test_chunk_restore_leaves_server_untouched(self):
+        """Test that restoring from a chunk store creates nothing on the server, and a missing store is an error."""
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, "source")
+            os.makedirs(source)
+            with open(os.path.join(source, "data.bin"), "wb") as source_file:
+                source_file.write(os.urandom(100000))
+            root = os.path.join(workdir, "sftp")
+            os.makedirs(root)
+            with LoopbackSFTPServer(root) as server, patch("metrics.RUN_SUMMARY_FILE", os.path.join(workdir, "runs.jsonl")):
+                sftp_chunk_sync(source, "store", "127.0.0.1", server.port, "user", "password",
+                                manifest_file=os.path.join(workdir, "manifest.db"))
+                # A read-only account can't create directories
+                with patch("remote_tree.RemoteTree.ensure_dir", side_effect=IOError("Permission denied")):
+                    counts = restore_from_sftp(Restorer(os.path.join(workdir, "restored"), []), "store", "127.0.0.1",
+                                               server.port, "user", "password", chunks=True)
+                    with self.assertRaises(FileNotFoundError):
+                        restore_from_sftp(Restorer(os.path.join(workdir, "other"), []), "stroe", "127.0.0.1",
+                                          server.port, "user", "password", chunks=True)
+            self.assertEqual(counts["restored"], 1)
+            self.assertEqual(sorted(os.listdir(root)), ["store"])
+            with open(os.path.join(workdir, "restored", "data.bin"), "rb") as restored, \
+                    open(os.path.join(source, "data.bin"), "rb") as original:
+                self.assertEqual(restored.read(), original.read())
+
+def corrupt(path):
+    """Flip the first byte of a file, keeping its size and times."""
+    file_stat = os.stat(path)
+    with open(path, "r+b") as damaged:
+        first = damaged.read(1)
+        damaged.seek(0)
+        damaged.write(bytes([first[0] ^ 0xFF]))
+    os.utime(path, (file_stat.st_atime, file_stat.st_mtime))
+
+class TestIntegrity(unittest.TestCase):
+    def test_uploads_verified_and_corrupted_copy_found_by_audit(self):
+        """Test that uploads are checked with server-side block hashes and an audit finds a damaged copy."""
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, "source")
+            os.makedirs(source)
+            sizes = {"empty.bin": 0, "small.txt": 100, "large.bin": 3 * BLOCK_SIZE + 17}
+            for name, size in sizes.items():
+                with open(os.path.join(source, name), "wb") as source_file:
+                    source_file.write(os.urandom(size))
+            root = os.path.join(workdir, "sftp")
+            os.makedirs(root)
+            manifest_file = os.path.join(workdir, "manifest.db")
+            with LoopbackSFTPServer(root) as server, patch("metrics.RUN_SUMMARY_FILE", os.path.join(workdir, "runs.jsonl")):
+                def sync():
+                    return sftp_sync_directories(source, "backup", "127.0.0.1", server.port, "user", "password",
+                                                 parallelism=2, verify=True, manifest_file=manifest_file)
+                first = sync()
+                with Manifest(manifest_file) as manifest:
+                    recorded = [row[3] for row in manifest.sample(f"sftp://user@127.0.0.1:{server.port}/backup", 10)]
+                corrupt(os.path.join(root, "backup", "large.bin"))
+                audit = audit_sftp(source, "backup", "127.0.0.1", server.port, "user", "password", 1.0,
+                                   manifest_file=manifest_file)
+                second = sync()
+            self.assertEqual(first["files"]["verified"], 3)
+            self.assertTrue(all(digest.startswith("sha1-blocks:") for digest in recorded))
+            self.assertEqual(audit["files"]["verified"], 2)
+            self.assertEqual(audit["files"]["mismatched"], 1)
+            self.assertEqual(second["files"]["copied"], 1)
+            with open(os.path.join(source, "large.bin"), "rb") as original, \
+                    open(os.path.join(root, "backup", "large.bin"), "rb") as uploaded:
+                self.assertEqual(uploaded.read(), original.read())
+
+    def test_local_copy_verified_and_audited(self):
+        """Test that local copies are read back after copying, and a damaged one is copied again after an audit."""
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, "source")
+            backup = os.path.join(workdir, "backup")
+            os.makedirs(source)
+            for index in range(4):
+                with open(os.path.join(source, f"{index}.bin"), "wb") as source_file:
+                    source_file.write(b"record %d\n" % index * 1000)
+            manifest_file = os.path.join(workdir, "manifest.db")
+            with patch("metrics.RUN_SUMMARY_FILE", os.path.join(workdir, "runs.jsonl")):
+                first = local_sync_directories(source, backup, compression="gzip", verify=True, manifest_file=manifest_file)
+                corrupt(os.path.join(backup, "2.bin.rbz"))
+                audit = audit_local(source, backup, 1.0, manifest_file=manifest_file)
+                second = local_sync_directories(source, backup, compression="gzip", verify=True, manifest_file=manifest_file)
+            self.assertEqual(first["files"]["verified"], 4)
+            self.assertEqual(audit["files"]["mismatched"], 1)
+            self.assertEqual(second["files"]["copied"], 1)
+            self.assertEqual(second["files"]["skipped"], 3)
+
+    def test_audit_of_default_local_job(self):
+        """Test that an audited local job without verification records its copies, so a damaged one is found."""
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, "source")
+            backup = os.path.join(workdir, "backup")
+            os.makedirs(source)
+            for index in range(3):
+                with open(os.path.join(source, f"f{index}"), "wb") as source_file:
+                    source_file.write(os.urandom(1000))
+            config = {"local_sync": True, "source_folder": source, "local_backup_folder": backup, "audit_fraction": 1.0}
+            cwd = os.getcwd()
+            os.chdir(workdir)
+            try:
+                self.assertTrue(run_backup(config))
+                with open(os.path.join(backup, "f2"), "wb") as overwritten:
+                    overwritten.write(os.urandom(1000))
+                self.assertFalse(run_audit(config))
+                with open(os.path.join(backup, "f2"), "rb") as copy, open(os.path.join(source, "f2"), "rb") as original:
+                    self.assertNotEqual(copy.read(), original.read())
+                run_backup(config)
+                with open(os.path.join(backup, "f2"), "rb") as copy, open(os.path.join(source, "f2"), "rb") as original:
+                    self.assertEqual(copy.read(), original.read())
+            finally:
+                os.chdir(cwd)
+
+    def test_audit_samples_backup_folder_without_manifest(self):
+        """Test that copies made without a manifest are sampled from the backup folder, and an empty one is not a pass."""
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, "source")
+            backup = os.path.join(workdir, "backup")
+            os.makedirs(source)
+            for index in range(3):
+                with open(os.path.join(source, f"f{index}"), "wb") as source_file:
+                    source_file.write(os.urandom(1000))
+            manifest_file = os.path.join(workdir, "manifest.db")
+            with patch("metrics.RUN_SUMMARY_FILE", os.path.join(workdir, "runs.jsonl")):
+                local_sync_directories(source, backup, manifest_file=manifest_file)
+                corrupt(os.path.join(backup, "f2"))
+                audit = audit_local(source, backup, 1.0, manifest_file=manifest_file)
+                os.makedirs(os.path.join(workdir, "empty"))
+                with self.assertLogs(level="WARNING"):
+                    empty = audit_local(source, os.path.join(workdir, "empty"), 1.0, manifest_file=manifest_file)
+            self.assertEqual(audit["files"], {"verified": 2, "mismatched": 1})
+            self.assertEqual(empty["files"], {})
+
+    def test_remote_hasher_falls_back_to_reading_back(self):
+        """Test that a server without check-file or a shell is checked by reading the copy back."""
+        data = b"backed up contents"
+        remote_file = MagicMock()
+        remote_file.stat.return_value.st_size = len(data)
+        remote_file.check.side_effect = IOError("Operation unsupported")
+        remote_file.read.side_effect = lambda size: remote_file.stream.read(size)
+        sftp = MagicMock()
+        sftp.open.return_value.__enter__.return_value = remote_file
+        sftp.get_channel.side_effect = Exception("exec refused")
+        hasher = RemoteHasher()
+        sent = StreamHasher(hasher.kinds)
+        sent.update(data)
+        remote_file.stream = io.BytesIO(data)
+        self.assertTrue(hasher.verify(sftp, "copy", sent.hexdigests()).startswith("sha256:"))
+        self.assertEqual(hasher.kinds, ("sha256",))
+        remote_file.stream = io.BytesIO(data[:-1] + b"?")
+        with self.assertRaises(IntegrityError):
+            hasher.verify(sftp, "copy", sent.hexdigests())
+
+    def test_check_file_mismatch_is_confirmed_by_reading_back(self):
+        """Test that a copy a buggy check-file says differs is read back before it is failed."""
+        data = b"backed up contents"
+        remote_file = MagicMock()
+        remote_file.stat.return_value.st_size = len(data)
+        remote_file.check.return_value = b"\0" * 20
+        remote_file.read.side_effect = lambda size: remote_file.stream.read(size)
+        sftp = MagicMock()
+        sftp.open.return_value.__enter__.return_value = remote_file
+        sftp.get_channel.side_effect = Exception("exec refused")
+        hasher = RemoteHasher()
+        sent = StreamHasher(hasher.kinds)
+        sent.update(data)
+        remote_file.stream = io.BytesIO(data)
+        self.assertTrue(hasher.verify(sftp, "copy", sent.hexdigests()).startswith("sha1-blocks:"))
+        self.assertNotIn("check-file", hasher.methods)
+        remote_file.stream = io.BytesIO(data[:-1] + b"?")
+        with self.assertRaises(IntegrityError):
+            hasher.verify(sftp, "copy", sent.hexdigests())
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+BUSINESS_HOURS = (8, 18)  # 8 AM to 6 PM
+WINDOW_CHECK_SECONDS = 5
+BURST_SECONDS = 0.5
+MIN_BURST = 64 * 1024
+MAX_WAIT = 1.0  # re-check at least this often so a new limit applies promptly
+MBPS = 125000  # bytes per second in one megabit per second
+
+RTT_INTERVAL = 5.0
+RTT_CONGESTED_RATIO = 2.0  # RTT this many times the idle RTT means the uplink is queueing
+RTT_SLACK = 0.005
+BACKOFF_FACTOR = 0.7
+RECOVERY_FACTOR = 1.1
+MIN_ADAPTIVE_RATE = 32 * 1024
+
+class TokenBucket:
+    """Thread-safe token bucket; a rate of None means unlimited."""
+
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.capacity = 0
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = rate or None
+            self.capacity = max(rate * BURST_SECONDS, MIN_BURST) if rate else 0
+            self.tokens = min(self.tokens, self.capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount):
+        """Block until amount bytes may be sent."""
+        while amount > 0:
+            with self.lock:
+                if not self.rate:
+                    return
+                self._refill()
+                take = min(amount, self.capacity)
+                if self.tokens >= take:
+                    self.tokens -= take
+                    amount -= take
+                    continue
+                wait = (take - self.tokens) / self.rate
+            time.sleep(min(wait, MAX_WAIT))
+
+class BandwidthLimiter:
+    """One token bucket shared by every transfer stream of a run.
+
+    The limit follows BUSINESS_HOURS and is re-read every few seconds, so a long
+    job changes speed as it crosses into or out of the window. With adaptive
+    throttling, observe_rtt lowers the rate while the round-trip time shows the
+    uplink queueing, and raises it again once the queue drains.
+    """
+
+    def __init__(self, business_rate=None, off_hours_rate=None, adaptive=False, business_hours=BUSINESS_HOURS,
+                 clock=datetime.now):
+        self.business_rate = business_rate or None
+        self.off_hours_rate = off_hours_rate or None
+        self.adaptive = adaptive
+        self.business_hours = business_hours
+        self.clock = clock
+        self.bucket = TokenBucket()
+        self.lock = threading.Lock()
+        self.limit = None
+        self.adaptive_rate = None
+        self.idle_rtt = None
+        self.sent = 0
+        self.sample_start = time.monotonic()
+        self.next_check = 0
+        self._update_rate()
+
+    def in_business_hours(self):
+        start, end = self.business_hours
+        return start <= self.clock().hour < end
+
+    def current_limit(self):
+        return self.business_rate if self.in_business_hours() else self.off_hours_rate
+
+    def _update_rate(self):
+        with self.lock:
+            limit = self.current_limit()
+            if limit != self.limit:
+                window = "business hours" if self.in_business_hours() else "outside business hours"
+                logging.info(f"Bandwidth limit {format_rate(limit)} ({window}).")
+                self.limit = limit
+            rates = [rate for rate in (limit, self.adaptive_rate) if rate]
+            self.bucket.set_rate(min(rates) if rates else None)
+            self.next_check = time.monotonic() + WINDOW_CHECK_SECONDS
+
+    def consume(self, amount):
+        """Block until amount bytes may be sent under the current limit."""
+        if time.monotonic() >= self.next_check:
+            self._update_rate()
+        self.bucket.consume(amount)
+        with self.lock:
+            self.sent += amount
+
+    def observe_rtt(self, rtt):
+        """Adjust the adaptive rate from a round-trip time measurement."""
+        with self.lock:
+            now = time.monotonic()
+            throughput = self.sent / max(now - self.sample_start, 1e-6)
+            self.sent = 0
+            self.sample_start = now
+            # Let the idle baseline drift up slowly in case the route changed
+            self.idle_rtt = rtt if self.idle_rtt is None else min(rtt, self.idle_rtt * 1.01)
+            congested = rtt > self.idle_rtt * RTT_CONGESTED_RATIO + RTT_SLACK
+            if congested and throughput > 0:
+                current = self.bucket.rate or throughput
+                self.adaptive_rate = max(MIN_ADAPTIVE_RATE, min(current, throughput) * BACKOFF_FACTOR)
+                logging.info(f"RTT {rtt * 1000:.0f} ms (idle {self.idle_rtt * 1000:.0f} ms); "
+                             f"slowing uploads to {format_rate(self.adaptive_rate)}.")
+            elif not congested and self.adaptive_rate is not None:
+                self.adaptive_rate *= RECOVERY_FACTOR
+                if self.limit and self.adaptive_rate >= self.limit:
+                    self.adaptive_rate = None
+        self._update_rate()
+
+class ThrottledWriter:
+    """File object wrapper that takes bytes from a limiter before each write."""
+
+    def __init__(self, file_obj, limiter):
+        self.file_obj = file_obj
+        self.limiter = limiter
+
+    def write(self, data):
+        self.limiter.consume(len(data))
+        return self.file_obj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file_obj, name)
+
+def throttled(file_obj, limiter):
+    """Wrap file_obj so writes respect limiter, or return it unchanged when there is no limiter."""
+    return ThrottledWriter(file_obj, limiter) if limiter else file_obj
+
+class RTTMonitor:
+    """Measure round-trip time on a spare SFTP session and feed it to the limiter."""
+
+    def __init__(self, sftp, limiter, interval=RTT_INTERVAL):
+        self.sftp = sftp
+        self.limiter = limiter
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._probe, name='rtt-monitor', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _probe(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                start = time.monotonic()
+                self.sftp.stat('.')
+                self.limiter.observe_rtt(time.monotonic() - start)
+            except Exception as e:
+                logging.error(f"RTT probe failed: {e}")
+                return
+
+def format_rate(rate):
+    return f"{rate * 8 / 1e6:.1f} Mbit/s" if rate else "unlimited"
+
+def create_limiter(config):
+    """Build the limiter described by the configuration, or None if uploads run at full speed."""
+    business = config.get('bandwidth_limit_business_mbps')
+    off_hours = config.get('bandwidth_limit_off_hours_mbps')
+    adaptive = config.get('bandwidth_adaptive', False)
+    if not (business or off_hours or adaptive):
+        return None
+    return BandwidthLimiter(business and business * MBPS, off_hours and off_hours * MBPS, adaptive)
@@ -1,7 +1,8 @@
 import os
 import json
 from cryptography.fernet import Fernet
-import win32com.client  # Requires `pywin32` package
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 CONFIG_FILE = 'config.json'
 KEY_FILE = 'key.key'
@@ -20,6 +21,11 @@ def load_key():
     with open(KEY_FILE, 'rb') as key_file:
         return key_file.read()
 
+def derive_payload_key(key):
+    """Derive the key that encrypts backed-up file contents from the configuration key."""
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'RemoteBackup payload encryption')
+    return hkdf.derive(key)
+
 def encrypt_config(data, key):
     """Encrypt configuration data."""
     fernet = Fernet(key)
@@ -55,6 +61,7 @@ def validate_config(config):
 
 def add_to_startup():
     """Add the program to Windows Startup."""
+    import win32com.client  # Requires `pywin32` package, so only loaded on Windows when needed
     startup_folder = os.path.join(os.getenv('APPDATA'), 'Microsoft\\Windows\\Start Menu\\Programs\\Startup')
     exe_path = os.path.abspath(__file__).replace('.py', '.exe')  # Adjust for .exe
     shortcut_path = os.path.join(startup_folder, 'RemoteBackup.lnk')
@@ -0,0 +1,135 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+DEBOUNCE_SECONDS = 2.0
+
+class ChangeSet:
+    """Debounced set of changed paths, relative to the watched folder."""
+
+    def __init__(self):
+        self.changes = {}
+        self.overflowed = False
+        self.lock = threading.Lock()
+
+    def add(self, relative_path):
+        with self.lock:
+            self.changes[relative_path] = time.monotonic()
+
+    def overflow(self):
+        """Mark that events were lost, so only a full scan is reliable."""
+        with self.lock:
+            self.overflowed = True
+
+    def collect(self, quiet_seconds=DEBOUNCE_SECONDS):
+        """Return (paths, overflowed), leaving paths changed in the last quiet_seconds for later."""
+        cutoff = time.monotonic() - quiet_seconds
+        with self.lock:
+            ready = [path for path, changed in self.changes.items() if changed <= cutoff]
+            for path in ready:
+                del self.changes[path]
+            overflowed, self.overflowed = self.overflowed, False
+        return sorted(ready), overflowed
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+EVENT_HEADER = struct.Struct('iIII')
+
+class InotifyWatcher:
+    """Collects changed paths under a folder with Linux inotify watches on every directory of the tree."""
+
+    def __init__(self, source_dir):
+        self.source_dir = os.path.abspath(source_dir)
+        self.changes = ChangeSet()
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = None
+        self.watches = {}
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watch_tree(self.source_dir)
+        self.running = True
+        self.thread = threading.Thread(target=self._read_events, name='inotify-watcher', daemon=True)
+        self.thread.start()
+        logging.info(f"Watching {len(self.watches)} directories under {self.source_dir}.")
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def collect(self, quiet_seconds=DEBOUNCE_SECONDS):
+        return self.changes.collect(quiet_seconds)
+
+    def _watch_tree(self, top):
+        for root, dirs, files in os.walk(top):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                # Typically fs.inotify.max_user_watches; changes below here are only caught by full scans
+                logging.error(f"Cannot watch {root}: {os.strerror(ctypes.get_errno())}")
+                self.changes.overflow()
+                continue
+            self.watches[wd] = root
+
+    def _read_events(self):
+        while self.running:
+            readable, _, _ = select.select([self.fd], [], [], 1.0)
+            if not readable:
+                continue
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                self._handle(wd, mask, os.fsdecode(name))
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logging.info("Change queue overflowed; the next run will do a full scan.")
+            self.changes.overflow()
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        directory = self.watches.get(wd)
+        if directory is None or not name:
+            return
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self._watch_tree(path)
+        self.changes.add(os.path.relpath(path, self.source_dir))
+
+def create_watcher(source_dir):
+    """Return a watcher for this platform, or None if change notifications are unavailable."""
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(source_dir)
+        except OSError as e:
+            logging.error(f"inotify is unavailable: {e}")
+    return None
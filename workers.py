@@ -0,0 +1,127 @@
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from scheduling import SCHEDULE_WINDOW, WALK_ORDER
+
+# Shared by every pool in the process, so concurrent jobs together stay under one cap
+_transfer_slots = None
+
+def set_transfer_limit(limit):
+    """Allow at most limit tasks to run at once across all pools; None or 0 removes the cap."""
+    global _transfer_slots
+    _transfer_slots = threading.BoundedSemaphore(limit) if limit else None
+
+@contextmanager
+def transfer_slot():
+    """Hold one of the process-wide transfer slots, if there is a cap."""
+    slots = _transfer_slots
+    if slots is None:
+        yield
+        return
+    with slots:
+        yield
+
+class TransferQueue:
+    """Bounded queue of tasks, handed out in the order a TransferPolicy ranks them.
+
+    Entries stay sorted by the policy's key, so the most urgent task is first.
+    With the 'interleave' order, one worker takes the largest task of the most
+    urgent rank instead, so big files keep moving without holding up small ones.
+    """
+
+    def __init__(self, maxsize, policy, parallelism):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.parallelism = parallelism
+        self.entries = []
+        self.sequence = 0
+        self.closed = False
+        self.large_turn = False
+        self.condition = threading.Condition()
+
+    def put(self, task, relative_path='', size=0):
+        with self.condition:
+            while len(self.entries) >= self.maxsize:
+                self.condition.wait()
+            self.sequence += 1
+            key = self.policy.key(relative_path, size, self.sequence)
+            bisect.insort(self.entries, (key, relative_path, size, task))
+            self.condition.notify_all()
+
+    def get(self, worker_index):
+        """Return the next (key, relative_path, size, task), or None once closed and empty."""
+        with self.condition:
+            while not self.entries and not self.closed:
+                self.condition.wait()
+            if not self.entries:
+                return None
+            index = 0
+            if self.policy.order == 'interleave':
+                if self.parallelism > 1:
+                    large = worker_index == 0
+                else:
+                    # A single stream alternates between the two ends
+                    large = self.large_turn = not self.large_turn
+                if large:
+                    rank = self.entries[0][0][0]
+                    index = bisect.bisect_left(self.entries, ((rank + 1,),)) - 1
+            entry = self.entries.pop(index)
+            self.condition.notify_all()
+            return entry
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class WorkerPool:
+    """Run tasks on a fixed number of threads fed from a bounded queue.
+
+    Each thread may hold its own session (an SFTP channel, for example), opened
+    with open_session and passed to every task it runs. Exceptions are the task's
+    own responsibility; anything that escapes is logged and the worker carries on.
+    Tasks start in the order the policy sets, and none start once its deadline
+    has passed; those are listed in deferred as (relative_path, size).
+    """
+
+    def __init__(self, parallelism, open_session=None, name='worker', queue_size=None, policy=None):
+        self.parallelism = max(1, int(parallelism or 1))
+        self.policy = policy or WALK_ORDER
+        # Reordering needs a wide view of what is pending; walk order only needs to keep workers busy
+        default_size = SCHEDULE_WINDOW if self.policy.reorders else self.parallelism * 4
+        self.tasks = TransferQueue(queue_size or default_size, self.policy, self.parallelism)
+        self.deferred = []
+        self.lock = threading.Lock()
+        self.threads = []
+        for index in range(self.parallelism):
+            session = open_session() if open_session else None
+            thread = threading.Thread(target=self._work, args=(session, index), name=f"{name}-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self, session, index):
+        while True:
+            entry = self.tasks.get(index)
+            if entry is None:
+                return
+            _, relative_path, size, task = entry
+            if self.policy.expired():
+                with self.lock:
+                    self.deferred.append((relative_path, size))
+                continue
+            try:
+                with transfer_slot():
+                    task(session)
+            except Exception as e:
+                logging.error(f"Worker error: {e}")
+
+    def submit(self, task, relative_path='', size=0):
+        """Queue a task, blocking while the queue is full."""
+        self.tasks.put(task, relative_path, size)
+
+    def join(self):
+        """Wait for every queued task and stop the workers."""
+        self.tasks.close()
+        for thread in self.threads:
+            thread.join()